@@ -0,0 +1,335 @@
+"""
+Greedy micro-batching of model inference over a shared-memory image ring
+
+Requests claim consecutive slots of a `SharedImageRing`, decode into them
+(in a thread, or in a decode process pool writing straight into shared
+memory) and wait for their row of the model output. A single runner task
+per model takes every ready slot (up to the batch size) in claim order, so a
+slow decode never holds back images that finished decoding after it, and
+resolves every waiting request. Ready slots that are consecutive in the ring
+are handed to the model as a view; otherwise they are gathered into a
+preallocated batch array. Padding and failed slots are freed without being
+run.
+
+No artificial delay is added: the runner fires as soon as anything is ready,
+and whatever arrives while the model is busy forms the next batch.
+
+A model may also return a second per-image output (e.g. an embedding) next to
+its main output; only requests that ask for it get it.
+"""
+
+import asyncio
+import logging
+from concurrent.futures import Executor
+from typing import Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+from shm_ring import SharedImageRing, decode_into_ring
+
+
+logger = logging.getLogger(__name__)
+
+
+class _SlotState:
+    """Book-keeping for one claimed ring slot"""
+
+    __slots__ = ("future", "ready", "skip", "with_extra")
+
+    def __init__(self, future: Optional[asyncio.Future], with_extra: bool = False):
+        self.future = future
+        self.ready = future is None
+        self.skip = future is None  # padding slot, or a slot whose decode failed
+        self.with_extra = with_extra  # resolve with (output row, extra row)
+
+
+class InferenceBatcher:
+    """Batches inference for one model, reading inputs from a SharedImageRing"""
+
+    def __init__(
+        self,
+        name: str,
+        predict_fn: Callable[[np.ndarray], np.ndarray],
+        image_size: Tuple[int, int],
+        max_batch_size: int = 16,
+        num_slots: int = 64,
+        decode_pool: Optional[Executor] = None,
+    ):
+        """
+        Args:
+            name: Label used in logs (usually the plant type)
+            predict_fn: Called with a uint8 batch view (N, H, W, 3); returns (N, C)
+                outputs, or a tuple of (N, C) outputs and an (N, D) extra output
+            image_size: Model input (width, height)
+            max_batch_size: Largest batch handed to predict_fn
+            num_slots: Ring capacity; bounds the number of in-flight images
+            decode_pool: Optional process pool used to decode uploads into the ring
+        """
+        if num_slots < max_batch_size:
+            raise ValueError("num_slots must be at least max_batch_size")
+
+        self.name = name
+        self.predict_fn = predict_fn
+        self.image_size = tuple(image_size)
+        self.max_batch_size = max_batch_size
+        self.decode_pool = decode_pool
+        self.ring = SharedImageRing(num_slots, self.image_size)
+
+        self._head = 0  # sequence number of the next slot to claim
+        self._tail = 0  # sequence number of the oldest slot not yet run
+        self._slots: Dict[int, _SlotState] = {}
+        self._slot_freed = asyncio.Condition()
+        self._claim_lock = asyncio.Lock()
+        self._wakeup = asyncio.Event()
+        self._runner: Optional[asyncio.Task] = None
+        width, height = self.image_size
+        # Ready slots that are not consecutive in the ring are copied here
+        self._gathered = np.empty((max_batch_size, height, width, 3), dtype=np.uint8)
+
+        self.batches_run = 0
+        self.images_run = 0
+
+    def start(self):
+        """Start the runner task (must be called from the running event loop)"""
+        if self._runner is None:
+            self._runner = asyncio.get_running_loop().create_task(self._run())
+
+    async def close(self):
+        """Stop the runner, fail anything still waiting and free the shared memory"""
+        if self._runner is not None:
+            self._runner.cancel()
+            try:
+                await self._runner
+            except asyncio.CancelledError:
+                pass
+            self._runner = None
+
+        for state in self._slots.values():
+            if state.future is not None and not state.future.done():
+                state.future.set_exception(RuntimeError(f"{self.name} batcher shut down"))
+        self._slots.clear()
+        self.ring.close()
+
+    async def _claim(self, count: int, with_extra: bool = False) -> int:
+        """
+        Reserve `count` consecutive ring slots and return the first sequence number
+
+        A claim never wraps around the end of the ring, so multi-image requests
+        always land in one contiguous view; the leftover slots at the end are
+        filled with skipped padding instead. Slots are run out of order, so a
+        claim waits until the earlier occupants of exactly its slots are freed.
+        """
+        if count > self.max_batch_size:
+            raise ValueError(f"Cannot claim {count} slots, max batch size is {self.max_batch_size}")
+
+        loop = asyncio.get_running_loop()
+        async with self._claim_lock:
+            padding = 0
+            offset = self._head % self.ring.num_slots
+            if offset + count > self.ring.num_slots:
+                padding = self.ring.num_slots - offset
+
+            needed = range(self._head - self.ring.num_slots, self._head - self.ring.num_slots + padding + count)
+            async with self._slot_freed:
+                await self._slot_freed.wait_for(lambda: not any(seq in self._slots for seq in needed))
+
+            for _ in range(padding):
+                self._slots[self._head] = _SlotState(None)
+                self._head += 1
+
+            first = self._head
+            for _ in range(count):
+                self._slots[self._head] = _SlotState(loop.create_future(), with_extra)
+                self._head += 1
+
+        if padding:
+            self._wakeup.set()
+        return first
+
+    def _commit(self, seq: int):
+        self._slots[seq].ready = True
+        self._wakeup.set()
+
+    def _abandon(self, seq: int):
+        state = self._slots.get(seq)
+        if state is None:
+            return
+        state.ready = True
+        state.skip = True
+        self._wakeup.set()
+
+    async def submit_bytes(self, image_data: bytes, with_extra: bool = False):
+        """
+        Decode encoded image bytes into the ring and return the model output row
+
+        Decoding runs in the decode process pool when one is configured,
+        otherwise in a thread.
+
+        Args:
+            image_data: Encoded image
+            with_extra: Return (output row, extra output row) instead; the
+                extra row is None when the model has no extra output
+        """
+        seq = await self._claim(1, with_extra)
+        index = seq % self.ring.num_slots
+        if self.decode_pool is not None:
+            decode = asyncio.get_running_loop().run_in_executor(
+                self.decode_pool,
+                decode_into_ring,
+                self.ring.name,
+                self.ring.num_slots,
+                self.image_size,
+                index,
+                image_data,
+            )
+        else:
+            decode = asyncio.ensure_future(asyncio.to_thread(self.ring.write_image, index, image_data))
+
+        try:
+            await asyncio.shield(decode)
+        except asyncio.CancelledError:
+            # The decoder may still be writing into the slot; only give it
+            # back once it has finished.
+            decode.add_done_callback(lambda _: self._abandon(seq))
+            raise
+        except Exception:
+            self._abandon(seq)
+            raise
+
+        self._commit(seq)
+        return await self._slots[seq].future
+
+    async def submit_pixels(self, pixels: np.ndarray) -> np.ndarray:
+        """
+        Run already resized uint8 images (N, H, W, 3) and return their (N, C) outputs
+
+        The N images occupy consecutive slots, so they normally run in a
+        single forward pass.
+        """
+        return await self.submit_fill(
+            pixels.shape[0], lambda view: np.copyto(view, pixels, casting="unsafe"), in_thread=False
+        )
+
+    async def submit_fill(
+        self, count: int, fill: Callable[[np.ndarray], None], in_thread: bool = True
+    ) -> np.ndarray:
+        """
+        Let `fill` write `count` images straight into the ring and return their (N, C) outputs
+
+        Useful when the images are cut out of a larger array (e.g. tiles), so
+        they never need their own intermediate batch array.
+
+        Args:
+            count: Number of images (at most max_batch_size)
+            fill: Called with the (count, H, W, 3) uint8 view of the claimed slots
+            in_thread: Run `fill` in a worker thread instead of on the event loop
+        """
+        first = await self._claim(count)
+        view = self.ring.batch_view(first % self.ring.num_slots, count)
+
+        def abandon_all(*_):
+            for seq in range(first, first + count):
+                self._abandon(seq)
+
+        if in_thread:
+            filling = asyncio.ensure_future(asyncio.to_thread(fill, view))
+            try:
+                await asyncio.shield(filling)
+            except asyncio.CancelledError:
+                # The thread may still be writing; only give the slots back once it is done
+                filling.add_done_callback(abandon_all)
+                raise
+            except Exception:
+                abandon_all()
+                raise
+        else:
+            try:
+                fill(view)
+            except BaseException:
+                abandon_all()
+                raise
+
+        futures = []
+        for seq in range(first, first + count):
+            futures.append(self._slots[seq].future)
+            self._slots[seq].ready = True
+        self._wakeup.set()
+
+        rows = await asyncio.gather(*futures)
+        return np.stack(rows)
+
+    def _next_batch(self) -> Tuple[List[int], List[int]]:
+        """
+        Ready slots to run next, oldest first
+
+        Returns:
+            Sequence numbers of up to max_batch_size ready live slots, and of
+            the ready padding or failed slots, which are freed without running
+        """
+        batch, skipped = [], []
+        for seq in range(self._tail, self._head):
+            state = self._slots.get(seq)
+            if state is None or not state.ready:
+                continue
+            if state.skip:
+                skipped.append(seq)
+            elif len(batch) < self.max_batch_size:
+                batch.append(seq)
+        return batch, skipped
+
+    def _batch_inputs(self, batch: List[int]) -> np.ndarray:
+        """The ring view of the batch's slots, or a copy of them when they are not consecutive"""
+        start = batch[0] % self.ring.num_slots
+        if batch[-1] - batch[0] == len(batch) - 1 and start + len(batch) <= self.ring.num_slots:
+            return self.ring.batch_view(start, len(batch))
+        indices = [seq % self.ring.num_slots for seq in batch]
+        return np.take(self.ring.array, indices, axis=0, out=self._gathered[: len(batch)])
+
+    def _predict(self, batch: List[int]):
+        inputs = self._batch_inputs(batch)
+        try:
+            return self.predict_fn(inputs)
+        finally:
+            del inputs
+
+    async def _free(self, seqs: List[int]):
+        for seq in seqs:
+            del self._slots[seq]
+        while self._tail < self._head and self._tail not in self._slots:
+            self._tail += 1
+        async with self._slot_freed:
+            self._slot_freed.notify_all()
+
+    async def _run(self):
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+
+            while True:
+                batch, skipped = self._next_batch()
+                if not batch and not skipped:
+                    break
+
+                if batch:
+                    states = [self._slots[seq] for seq in batch]
+                    try:
+                        outputs = await asyncio.to_thread(self._predict, batch)
+                        extras = None
+                        if isinstance(outputs, tuple):
+                            outputs, extras = outputs
+                    except Exception as e:
+                        logger.error(f"{self.name} batch inference failed: {str(e)}")
+                        for state in states:
+                            if not state.future.done():
+                                state.future.set_exception(e)
+                    else:
+                        self.batches_run += 1
+                        self.images_run += len(batch)
+                        for i, (state, row) in enumerate(zip(states, outputs)):
+                            if not state.future.done():
+                                if state.with_extra:
+                                    state.future.set_result((row, extras[i] if extras is not None else None))
+                                else:
+                                    state.future.set_result(row)
+
+                await self._free(batch + skipped)
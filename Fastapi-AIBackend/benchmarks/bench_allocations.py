@@ -0,0 +1,134 @@
+"""
+Measure input allocations and garbage-collector pressure of the predict path
+
+Runs one crop model on uint8 batches, as the image ring hands them to the
+batcher, through:
+  - per-batch float32:  a new float32 copy of every batch (the previous path)
+  - preallocated:       make_batch_predict_fn's reused input buffer
+  - preallocated bf16:  the same on the bfloat16 copy of the model (--bfloat16)
+
+and reports per batch size:
+  - input MB:   highest Python/numpy heap growth (tracemalloc) while a batch
+                runs, which is where the float32 copies show up
+                (TensorFlow's own allocator is not traced)
+  - gc/1k:      garbage collections per 1000 batches, all generations
+  - gc ms/1k:   time spent in those collections per 1000 batches
+  - mean ms:    mean batch latency, measured without tracemalloc
+
+Run from the Fastapi-AIBackend directory:
+
+    python benchmarks/bench_allocations.py --plant tomato --batch-sizes 1 8 16 --runs 200 --bfloat16
+"""
+
+import argparse
+import gc
+import statistics
+import sys
+import threading
+import time
+import tracemalloc
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main  # noqa: E402
+from memory_profile import to_mb  # noqa: E402
+
+
+def per_batch_float32_fn(model):
+    """The predict wrapper before input buffers were preallocated"""
+
+    def predict_batch(batch):
+        return model.predict_on_batch(batch.astype(np.float32) / 255.0)
+
+    return predict_batch
+
+
+def gc_pressure(predict, batch, runs):
+    """Mean latency (ms), collections and collection time (ms) over `runs` batches"""
+    pauses = []
+    # Start times keyed by (thread, generation): each "stop" is timed against
+    # its own collection's "start", and a stop with no recorded start (the
+    # collection began before the callback was installed) is not counted
+    started = {}
+
+    def on_gc(phase, info):
+        key = (threading.get_ident(), info["generation"])
+        if phase == "start":
+            started[key] = time.perf_counter()
+        elif key in started:
+            pauses.append((time.perf_counter() - started.pop(key)) * 1000)
+
+    timings = []
+    collections_before = sum(stats["collections"] for stats in gc.get_stats())
+    gc.callbacks.append(on_gc)
+    try:
+        for _ in range(runs):
+            begin = time.perf_counter()
+            predict(batch)
+            timings.append((time.perf_counter() - begin) * 1000)
+    finally:
+        gc.callbacks.remove(on_gc)
+    collections = sum(stats["collections"] for stats in gc.get_stats()) - collections_before
+    return statistics.mean(timings), collections, sum(pauses)
+
+
+def input_allocations(predict, batch, runs):
+    """Highest traced heap growth (bytes) while running a batch"""
+    tracemalloc.start()
+    try:
+        highest = 0
+        for _ in range(runs):
+            tracemalloc.reset_peak()
+            current, _ = tracemalloc.get_traced_memory()
+            predict(batch)
+            highest = max(highest, tracemalloc.get_traced_memory()[1] - current)
+        return highest
+    finally:
+        tracemalloc.stop()
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="Benchmark input allocations and GC pressure")
+    parser.add_argument("--plant", default="tomato", choices=list(main.MODEL_PATHS.keys()))
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, main.INFERENCE_MAX_BATCH])
+    parser.add_argument("--runs", type=int, default=100, help="Batches per measurement")
+    parser.add_argument("--bfloat16", action="store_true", help="Also run the bfloat16 copy of the model")
+    args = parser.parse_args()
+
+    if not main.load_model_and_labels(args.plant):
+        sys.exit(f"Could not load the {args.plant} model")
+    model = main.models[args.plant]
+
+    variants = [
+        ("per-batch float32", per_batch_float32_fn(model)),
+        ("preallocated", main.make_batch_predict_fn(model, max_batch_size=max(args.batch_sizes))),
+    ]
+    if args.bfloat16:
+        if not main.cpu_supports_bfloat16():
+            print("Note: this CPU has no native bfloat16 support, expect it to be slow\n")
+        mixed = main.build_bfloat16_model(model)
+        if mixed is None:
+            sys.exit(f"Could not build a bfloat16 copy of the {args.plant} model")
+        variants.append(("preallocated bf16", main.make_batch_predict_fn(mixed, max_batch_size=max(args.batch_sizes))))
+
+    height, width = model.input_shape[1:3] if model.input_shape[1] else main.IMG_SIZE[::-1]
+    rng = np.random.default_rng(0)
+
+    print(f"{'variant':<18} {'batch':>5} {'input MB':>9} {'gc/1k':>7} {'gc ms/1k':>9} {'mean ms':>9}")
+    for batch_size in args.batch_sizes:
+        batch = rng.integers(0, 255, (batch_size, height, width, 3), dtype=np.uint8)
+        for name, predict in variants:
+            predict(batch)  # warm up this batch size
+            mean_ms, collections, pause_ms = gc_pressure(predict, batch, args.runs)
+            input_bytes = input_allocations(predict, batch, min(args.runs, 20))
+            print(
+                f"{name:<18} {batch_size:>5} {to_mb(input_bytes):>9.1f} {collections * 1000 / args.runs:>7.1f} "
+                f"{pause_ms * 1000 / args.runs:>9.2f} {mean_ms:>9.2f}"
+            )
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,124 @@
+"""
+Measure the memory footprint of the crop models and catch regressions
+
+Loads each crop model the way the API does, then runs every batch size a few
+times and reports:
+  - RSS growth when each model is loaded
+  - peak RSS above the starting point while running each batch size
+  - the process RSS at the end
+
+With --max-rss-mb the run fails (exit code 1) when the final RSS is higher.
+With --baseline the run fails when the final RSS or any model's load growth
+exceeds a saved earlier run by more than --tolerance; --save-baseline writes
+such a file.
+
+Run from the Fastapi-AIBackend directory:
+
+    python benchmarks/bench_memory.py --plants tomato rice --save-baseline memory_baseline.json
+    python benchmarks/bench_memory.py --plants tomato rice --baseline memory_baseline.json --tolerance 0.1
+"""
+
+import argparse
+import json
+import sys
+from pathlib import Path
+
+import numpy as np
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main  # noqa: E402
+from memory_profile import current_rss, measure_memory, to_mb  # noqa: E402
+
+
+def measure_batches(plant_type, batch_sizes, runs):
+    """Peak RSS growth (MB) per batch size, the highest over `runs` forward passes"""
+    predict = main.make_batch_predict_fn(main.models[plant_type])
+    width, height = main.IMG_SIZE
+    peaks = {}
+    for batch_size in batch_sizes:
+        batch = np.zeros((batch_size, height, width, 3), dtype=np.uint8)
+        highest = 0.0
+        for _ in range(runs):
+            with measure_memory() as memory:
+                predict(batch)
+            highest = max(highest, memory["peak_delta_mb"])
+        peaks[batch_size] = highest
+    return peaks
+
+
+def check_regressions(result, args):
+    """Failure messages for every figure over its limit"""
+    failures = []
+    if args.max_rss_mb is not None and result["final_rss_mb"] > args.max_rss_mb:
+        failures.append(f"final RSS {result['final_rss_mb']} MB > limit {args.max_rss_mb} MB")
+
+    if args.baseline:
+        baseline = json.loads(Path(args.baseline).read_text())
+        allowed = 1 + args.tolerance
+        if result["final_rss_mb"] > baseline["final_rss_mb"] * allowed:
+            failures.append(
+                f"final RSS {result['final_rss_mb']} MB > baseline {baseline['final_rss_mb']} MB "
+                f"+{args.tolerance:.0%}"
+            )
+        for plant_type, figures in result["models"].items():
+            before = baseline["models"].get(plant_type)
+            if before is None:
+                continue
+            # Small models: allow at least 1 MB of measurement noise
+            limit = max(before["load_rss_mb"] * allowed, before["load_rss_mb"] + 1.0)
+            if figures["load_rss_mb"] > limit:
+                failures.append(
+                    f"{plant_type} load growth {figures['load_rss_mb']} MB > baseline {before['load_rss_mb']} MB "
+                    f"+{args.tolerance:.0%}"
+                )
+    return failures
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="Benchmark model memory footprint")
+    parser.add_argument("--plants", nargs="+", default=list(main.MODEL_PATHS.keys()), choices=list(main.MODEL_PATHS.keys()))
+    parser.add_argument("--batch-sizes", type=int, nargs="+", default=[1, 4, main.INFERENCE_MAX_BATCH])
+    parser.add_argument("--runs", type=int, default=3, help="Forward passes per batch size")
+    parser.add_argument("--max-rss-mb", type=float, help="Fail if the final RSS exceeds this")
+    parser.add_argument("--baseline", help="JSON from an earlier --save-baseline run to compare against")
+    parser.add_argument("--tolerance", type=float, default=0.1, help="Allowed growth over the baseline (0.1 = 10%%)")
+    parser.add_argument("--save-baseline", help="Write this run's figures to a JSON file")
+    args = parser.parse_args()
+
+    if current_rss() is None:
+        sys.exit("Current RSS is not available on this platform (needs /proc/self/status)")
+
+    result = {"start_rss_mb": to_mb(current_rss()), "models": {}}
+    print(f"Start RSS: {result['start_rss_mb']} MB\n")
+    print(f"{'model':<10} {'load MB':>9}   " + "   ".join(f"{'batch ' + str(b) + ' MB':>12}" for b in args.batch_sizes))
+    for plant_type in args.plants:
+        if not main.load_model_and_labels(plant_type):
+            sys.exit(f"Could not load the {plant_type} model")
+        figures = {
+            "load_rss_mb": main.model_memory[plant_type]["load_rss_mb"],
+            "batch_peak_mb": measure_batches(plant_type, args.batch_sizes, args.runs),
+        }
+        result["models"][plant_type] = figures
+        print(
+            f"{plant_type:<10} {figures['load_rss_mb']:>9.1f}   "
+            + "   ".join(f"{figures['batch_peak_mb'][b]:>12.1f}" for b in args.batch_sizes)
+        )
+
+    result["final_rss_mb"] = to_mb(current_rss())
+    print(f"\nFinal RSS: {result['final_rss_mb']} MB")
+
+    if args.save_baseline:
+        Path(args.save_baseline).write_text(json.dumps(result, indent=2))
+        print(f"Saved baseline to {args.save_baseline}")
+
+    failures = check_regressions(result, args)
+    if failures:
+        print("\nMemory regression:")
+        for failure in failures:
+            print(f"  - {failure}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main_benchmark()
@@ -0,0 +1,100 @@
+"""
+Benchmark the latency overhead of test-time augmentation
+
+Compares, for one crop model:
+  - single view:  one image per forward pass (the normal predict path)
+  - TTA batched:  all TTA views in one forward pass (what ?tta=true does)
+  - TTA serial:   the same views as separate forward passes
+
+Run from the Fastapi-AIBackend directory:
+
+    python benchmarks/bench_tta.py --plant tomato --images path/to/leaves --runs 50
+"""
+
+import argparse
+import statistics
+import sys
+import time
+from pathlib import Path
+
+import numpy as np
+from PIL import Image
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+
+import main  # noqa: E402
+
+
+def load_images(images_dir, count):
+    """Load sample images from a directory, or generate synthetic ones"""
+    if images_dir:
+        paths = sorted(p for p in Path(images_dir).iterdir() if p.suffix.lower() in {".jpg", ".jpeg", ".png"})
+        return [Image.open(p).convert("RGB") for p in paths[:count]]
+
+    rng = np.random.default_rng(0)
+    return [Image.fromarray(rng.integers(0, 255, (1200, 1600, 3), dtype=np.uint8)) for _ in range(count)]
+
+
+def time_ms(fn, runs):
+    timings = []
+    for _ in range(runs):
+        started = time.perf_counter()
+        fn()
+        timings.append((time.perf_counter() - started) * 1000)
+    return timings
+
+
+def summarize(name, timings):
+    timings = sorted(timings)
+    p95 = timings[min(len(timings) - 1, int(len(timings) * 0.95))]
+    print(f"{name:<14} mean {statistics.mean(timings):8.2f} ms   p50 {statistics.median(timings):8.2f} ms   p95 {p95:8.2f} ms")
+    return statistics.mean(timings)
+
+
+def main_benchmark():
+    parser = argparse.ArgumentParser(description="Benchmark TTA latency overhead")
+    parser.add_argument("--plant", default="tomato", choices=list(main.MODEL_PATHS.keys()))
+    parser.add_argument("--images", help="Directory of sample images (default: synthetic)")
+    parser.add_argument("--runs", type=int, default=30)
+    args = parser.parse_args()
+
+    if not main.load_model_and_labels(args.plant):
+        sys.exit(f"Could not load the {args.plant} model")
+    predict = main.make_batch_predict_fn(main.models[args.plant])
+
+    images = load_images(args.images, 8)
+
+    # Warm up every batch size we are going to use
+    predict(main.prepare_pixels(images[0], main.IMG_SIZE)[np.newaxis])
+    predict(main.build_tta_batch(images[0]))
+
+    cycle = {"i": 0}
+
+    def next_image():
+        cycle["i"] = (cycle["i"] + 1) % len(images)
+        return images[cycle["i"]]
+
+    def single_view():
+        predict(main.prepare_pixels(next_image(), main.IMG_SIZE)[np.newaxis])
+
+    def tta_batched():
+        predict(main.build_tta_batch(next_image()))
+
+    def tta_serial():
+        for view in main.build_tta_batch(next_image()):
+            predict(view[np.newaxis])
+
+    # Every timing includes preprocessing (resize / view construction) of the decoded image
+    print(f"{args.plant}: {len(main.TTA_VIEWS)} TTA views, {args.runs} runs\n")
+    summarize("build views", time_ms(lambda: main.build_tta_batch(next_image()), args.runs))
+    single = summarize("single view", time_ms(single_view, args.runs))
+    batched = summarize("TTA batched", time_ms(tta_batched, args.runs))
+    serial = summarize("TTA serial", time_ms(tta_serial, args.runs))
+
+    print()
+    print(f"TTA batched overhead vs single view: {batched / single:.2f}x")
+    print(f"TTA batched speed-up vs serial:      {serial / batched:.2f}x")
+
+
+if __name__ == "__main__":
+    main_benchmark()
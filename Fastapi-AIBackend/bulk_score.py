@@ -0,0 +1,358 @@
+"""
+Offline bulk scoring of field photos
+
+Streams images out of a directory, a zip file or a tar archive (plain or
+compressed) without extracting anything to disk, decodes them in a process
+pool straight into a shared-memory image ring, and classifies them in
+batches with the same models and class labels as the API.
+
+Decode workers resize with shm_ring.prepare_pixels, the function the API's
+image rings use, so bulk scores match /predict for the same image. The API's
+helpers live in main, which imports TensorFlow, and decode workers must stay
+light.
+
+Results are appended to the output after every batch, so an interrupted run
+can be resumed. Images already scored are skipped, and images that failed
+are tried again. A retried image gets a new row, and the last row for a path
+is the current one. Parquet output is a directory of part files. Each part
+is written by a single ParquetWriter and rolls over every
+PARQUET_ROWS_PER_FILE rows.
+
+Examples:
+
+    python bulk_score.py --plant rice field_photos/ --output rice.csv
+    python bulk_score.py --plant mango uploads.zip --output mango.ndjson --workers 8
+    python bulk_score.py --plant cotton survey.tar.gz --output cotton.parquet --resume
+"""
+
+import argparse
+import csv
+import json
+import multiprocessing
+import os
+import sys
+import tarfile
+import time
+import zipfile
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+from typing import Iterator, List, Set, Tuple
+
+from shm_ring import SharedImageRing, decode_into_ring
+
+
+IMAGE_EXTENSIONS = {".jpg", ".jpeg", ".png", ".bmp", ".tif", ".tiff"}
+OUTPUT_FIELDS = ["path", "plant_type", "predicted_class", "confidence", "top_3_predictions", "error"]
+PARQUET_ROWS_PER_FILE = int(os.getenv("PARQUET_ROWS_PER_FILE", "1000000"))
+
+
+def is_image_name(name: str) -> bool:
+    return Path(name).suffix.lower() in IMAGE_EXTENSIONS and not Path(name).name.startswith(".")
+
+
+def member_key(name: str) -> str:
+    """Archive member name as a stable result key ("./a/b.jpg" -> "a/b.jpg")"""
+    while name.startswith("./"):
+        name = name[2:]
+    return name
+
+
+def iter_directory(root: Path) -> Iterator[Tuple[str, bytes]]:
+    for dirpath, dirnames, filenames in os.walk(root):
+        dirnames.sort()
+        for filename in sorted(filenames):
+            if is_image_name(filename):
+                path = Path(dirpath) / filename
+                yield path.relative_to(root).as_posix(), path.read_bytes()
+
+
+def iter_zip(archive: Path) -> Iterator[Tuple[str, bytes]]:
+    with zipfile.ZipFile(archive) as zf:
+        for info in zf.infolist():
+            if not info.is_dir() and is_image_name(info.filename):
+                yield member_key(info.filename), zf.read(info)
+
+
+def iter_tar(archive: Path) -> Iterator[Tuple[str, bytes]]:
+    # "r|*" reads the archive as a stream (any compression), never seeking back
+    with tarfile.open(archive, mode="r|*") as tf:
+        for member in tf:
+            if member.isfile() and is_image_name(member.name):
+                fileobj = tf.extractfile(member)
+                if fileobj is not None:
+                    yield member_key(member.name), fileobj.read()
+
+
+def iter_images(source: Path) -> Iterator[Tuple[str, bytes]]:
+    """Yield (key, encoded image bytes) for every image in a directory or archive"""
+    if source.is_dir():
+        return iter_directory(source)
+    if zipfile.is_zipfile(source):
+        return iter_zip(source)
+    if tarfile.is_tarfile(source):
+        return iter_tar(source)
+    raise ValueError(f"{source} is not a directory, zip file or tar archive")
+
+
+class ResultWriter:
+    """Appends result rows to CSV, NDJSON or Parquet output"""
+
+    def __init__(self, output: Path):
+        self.output = output
+        self.format = output.suffix.lower().lstrip(".")
+        if self.format not in {"csv", "ndjson", "jsonl", "parquet"}:
+            raise ValueError("Output must end in .csv, .ndjson, .jsonl or .parquet")
+        self._file = None
+        self._csv = None
+        self._parquet_part = None
+        self._parquet_writer = None
+        self._parquet_rows = 0
+
+    def completed_keys(self) -> Set[str]:
+        """Keys scored successfully by a previous (possibly interrupted) run
+
+        A key whose last row records an error is left out, so it is retried.
+        """
+        if not self.output.exists():
+            return set()
+
+        if self.format == "parquet":
+            import pyarrow.parquet as pq
+
+            errors = {}
+            for part in sorted(self.output.glob("part-*.parquet")):
+                try:
+                    table = pq.read_table(part, columns=["path", "error"])
+                except Exception:
+                    # Killed before the writer wrote its footer; those images are scored again.
+                    # Parquet readers skip "_"-prefixed files, so the directory stays readable
+                    aside = part.with_name(f"_incomplete-{part.name}")
+                    print(f"Skipping unreadable {part.name}, renamed to {aside.name}")
+                    part.rename(aside)
+                    continue
+                errors.update(zip(table.column("path").to_pylist(), table.column("error").to_pylist()))
+            return {key for key, error in errors.items() if not error}
+
+        self._drop_partial_line()
+        with open(self.output, "r", newline="", encoding="utf-8") as f:
+            if self.format == "csv":
+                rows = csv.DictReader(f)
+            else:
+                rows = (json.loads(line) for line in f if line.strip())
+            errors = {row["path"]: row["error"] for row in rows}
+        return {key for key, error in errors.items() if not error}
+
+    def _drop_partial_line(self):
+        """Cut off a half-written last line left behind by an interrupted run"""
+        with open(self.output, "rb+") as f:
+            data = f.read()
+            if data and not data.endswith(b"\n"):
+                f.truncate(data.rfind(b"\n") + 1)
+
+    def open(self):
+        if self.format == "parquet":
+            self.output.mkdir(parents=True, exist_ok=True)
+            parts = [int(part.stem.split("-")[1]) for part in self.output.glob("part-*.parquet")]
+            self._parquet_part = max(parts, default=-1) + 1
+            return
+
+        new_file = not self.output.exists() or self.output.stat().st_size == 0
+        self._file = open(self.output, "a", newline="", encoding="utf-8")
+        if self.format == "csv":
+            self._csv = csv.DictWriter(self._file, fieldnames=OUTPUT_FIELDS)
+            if new_file:
+                self._csv.writeheader()
+
+    def write(self, rows: List[dict]):
+        if not rows:
+            return
+
+        if self.format == "parquet":
+            import pyarrow as pa
+            import pyarrow.parquet as pq
+
+            # Explicit schema: a batch with no failures would otherwise infer a null "error" column
+            schema = pa.schema(
+                [(field, pa.float64() if field == "confidence" else pa.string()) for field in OUTPUT_FIELDS]
+            )
+            table = pa.Table.from_pylist(
+                [{**row, "top_3_predictions": json.dumps(row["top_3_predictions"])} for row in rows],
+                schema=schema,
+            )
+            if self._parquet_writer is not None and self._parquet_rows >= PARQUET_ROWS_PER_FILE:
+                self._close_parquet_part()
+            if self._parquet_writer is None:
+                self._parquet_writer = pq.ParquetWriter(
+                    self.output / f"part-{self._parquet_part:06d}.parquet", schema
+                )
+            self._parquet_writer.write_table(table)
+            self._parquet_rows += len(rows)
+            return
+
+        for row in rows:
+            if self.format == "csv":
+                self._csv.writerow({**row, "top_3_predictions": json.dumps(row["top_3_predictions"])})
+            else:
+                self._file.write(json.dumps(row, separators=(",", ":")) + "\n")
+        self._file.flush()
+
+    def _close_parquet_part(self):
+        self._parquet_writer.close()
+        self._parquet_writer = None
+        self._parquet_part += 1
+        self._parquet_rows = 0
+
+    def close(self):
+        if self._parquet_writer is not None:
+            self._close_parquet_part()
+        if self._file is not None:
+            self._file.close()
+
+
+def chunked(entries: Iterator[Tuple[str, bytes]], size: int) -> Iterator[List[Tuple[str, bytes]]]:
+    chunk = []
+    for entry in entries:
+        chunk.append(entry)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def score(args):
+    # Imported here so spawned decode workers (which re-import this module)
+    # never load TensorFlow
+    import main
+
+    if args.plant not in main.MODEL_PATHS:
+        sys.exit(f"Unsupported plant type: {args.plant}. Supported types: {list(main.MODEL_PATHS.keys())}")
+    if not main.load_model_and_labels(args.plant):
+        sys.exit(f"Could not load the {args.plant} model")
+
+    labels = main.class_labels[args.plant]
+    predict = main.make_batch_predict_fn(main.models[args.plant])
+
+    writer = ResultWriter(Path(args.output))
+    done = writer.completed_keys() if args.resume else set()
+    if done:
+        print(f"Resuming: {len(done)} images already scored")
+    elif not args.resume and writer.output.exists():
+        sys.exit(f"{writer.output} already exists; pass --resume to continue it")
+    writer.open()
+
+    batch_size = args.batch_size
+    # Two halves: the pool decodes the next batch while the model runs the current one
+    ring = SharedImageRing(2 * batch_size, main.IMG_SIZE)
+    pool = None
+    if args.workers > 0:
+        pool = ProcessPoolExecutor(max_workers=args.workers, mp_context=multiprocessing.get_context("spawn"))
+
+    def start_batch(half: int, entries: List[Tuple[str, bytes]]):
+        jobs = []
+        for i, (key, data) in enumerate(entries):
+            slot = half * batch_size + i
+            if pool is not None:
+                jobs.append(pool.submit(decode_into_ring, ring.name, ring.num_slots, ring.image_size, slot, data))
+            else:
+                jobs.append(slot)
+        return half, [key for key, _ in entries], [data for _, data in entries] if pool is None else None, jobs
+
+    def finish_batch(pending) -> List[dict]:
+        half, keys, raw, jobs = pending
+        errors = {}
+        for i, job in enumerate(jobs):
+            try:
+                if pool is not None:
+                    job.result()
+                else:
+                    ring.write_image(job, raw[i])
+            except Exception as e:
+                errors[i] = str(e)
+
+        rows = []
+        outputs = None
+        if len(errors) < len(keys):
+            outputs = predict(ring.batch_view(half * batch_size, len(keys)))
+            top_3 = main.top_k_indices(outputs, 3)
+        for i, key in enumerate(keys):
+            if i in errors:
+                rows.append(
+                    {"path": key, "plant_type": args.plant, "predicted_class": None,
+                     "confidence": None, "top_3_predictions": [], "error": errors[i]}
+                )
+                continue
+            probabilities = outputs[i]
+            top_3_idx = top_3[i]
+            rows.append(
+                {
+                    "path": key,
+                    "plant_type": args.plant,
+                    "predicted_class": labels[int(top_3_idx[0])],
+                    "confidence": float(probabilities[top_3_idx[0]]),
+                    "top_3_predictions": [
+                        {"class": labels[int(j)], "confidence": float(probabilities[j])} for j in top_3_idx
+                    ],
+                    "error": None,
+                }
+            )
+        return rows
+
+    source = (entry for entry in iter_images(Path(args.source)) if entry[0] not in done)
+    scored = 0
+    started = time.perf_counter()
+    pending = None
+    half = 0
+    try:
+        for entries in chunked(source, batch_size):
+            submitted = start_batch(half, entries)
+            if pending is not None:
+                rows = finish_batch(pending)
+                writer.write(rows)
+                scored += len(rows)
+            pending = submitted
+            half = 1 - half
+
+            elapsed = time.perf_counter() - started
+            if scored and elapsed > 0:
+                print(f"\r{scored} images, {scored / elapsed * 60:.0f} images/min", end="", flush=True)
+
+        if pending is not None:
+            rows = finish_batch(pending)
+            writer.write(rows)
+            scored += len(rows)
+    finally:
+        writer.close()
+        if pool is not None:
+            pool.shutdown(cancel_futures=True)
+        ring.close()
+
+    elapsed = time.perf_counter() - started
+    rate = scored / elapsed * 60 if elapsed > 0 else 0.0
+    print(f"\rScored {scored} images in {elapsed:.1f}s ({rate:.0f} images/min) -> {args.output}")
+
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Score a directory or archive of plant images")
+    parser.add_argument("source", help="Directory, .zip or .tar[.gz|.bz2|.xz] of images")
+    parser.add_argument("--plant", required=True, help="Crop model to use (tomato, cotton, mango, rice)")
+    parser.add_argument("--output", required=True, help="Output file: .csv, .ndjson/.jsonl or .parquet (directory)")
+    parser.add_argument("--batch-size", type=int, default=32, help="Images per forward pass")
+    parser.add_argument(
+        "--workers", type=int, default=os.cpu_count() or 1, help="Decode processes (0 decodes in-process)"
+    )
+    parser.add_argument("--resume", action="store_true", help="Skip images already scored in the output and retry failed ones")
+    args = parser.parse_args()
+
+    if args.batch_size < 1:
+        parser.error("--batch-size must be at least 1")
+    if args.output.lower().endswith(".parquet"):
+        try:
+            import pyarrow  # noqa: F401
+        except ImportError:
+            parser.error("Parquet output needs pyarrow: pip install pyarrow")
+    score(args)
+
+
+if __name__ == "__main__":
+    main_cli()
@@ -0,0 +1,348 @@
+"""
+Disk-backed embedding store with an IVF index for similarity search
+
+Stores one L2-normalised embedding per diagnosed image, quantised to int8
+(each component times 127, which is lossless enough for cosine similarity of
+unit vectors) or float16, in a memory-mapped file that grows by doubling.
+Record metadata (filename, predicted class, confidence, time) lives in a
+SQLite table next to it; a record only exists once its metadata row is
+committed, so a crash mid-insert leaves nothing half-written.
+
+Search is exact (a chunked scan) until `train_min` records exist. After
+that an inverted-file (IVF) index is trained: spherical k-means centroids
+split the records into about sqrt(N) lists, new records are appended to the
+list of their nearest centroid, and a query only scans the records of its
+`nprobe` nearest lists. The index is retrained whenever the store has grown
+fourfold since the last training. Training runs in a background thread while
+searches keep using the previous index (or the exact scan); the new index is
+swapped in once it is complete. Only the centroids and 8 bytes of list
+membership per record are held in memory; the vectors stay in the page cache.
+
+A store must only be opened by one process at a time.
+"""
+
+import array
+import json
+import logging
+import math
+import os
+import sqlite3
+import threading
+import time
+from typing import List, Optional
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+INT8_SCALE = 127.0
+SCAN_CHUNK = 65536
+KMEANS_ITERATIONS = 10
+KMEANS_SAMPLES_PER_LIST = 64
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS records (
+    id INTEGER PRIMARY KEY,
+    created_at REAL NOT NULL,
+    filename TEXT,
+    predicted_class TEXT,
+    confidence REAL
+);
+"""
+
+
+def normalize(vector: np.ndarray) -> np.ndarray:
+    vector = np.asarray(vector, dtype=np.float32).reshape(-1)
+    norm = float(np.linalg.norm(vector))
+    return vector / norm if norm > 0 else vector
+
+
+class EmbeddingStore:
+    """Append-only embedding store of one model version with approximate nearest-neighbour search"""
+
+    def __init__(
+        self,
+        directory: str,
+        dim: int,
+        dtype: str = "int8",
+        nprobe: int = 8,
+        train_min: int = 2048,
+        max_lists: int = 1024,
+    ):
+        """
+        Args:
+            directory: Where the vector, list and metadata files live
+            dim: Embedding size
+            dtype: "int8" or "float16" storage
+            nprobe: Lists scanned per query once the index is trained
+            train_min: Records needed before the IVF index is trained
+            max_lists: Upper bound on the number of IVF lists
+        """
+        if dtype not in ("int8", "float16"):
+            raise ValueError(f"Unsupported embedding dtype: {dtype}")
+        self.directory = directory
+        self.dim = dim
+        self.dtype = np.dtype(dtype)
+        self.nprobe = nprobe
+        self.train_min = train_min
+        self.max_lists = max_lists
+
+        os.makedirs(directory, exist_ok=True)
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(os.path.join(directory, "records.db"), check_same_thread=False)
+        self._db.row_factory = sqlite3.Row
+        self._db.execute("PRAGMA journal_mode=WAL")
+        self._db.executescript(SCHEMA)
+        self.count = self._db.execute("SELECT COALESCE(MAX(id) + 1, 0) FROM records").fetchone()[0]
+
+        self._vectors = self._open_memmap("vectors.bin", self.dtype, (dim,))
+        self._assignments = self._open_memmap("assignments.bin", np.dtype(np.int32), ())
+        self.centroids: Optional[np.ndarray] = None
+        self.trained_count = 0
+        self._lists: List[array.array] = []
+        self._trainer: Optional[threading.Thread] = None
+        self._closing = False
+        self._load_index()
+
+    def _open_memmap(self, name: str, dtype: np.dtype, row_shape: tuple, capacity: int = 0) -> np.memmap:
+        """Open (creating or growing) a memory-mapped array of at least `capacity` rows"""
+        path = os.path.join(self.directory, name)
+        row_bytes = dtype.itemsize * int(np.prod(row_shape, dtype=np.int64))
+        existing = os.path.getsize(path) // row_bytes if os.path.exists(path) else 0
+        rows = max(existing, capacity, self.count, 4096)
+        if rows > existing:
+            with open(path, "ab") as f:
+                f.truncate(rows * row_bytes)
+        return np.memmap(path, dtype=dtype, mode="r+", shape=(rows,) + row_shape)
+
+    def _ensure_capacity(self, rows: int):
+        if rows <= self._vectors.shape[0]:
+            return
+        capacity = self._vectors.shape[0]
+        while capacity < rows:
+            capacity *= 2
+        self._vectors.flush()
+        self._assignments.flush()
+        self._vectors = self._open_memmap("vectors.bin", self.dtype, (self.dim,), capacity)
+        self._assignments = self._open_memmap("assignments.bin", np.dtype(np.int32), (), capacity)
+
+    def _encode(self, vectors: np.ndarray) -> np.ndarray:
+        if self.dtype == np.int8:
+            return np.clip(np.rint(vectors * INT8_SCALE), -127, 127).astype(np.int8)
+        return vectors.astype(np.float16)
+
+    def _decode(self, stored: np.ndarray) -> np.ndarray:
+        decoded = stored.astype(np.float32)
+        if self.dtype == np.int8:
+            decoded /= INT8_SCALE
+        return decoded
+
+    def _load_index(self):
+        path = os.path.join(self.directory, "centroids.npy")
+        if not os.path.exists(path):
+            return
+        self.centroids = np.load(path)
+        try:
+            with open(os.path.join(self.directory, "index.json")) as f:
+                self.trained_count = int(json.load(f)["trained_count"])
+        except (FileNotFoundError, KeyError, ValueError):
+            self.trained_count = self.count  # index saved before the training size was recorded
+        self._lists = self._build_lists(np.asarray(self._assignments[: self.count]), len(self.centroids))
+
+    @staticmethod
+    def _build_lists(assignments: np.ndarray, num_lists: int) -> List[array.array]:
+        order = np.argsort(assignments, kind="stable")
+        bounds = np.searchsorted(assignments[order], np.arange(num_lists + 1))
+        return [
+            array.array("q", order[bounds[i]:bounds[i + 1]].astype(np.int64).tobytes())
+            for i in range(num_lists)
+        ]
+
+    def _start_training(self):
+        """Train a new index in the background over the records stored so far (call with the lock held)"""
+        self._trainer = threading.Thread(
+            target=self._train, args=(self._vectors, self.count), name=f"embedding-index-{self.directory}", daemon=True
+        )
+        self._trainer.start()
+
+    def _train(self, vectors: np.memmap, count: int):
+        """
+        (Re)train the IVF centroids on a sample of the first `count` records and assign them
+
+        Runs without the lock: stored vectors never change, so only the swap
+        at the end (which also assigns the records added meanwhile) holds it.
+        """
+        try:
+            self._train_and_swap(vectors, count)
+        except Exception as e:
+            logger.error(f"Training the embedding index in {self.directory} failed: {str(e)}")
+        finally:
+            with self._lock:
+                self._trainer = None
+
+    def _train_and_swap(self, vectors: np.memmap, count: int):
+        started = time.perf_counter()
+        num_lists = max(1, min(self.max_lists, int(math.sqrt(count))))
+        rng = np.random.default_rng(count)
+        sample_size = min(count, num_lists * KMEANS_SAMPLES_PER_LIST)
+        sample = self._decode(vectors[np.sort(rng.choice(count, sample_size, replace=False))])
+
+        # Spherical k-means: assign by cosine similarity, re-normalise the means
+        centroids = sample[rng.choice(sample_size, num_lists, replace=False)]
+        for _ in range(KMEANS_ITERATIONS):
+            labels = np.argmax(sample @ centroids.T, axis=1)
+            sums = np.zeros_like(centroids)
+            np.add.at(sums, labels, sample)
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            empty = norms[:, 0] == 0
+            centroids = np.where(empty[:, None], centroids, sums / np.maximum(norms, 1e-12))
+
+        centroids = centroids.astype(np.float32)
+        assignments = np.empty(count, dtype=np.int32)
+        for start in range(0, count, SCAN_CHUNK):
+            if self._closing:
+                return
+            chunk = self._decode(vectors[start:min(start + SCAN_CHUNK, count)])
+            assignments[start:start + len(chunk)] = np.argmax(chunk @ centroids.T, axis=1)
+        lists = self._build_lists(assignments, num_lists)
+
+        with self._lock:
+            if self._closing:
+                return
+            # Records added while training still belong to the new index
+            added = np.arange(count, self.count, dtype=np.int64)
+            if len(added):
+                added_assignments = np.argmax(self._decode(self._vectors[count:self.count]) @ centroids.T, axis=1)
+                for record_id, list_id in zip(added, added_assignments):
+                    lists[list_id].append(int(record_id))
+                self._assignments[count:self.count] = added_assignments
+            self._assignments[:count] = assignments
+            self._assignments.flush()
+
+            self.centroids = centroids
+            self._lists = lists
+            self.trained_count = count
+            np.save(os.path.join(self.directory, "centroids.npy"), centroids)
+            with open(os.path.join(self.directory, "index.json"), "w") as f:
+                json.dump({"trained_count": count, "lists": num_lists}, f)
+        logger.info(
+            f"Trained embedding index in {self.directory}: {num_lists} lists over {count} records "
+            f"({(time.perf_counter() - started) * 1000:.0f} ms, {len(added)} added meanwhile)"
+        )
+
+    def add(self, embedding: np.ndarray, filename: Optional[str], predicted_class: str, confidence: float) -> int:
+        """Store an embedding with its diagnosis and return the record id (blocking)"""
+        vector = normalize(embedding)
+        if vector.shape[0] != self.dim:
+            raise ValueError(f"Expected a {self.dim}-dimensional embedding, got {vector.shape[0]}")
+
+        with self._lock:
+            record_id = self.count
+            self._ensure_capacity(record_id + 1)
+            self._vectors[record_id] = self._encode(vector)
+            if self.centroids is not None:
+                list_id = int(np.argmax(self.centroids @ vector))
+                self._assignments[record_id] = list_id
+
+            self._db.execute(
+                "INSERT INTO records (id, created_at, filename, predicted_class, confidence) VALUES (?, ?, ?, ?, ?)",
+                (record_id, time.time(), filename, predicted_class, confidence),
+            )
+            self._db.commit()
+            self.count += 1
+            if self.centroids is not None:
+                self._lists[list_id].append(record_id)
+
+            if (
+                self._trainer is None
+                and self.count >= self.train_min
+                and self.count >= 4 * max(self.trained_count, self.train_min // 4)
+            ):
+                self._start_training()
+            return record_id
+
+    def search(self, embedding: np.ndarray, k: int = 5) -> List[dict]:
+        """
+        Find the stored records most similar to an embedding (blocking)
+
+        Returns:
+            Up to k records, most similar first, each with its cosine similarity
+        """
+        query = normalize(embedding)
+        # Only the snapshot of the index is taken under the lock; stored
+        # vectors never change, so the scan runs alongside inserts and
+        # other searches
+        with self._lock:
+            vectors, count = self._vectors, self.count
+            candidates = None
+            if self.centroids is not None:
+                probe = np.argsort(self.centroids @ query)[::-1][: self.nprobe]
+                # Copied, since the lists keep growing
+                candidates = np.concatenate(
+                    [np.frombuffer(self._lists[i], dtype=np.int64) for i in probe]
+                    or [np.empty(0, dtype=np.int64)]
+                )
+
+        if candidates is None:
+            scores = np.concatenate(
+                [
+                    self._decode(vectors[start:min(start + SCAN_CHUNK, count)]) @ query
+                    for start in range(0, count, SCAN_CHUNK)
+                ]
+                or [np.empty(0, dtype=np.float32)]
+            )
+        else:
+            candidates.sort()
+            scores = self._decode(vectors[candidates]) @ query if len(candidates) else np.empty(0)
+
+        if len(scores) == 0:
+            return []
+        k = min(k, len(scores))
+        top = np.argpartition(scores, -k)[-k:]
+        top = top[np.argsort(scores[top])[::-1]]
+        ids = top if candidates is None else candidates[top]
+
+        placeholders = ",".join("?" * len(ids))
+        with self._lock:
+            rows = {
+                row["id"]: row
+                for row in self._db.execute(f"SELECT * FROM records WHERE id IN ({placeholders})", [int(i) for i in ids])
+            }
+
+        return [
+            {
+                "record_id": int(record_id),
+                "similarity": round(min(1.0, float(score)), 4),
+                "filename": rows[int(record_id)]["filename"],
+                "predicted_class": rows[int(record_id)]["predicted_class"],
+                "confidence": rows[int(record_id)]["confidence"],
+                "created_at": rows[int(record_id)]["created_at"],
+            }
+            for record_id, score in zip(ids, scores[top])
+            if int(record_id) in rows
+        ]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "records": self.count,
+                "dim": self.dim,
+                "dtype": self.dtype.name,
+                "index": "ivf" if self.centroids is not None else "exact",
+                "lists": len(self.centroids) if self.centroids is not None else 0,
+                "trained_records": self.trained_count,
+                "training": self._trainer is not None,
+                "nprobe": self.nprobe,
+                "vector_file_mb": round(self._vectors.nbytes / (1024 * 1024), 1),
+            }
+
+    def close(self):
+        self._closing = True
+        trainer = self._trainer
+        if trainer is not None:
+            trainer.join()
+        with self._lock:
+            self._vectors.flush()
+            self._assignments.flush()
+            self._db.close()
@@ -0,0 +1,401 @@
+"""
+Persistent asynchronous job queue
+
+Slow work (TTA predictions, cure generation while LLM providers are slow) can
+be submitted as a job instead of holding an HTTP connection open. Submitting
+returns a job id straight away; a pool of worker tasks in the API process
+runs the job and clients poll for the result, optionally long-polling until
+it is ready.
+
+Jobs live in a SQLite database, so queued work survives a restart and every
+worker process of serve.py sees the same job states. Idle worker tasks claim
+the oldest queued job they can run straight from the database with an
+atomic conditional UPDATE, so a job submitted to one process is run by any
+process that can take it, even if the submitting one has gone away. A
+submission wakes the local workers at once; other processes pick it up on
+their next poll. A claimed job holds a lease that its worker renews while
+the job runs. If the process dies, or hangs so that the lease isn't renewed,
+any process may reclaim the job once the lease expires. The result of a
+claim that was taken over is discarded. Jobs are deduplicated by a hash of their kind, parameters
+and payload: resubmitting the same request returns the existing job instead
+of running it again (a failed job is retried).
+"""
+
+import asyncio
+import hashlib
+import json
+import logging
+import sqlite3
+import threading
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, Optional, Set
+
+import orjson
+
+
+logger = logging.getLogger(__name__)
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id TEXT PRIMARY KEY,
+    kind TEXT NOT NULL,
+    content_hash TEXT NOT NULL UNIQUE,
+    status TEXT NOT NULL,
+    params TEXT NOT NULL,
+    payload BLOB,
+    result TEXT,
+    error TEXT,
+    worker_id TEXT,
+    created_at REAL NOT NULL,
+    started_at REAL,
+    finished_at REAL,
+    lease_until REAL
+);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created_at);
+"""
+
+# Matches a job that is still held by the claim that started it at started_at;
+# a claim taken over after its lease expired no longer matches
+HOLDS_CLAIM = "id = ? AND status = ? AND worker_id = ? AND started_at = ?"
+
+# Jobs considered per query when looking for one this process can run
+CLAIM_PAGE_SIZE = 32
+
+JobHandler = Callable[[dict, Optional[bytes]], Awaitable[dict]]
+
+
+def job_content_hash(kind: str, params: dict, payload: Optional[bytes]) -> str:
+    """Hash identifying a job's work: equal hashes mean identical results"""
+    digest = hashlib.sha256()
+    digest.update(kind.encode())
+    digest.update(json.dumps(params, sort_keys=True).encode())
+    if payload is not None:
+        digest.update(payload)
+    return digest.hexdigest()
+
+
+class JobQueue:
+    """SQLite-backed job store with an in-process pool of async workers"""
+
+    def __init__(
+        self,
+        db_path: str,
+        worker_id: str = "0",
+        num_workers: int = 4,
+        retention_seconds: float = 24 * 3600,
+        accepts: Optional[Callable[[str, dict], bool]] = None,
+        poll_interval: float = 1.0,
+        lease_seconds: float = 60.0,
+    ):
+        """
+        Args:
+            db_path: SQLite database file
+            worker_id: This process's id, to recover only its own interrupted jobs
+            num_workers: Jobs run concurrently by this process
+            retention_seconds: How long finished jobs are kept
+            accepts: Whether this process can run a job, given its kind and params
+            poll_interval: Seconds between checks of the store for jobs queued elsewhere
+            lease_seconds: How long a running job stays claimed without its
+                worker renewing the lease (renewed every third of this)
+        """
+        self.db_path = db_path
+        self.worker_id = worker_id
+        self.num_workers = num_workers
+        self.retention_seconds = retention_seconds
+        self.accepts = accepts or (lambda kind, params: True)
+        self.poll_interval = poll_interval
+        self.lease_seconds = lease_seconds
+        self.handlers: Dict[str, JobHandler] = {}
+
+        self._db: Optional[sqlite3.Connection] = None
+        self._db_lock = threading.Lock()
+        self._wakeup: Optional[asyncio.Event] = None
+        # One event per waiting `get` call, removed when that call returns
+        self._finished: Dict[str, Set[asyncio.Event]] = {}
+        self._tasks = []
+
+    def register(self, kind: str, handler: JobHandler):
+        """Register the coroutine that runs jobs of a kind; it returns a JSON-able result"""
+        self.handlers[kind] = handler
+
+    def _execute(self, sql: str, params: tuple = ()) -> sqlite3.Cursor:
+        with self._db_lock:
+            cursor = self._db.execute(sql, params)
+            self._db.commit()
+            return cursor
+
+    def _query(self, sql: str, params: tuple = ()) -> list:
+        with self._db_lock:
+            return self._db.execute(sql, params).fetchall()
+
+    async def start(self):
+        """Open the store, requeue interrupted jobs and start the workers"""
+        self._db = sqlite3.connect(self.db_path, check_same_thread=False, timeout=30)
+        self._db.row_factory = sqlite3.Row
+        with self._db_lock:
+            self._db.execute("PRAGMA journal_mode=WAL")
+            self._db.executescript(SCHEMA)
+            columns = {row["name"] for row in self._db.execute("PRAGMA table_info(jobs)")}
+            if "lease_until" not in columns:
+                # Stores created before leases: running jobs without one can be reclaimed at once
+                self._db.execute("ALTER TABLE jobs ADD COLUMN lease_until REAL")
+                self._db.commit()
+
+        # Jobs this process was running when it stopped start over straight away;
+        # those of processes that never come back are reclaimed when their lease expires
+        requeued = self._execute(
+            "UPDATE jobs SET status = ?, started_at = NULL, lease_until = NULL WHERE status = ? AND worker_id = ?",
+            (QUEUED, RUNNING, self.worker_id),
+        )
+        if requeued.rowcount:
+            logger.info(f"Requeued {requeued.rowcount} interrupted jobs")
+        self._wakeup = asyncio.Event()
+
+        loop = asyncio.get_running_loop()
+        self._tasks = [loop.create_task(self._work()) for _ in range(self.num_workers)]
+        self._tasks.append(loop.create_task(self._expire_finished()))
+
+    async def close(self):
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+        if self._db is not None:
+            with self._db_lock:
+                self._db.close()
+            self._db = None
+
+    async def submit(self, kind: str, params: dict, payload: Optional[bytes] = None) -> dict:
+        """
+        Queue a job, or return the existing job for identical work
+
+        Returns:
+            The job (see describe) with a "deduplicated" flag
+        """
+        if kind not in self.handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+
+        content_hash = job_content_hash(kind, params, payload)
+        job_id = uuid.uuid4().hex
+        now = time.time()
+
+        def insert_or_reuse():
+            with self._db_lock:
+                existing = self._db.execute(
+                    "SELECT id, status FROM jobs WHERE content_hash = ?", (content_hash,)
+                ).fetchone()
+                if existing is None:
+                    try:
+                        self._db.execute(
+                            "INSERT INTO jobs (id, kind, content_hash, status, params, payload, created_at) "
+                            "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                            (job_id, kind, content_hash, QUEUED, json.dumps(params), payload, now),
+                        )
+                        self._db.commit()
+                        return job_id, False, True
+                    except sqlite3.IntegrityError:
+                        # Another worker process inserted the same job in the meantime
+                        self._db.rollback()
+                        existing = self._db.execute(
+                            "SELECT id, status FROM jobs WHERE content_hash = ?", (content_hash,)
+                        ).fetchone()
+                if existing["status"] == FAILED:
+                    # Retrying a failed job runs it again under the same id
+                    self._db.execute(
+                        "UPDATE jobs SET status = ?, payload = ?, error = NULL, started_at = NULL, "
+                        "finished_at = NULL, created_at = ? WHERE id = ?",
+                        (QUEUED, payload, now, existing["id"]),
+                    )
+                    self._db.commit()
+                    return existing["id"], True, True
+                return existing["id"], True, False
+
+        existing_id, deduplicated, enqueue = await asyncio.to_thread(insert_or_reuse)
+        if enqueue:
+            self._wakeup.set()
+        job = await self.get(existing_id)
+        job["deduplicated"] = deduplicated
+        return job
+
+    async def get(self, job_id: str, wait: float = 0.0) -> Optional[dict]:
+        """
+        Look up a job, waiting up to `wait` seconds for it to finish
+
+        Jobs may be run by another worker process, so besides the local
+        completion event the store is re-checked periodically while waiting.
+        """
+        deadline = time.monotonic() + wait
+        event = asyncio.Event()
+        try:
+            while True:
+                rows = await asyncio.to_thread(self._query, "SELECT * FROM jobs WHERE id = ?", (job_id,))
+                if not rows:
+                    return None
+                job = self.describe(rows[0])
+                if job["status"] in (DONE, FAILED):
+                    return job
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return job
+
+                self._finished.setdefault(job_id, set()).add(event)
+                try:
+                    await asyncio.wait_for(event.wait(), timeout=min(remaining, 0.5))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            waiters = self._finished.get(job_id)
+            if waiters is not None:
+                waiters.discard(event)
+                if not waiters:
+                    del self._finished[job_id]
+
+    @staticmethod
+    def describe(row: sqlite3.Row) -> dict:
+        return {
+            "job_id": row["id"],
+            "kind": row["kind"],
+            "status": row["status"],
+            "created_at": row["created_at"],
+            "started_at": row["started_at"],
+            "finished_at": row["finished_at"],
+            "result": orjson.loads(row["result"]) if row["result"] is not None else None,
+            "error": row["error"],
+        }
+
+    async def _work(self):
+        while True:
+            # Cleared before looking, so a submission during the claim is not missed
+            self._wakeup.clear()
+            try:
+                job = await asyncio.to_thread(self._claim_next)
+            except Exception as e:
+                logger.error(f"Claiming a job failed: {str(e)}")
+                job = None
+            if job is None:
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), timeout=self.poll_interval)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+            try:
+                await self._run(*job)
+            except Exception as e:
+                logger.error(f"Job {job[0]} could not be run: {str(e)}")
+
+    def _claim_next(self) -> Optional[tuple]:
+        """
+        Claim the oldest job this process can run (blocking)
+
+        Queued jobs and running jobs whose lease has expired can be claimed.
+        Only kinds with a handler here are read, a page at a time, so a poll
+        doesn't decode the whole queue. The UPDATE only succeeds while the
+        job is still claimable, so when several processes go for the same job
+        exactly one of them gets it.
+
+        Returns:
+            Tuple of (job id, kind, params, payload, started_at), or None if there is nothing to run
+        """
+        if not self.handlers:
+            return None
+        kinds = tuple(self.handlers)
+        claimable = (
+            f"kind IN ({','.join('?' * len(kinds))}) "
+            "AND (status = ? OR (status = ? AND (lease_until IS NULL OR lease_until < ?)))"
+        )
+        offset = 0
+        while True:
+            now = time.time()
+            candidates = self._query(
+                f"SELECT id, kind, params, status FROM jobs WHERE {claimable} ORDER BY created_at LIMIT ? OFFSET ?",
+                kinds + (QUEUED, RUNNING, now, CLAIM_PAGE_SIZE, offset),
+            )
+            for row in candidates:
+                params = json.loads(row["params"])
+                if not self.accepts(row["kind"], params):
+                    continue
+                claimed = self._execute(
+                    f"UPDATE jobs SET status = ?, worker_id = ?, started_at = ?, lease_until = ? "
+                    f"WHERE id = ? AND {claimable}",
+                    (RUNNING, self.worker_id, now, now + self.lease_seconds, row["id"]) + kinds + (QUEUED, RUNNING, now),
+                )
+                if claimed.rowcount == 0:
+                    continue  # taken by another worker in the meantime
+                if row["status"] == RUNNING:
+                    logger.warning(f"Reclaimed {row['kind']} job {row['id']} after its lease expired")
+                payload = self._query("SELECT payload FROM jobs WHERE id = ?", (row["id"],))[0]["payload"]
+                return row["id"], row["kind"], params, payload, now
+            if len(candidates) < CLAIM_PAGE_SIZE:
+                return None
+            offset += CLAIM_PAGE_SIZE
+
+    async def _renew_lease(self, job_id: str, started_at: float):
+        while True:
+            await asyncio.sleep(self.lease_seconds / 3)
+            await asyncio.to_thread(
+                self._execute,
+                f"UPDATE jobs SET lease_until = ? WHERE {HOLDS_CLAIM}",
+                (time.time() + self.lease_seconds, job_id, RUNNING, self.worker_id, started_at),
+            )
+
+    async def _run(self, job_id: str, kind: str, params: dict, payload: Optional[bytes], started_at: float):
+        renewal = asyncio.create_task(self._renew_lease(job_id, started_at))
+        try:
+            result = await self.handlers[kind](params, payload)
+            status, result_json, error = DONE, orjson.dumps(result, option=orjson.OPT_SERIALIZE_NUMPY).decode(), None
+        except Exception as e:
+            status, result_json, error = FAILED, None, str(getattr(e, "detail", e))
+            logger.warning(f"{kind} job {job_id} failed: {error}")
+        finally:
+            renewal.cancel()
+
+        # The payload is only needed to run the job; keep the hash for deduplication
+        finished = await asyncio.to_thread(
+            self._execute,
+            "UPDATE jobs SET status = ?, result = ?, error = ?, finished_at = ?, lease_until = NULL, payload = NULL "
+            f"WHERE {HOLDS_CLAIM}",
+            (status, result_json, error, time.time(), job_id, RUNNING, self.worker_id, started_at),
+        )
+        if finished.rowcount == 0:
+            logger.warning(f"{kind} job {job_id} was reclaimed after its lease expired, result discarded")
+            return
+        for event in self._finished.pop(job_id, ()):
+            event.set()
+
+    async def _expire_finished(self):
+        while True:
+            await asyncio.sleep(min(self.retention_seconds, 3600))
+            cutoff = time.time() - self.retention_seconds
+            cursor = await asyncio.to_thread(
+                self._execute,
+                "DELETE FROM jobs WHERE status IN (?, ?) AND finished_at < ?",
+                (DONE, FAILED, cutoff),
+            )
+            if cursor.rowcount:
+                logger.info(f"Removed {cursor.rowcount} expired jobs")
+            # Waiters normally remove their own events; drop any left for jobs that are gone
+            if self._finished:
+                placeholders = ",".join("?" * len(self._finished))
+                rows = await asyncio.to_thread(
+                    self._query, f"SELECT id FROM jobs WHERE id IN ({placeholders})", tuple(self._finished)
+                )
+                for job_id in set(self._finished) - {row["id"] for row in rows}:
+                    del self._finished[job_id]
+
+    def stats(self) -> dict:
+        """Job counts by status, plus running jobs whose lease has expired (blocking)"""
+        rows = self._query("SELECT status, COUNT(*) AS count FROM jobs GROUP BY status")
+        counts = {status: 0 for status in (QUEUED, RUNNING, DONE, FAILED)}
+        counts.update({row["status"]: row["count"] for row in rows})
+        expired = self._query(
+            "SELECT COUNT(*) AS count FROM jobs WHERE status = ? AND (lease_until IS NULL OR lease_until < ?)",
+            (RUNNING, time.time()),
+        )
+        counts["lease_expired"] = expired[0]["count"]
+        return counts
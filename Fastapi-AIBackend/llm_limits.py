@@ -0,0 +1,267 @@
+"""
+Client-side rate limiting for the LLM providers
+
+Groq and Together enforce requests-per-minute and tokens-per-minute limits
+and answer 429 once they are exceeded. `ProviderLimiter` keeps a token bucket
+for each limit, so a request waits for budget (up to its deadline) instead of
+being sent only to be rejected. A request reserves its prompt's estimated
+tokens plus `max_tokens`, and the unused part is refunded once the response
+reports its actual usage. The buckets are corrected from the providers'
+rate-limit response headers, and a 429 blocks the provider until its
+Retry-After time. A call that never reached the provider, or that the
+provider did not bill (network error, timeout, 5xx, 429), gets its whole
+reservation back.
+
+The buckets live in one process. With several serve.py workers each limiter
+gets an equal share of the provider's limits, so together the workers stay
+within the provider's budget.
+
+`PromptPacker` sends the prompts of concurrent requests as one call, for
+providers whose API accepts a list of inputs.
+"""
+
+import asyncio
+import logging
+import re
+import time
+from typing import Awaitable, Callable, List, Mapping, Optional
+
+
+logger = logging.getLogger(__name__)
+
+DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)?")
+DURATION_UNITS = {"ms": 0.001, "s": 1.0, "m": 60.0, "h": 3600.0, None: 1.0}
+
+
+def estimate_tokens(text: str) -> int:
+    """Rough token count of a prompt: about 3 UTF-8 bytes per token (Urdu script counts more)"""
+    return max(1, len(text.encode("utf-8")) // 3)
+
+
+def parse_duration(value: Optional[str]) -> Optional[float]:
+    """Seconds in a rate-limit header value such as "2", "1.5s", "250ms" or "1m30s" """
+    if not value:
+        return None
+    parts = DURATION_PART.findall(value.strip())
+    if not parts:
+        return None
+    return sum(float(number) * DURATION_UNITS[unit or None] for number, unit in parts)
+
+
+def header_number(headers: Mapping[str, str], *names: str) -> Optional[float]:
+    for name in names:
+        value = headers.get(name)
+        if value is not None:
+            try:
+                return float(value)
+            except ValueError:
+                continue
+    return None
+
+
+class TokenBucket:
+    """Continuously refilling budget of `limit` units per minute (a limit of 0 means unlimited)"""
+
+    def __init__(self, limit_per_minute: float):
+        self.limit = float(limit_per_minute)
+        self.level = self.limit
+        self.updated = time.monotonic()
+
+    def refill(self, now: float):
+        if self.limit > 0:
+            self.level = min(self.limit, self.level + (now - self.updated) * self.limit / 60.0)
+        self.updated = now
+
+    def wait_time(self, amount: float) -> float:
+        """Seconds until `amount` units are available (after refill)"""
+        if self.limit <= 0:
+            return 0.0
+        amount = min(amount, self.limit)  # larger requests would never fit
+        return max(0.0, (amount - self.level) * 60.0 / self.limit)
+
+    def take(self, amount: float):
+        if self.limit > 0:
+            self.level -= min(amount, self.limit)
+
+    def give_back(self, amount: float):
+        if self.limit > 0:
+            self.level = min(self.limit, self.level + amount)
+
+
+class ProviderLimiter:
+    """Requests-per-minute and tokens-per-minute budget of one LLM provider"""
+
+    def __init__(self, name: str, requests_per_minute: float = 0, tokens_per_minute: float = 0, share: float = 1.0):
+        """
+        Args:
+            name: Provider name, used in logs
+            requests_per_minute: Request limit (0 = unlimited)
+            tokens_per_minute: Token limit (0 = unlimited)
+            share: Fraction of the provider's limits this process may use,
+                1 / number of worker processes sharing the API keys
+        """
+        self.name = name
+        self.share = share
+        self.requests = TokenBucket(requests_per_minute * share)
+        self.tokens = TokenBucket(tokens_per_minute * share)
+        self.blocked_until = 0.0
+        self.waiting = 0
+        self.rejected = 0
+        self.rate_limited = 0
+        self._lock = asyncio.Lock()
+
+    async def acquire(self, tokens: int, deadline: float) -> bool:
+        """
+        Reserve one request and `tokens` tokens, waiting for budget until `deadline`
+
+        Waiters are served in arrival order. Returns False straight away when
+        the budget can't be available before the deadline, so the caller can
+        move on to another provider without waiting for nothing.
+        """
+        self.waiting += 1
+        try:
+            try:
+                await asyncio.wait_for(self._lock.acquire(), timeout=max(0.0, deadline - time.monotonic()))
+            except asyncio.TimeoutError:
+                self.rejected += 1
+                return False
+            try:
+                now = time.monotonic()
+                self.requests.refill(now)
+                self.tokens.refill(now)
+                wait = max(self.requests.wait_time(1), self.tokens.wait_time(tokens), self.blocked_until - now)
+                if now + wait > deadline:
+                    self.rejected += 1
+                    return False
+                if wait > 0:
+                    await asyncio.sleep(wait)
+                    now = time.monotonic()
+                    self.requests.refill(now)
+                    self.tokens.refill(now)
+                self.requests.take(1)
+                self.tokens.take(tokens)
+                return True
+            finally:
+                self._lock.release()
+        finally:
+            self.waiting -= 1
+
+    def settle(self, reserved_tokens: int, used_tokens: Optional[int], requests_used: float = 1.0):
+        """Refund the part of a reservation the request did not use"""
+        if used_tokens is not None and used_tokens < reserved_tokens:
+            self.tokens.give_back(reserved_tokens - used_tokens)
+        if requests_used < 1.0:
+            self.requests.give_back(1.0 - requests_used)
+
+    def refund(self, reserved_tokens: int, requests: float = 1.0):
+        """Return a whole reservation, for a call the provider did not bill"""
+        self.tokens.give_back(reserved_tokens)
+        self.requests.give_back(requests)
+
+    def update_from_headers(self, headers: Mapping[str, str]):
+        """
+        Correct the budget from a response's rate-limit headers
+
+        Understands the OpenAI-style headers Groq sends
+        (x-ratelimit-{limit,remaining,reset}-{requests,tokens}) and Together's
+        (x-ratelimit-* for requests, x-tokenlimit-* for tokens).
+        """
+        now = time.monotonic()
+        self.tokens.refill(now)
+
+        # The headers count the whole account, of which this process gets its share
+        token_limit = header_number(headers, "x-ratelimit-limit-tokens", "x-tokenlimit-limit")
+        if token_limit and token_limit > 0:
+            self.tokens.limit = token_limit * self.share
+        remaining_tokens = header_number(headers, "x-ratelimit-remaining-tokens", "x-tokenlimit-remaining")
+        if remaining_tokens is not None:
+            self.tokens.level = min(self.tokens.level, remaining_tokens * self.share)
+
+        # Groq's request headers count per day, so only an exhausted budget is acted on
+        remaining_requests = header_number(headers, "x-ratelimit-remaining-requests", "x-ratelimit-remaining")
+        if remaining_requests is not None and remaining_requests <= 0:
+            reset = parse_duration(headers.get("x-ratelimit-reset-requests") or headers.get("x-ratelimit-reset"))
+            if reset:
+                self.blocked_until = max(self.blocked_until, now + reset)
+
+    def on_rate_limited(self, headers: Mapping[str, str]):
+        """Stop sending until the provider's Retry-After (or token reset) time after a 429"""
+        self.rate_limited += 1
+        self.update_from_headers(headers)
+        retry_after = parse_duration(headers.get("retry-after")) or parse_duration(
+            headers.get("x-ratelimit-reset-tokens")
+        )
+        self.blocked_until = max(self.blocked_until, time.monotonic() + (retry_after or 1.0))
+        logger.warning("%s rate limited, pausing for %.1fs", self.name, self.blocked_until - time.monotonic())
+
+    def describe(self) -> dict:
+        now = time.monotonic()
+        self.requests.refill(now)
+        self.tokens.refill(now)
+        return {
+            "requests_per_minute": self.requests.limit or None,
+            "tokens_per_minute": self.tokens.limit or None,
+            "requests_available": round(self.requests.level, 1) if self.requests.limit else None,
+            "tokens_available": round(self.tokens.level) if self.tokens.limit else None,
+            "blocked_for_seconds": round(max(0.0, self.blocked_until - now), 1),
+            "waiting": self.waiting,
+            "rejected": self.rejected,
+            "rate_limited": self.rate_limited,
+        }
+
+
+class PromptPacker:
+    """
+    Packs the prompts of concurrent calls into one multi-prompt provider call
+
+    The first prompt opens a short window; every prompt that arrives within
+    it (up to `max_prompts`) is sent in the same call, and each caller gets
+    its own entry of the result.
+    """
+
+    def __init__(
+        self,
+        call_batch: Callable[[List[str]], Awaitable[List[dict]]],
+        window_seconds: float = 0.02,
+        max_prompts: int = 8,
+    ):
+        """
+        Args:
+            call_batch: Sends a list of prompts; returns one result dict per prompt
+            window_seconds: How long the first prompt waits for others
+            max_prompts: Largest number of prompts per call
+        """
+        self.call_batch = call_batch
+        self.window_seconds = window_seconds
+        self.max_prompts = max_prompts
+        self._pending: List[tuple] = []
+        self._flush: Optional[asyncio.TimerHandle] = None
+
+    async def submit(self, prompt: str) -> dict:
+        future = asyncio.get_running_loop().create_future()
+        self._pending.append((prompt, future))
+        if len(self._pending) >= self.max_prompts:
+            self._send()
+        elif self._flush is None:
+            self._flush = asyncio.get_running_loop().call_later(self.window_seconds, self._send)
+        return await future
+
+    def _send(self):
+        if self._flush is not None:
+            self._flush.cancel()
+            self._flush = None
+        batch, self._pending = self._pending, []
+        if batch:
+            task = asyncio.get_running_loop().create_task(self._run(batch))
+            task.add_done_callback(lambda t: t.exception())  # results are delivered through the futures
+
+    async def _run(self, batch: List[tuple]):
+        try:
+            results = await self.call_batch([prompt for prompt, _ in batch])
+        except Exception as e:
+            results = [{"success": False, "error": str(e)}] * len(batch)
+        if len(results) != len(batch):
+            results = [{"success": False, "error": f"Expected {len(batch)} results, got {len(results)}"}] * len(batch)
+        for (_, future), result in zip(batch, results):
+            if not future.done():
+                future.set_result({**result, "packed": len(batch)})
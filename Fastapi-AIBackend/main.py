@@ -1,5 +1,5 @@
-from fastapi import FastAPI, File, UploadFile, HTTPException, Path as FastAPIPath
-from fastapi.responses import JSONResponse
+from fastapi import FastAPI, File, UploadFile, HTTPException, Query, WebSocket, WebSocketDisconnect, Path as FastAPIPath
+from fastapi.responses import JSONResponse, ORJSONResponse, StreamingResponse
 from fastapi.middleware.cors import CORSMiddleware
 import tensorflow as tf
 from tensorflow import keras
@@ -9,13 +9,33 @@ import io
 import uvicorn
 from pathlib import Path
 import logging
-from typing import List, Dict, Any, Optional
+from typing import List, Dict, Any, Optional, Tuple, Callable
 import os
 import json
 from enum import Enum
 from pydantic import BaseModel
 import joblib
+import orjson
 from dotenv import load_dotenv
+import asyncio
+import multiprocessing
+import random
+import threading
+import time
+import tracemalloc
+from collections import OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from contextlib import ExitStack
+
+from batching import InferenceBatcher
+from embedding_store import EmbeddingStore
+from job_queue import DONE, FAILED, JobQueue
+from llm_limits import ProviderLimiter, PromptPacker, estimate_tokens
+from memory_profile import measure_memory, process_memory, to_mb, tracemalloc_top
+from model_registry import ACTIVE, CANARY, ModelRegistry, ModelVersion, content_version, file_fingerprint
+from request_logging import RequestLog, setup_logging
+from shm_ring import prepare_pixels
+from upload_limits import MAX_UPLOAD_BYTES, MULTIPART_OVERHEAD_BYTES, UploadSizeLimitMiddleware, upload_too_large_message
 
 
 
@@ -24,10 +44,71 @@ load_dotenv()  # Load environment variables from .env file
 
 
 
-# Configure logging
-logging.basicConfig(level=logging.INFO)
+# Configure logging: formatting and output happen on a background thread
+# (see request_logging.py); each request logs one summary record
+LOG_LEVEL = os.getenv("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.getenv("LOG_FORMAT", "text")  # "text" or "json"
+LOG_SAMPLE_RATE = float(os.getenv("LOG_SAMPLE_RATE", "1.0"))  # share of successful requests logged
+
+setup_logging(LOG_LEVEL, json_output=LOG_FORMAT == "json")
 logger = logging.getLogger(__name__)
 
+# Memory profiling: with tracemalloc on, /debug/memory also lists the largest
+# Python allocation sites, at the cost of slower allocation. Frames kept per
+# allocation, 0 = off
+MEMORY_TRACEMALLOC_FRAMES = int(os.getenv("MEMORY_TRACEMALLOC_FRAMES", "0"))
+if MEMORY_TRACEMALLOC_FRAMES > 0:
+    tracemalloc.start(MEMORY_TRACEMALLOC_FRAMES)
+
+
+# Worker runtime configuration (set per process by serve.py in multi-worker mode)
+WORKER_ID = os.getenv("WORKER_ID", "0")
+WORKER_COUNT = max(1, int(os.getenv("WORKER_COUNT", "1")))
+WORKER_PLANT_TYPES = [p.strip() for p in os.getenv("WORKER_PLANT_TYPES", "").split(",") if p.strip()]
+WORKER_CPUS = [int(c) for c in os.getenv("WORKER_CPUS", "").split(",") if c.strip()]
+TF_INTRA_OP_THREADS = int(os.getenv("TF_INTRA_OP_THREADS", "0"))
+TF_INTER_OP_THREADS = int(os.getenv("TF_INTER_OP_THREADS", "0"))
+
+
+def configure_worker_runtime():
+    """
+    Pin this process to its CPU set and size the TensorFlow thread pools
+
+    Must run before TensorFlow executes its first op, otherwise the thread
+    pool sizes can no longer be changed.
+    """
+    if WORKER_CPUS and hasattr(os, "sched_setaffinity"):
+        try:
+            os.sched_setaffinity(0, WORKER_CPUS)
+            logger.info(f"Worker {WORKER_ID} pinned to CPUs {WORKER_CPUS}")
+        except OSError as e:
+            logger.warning(f"Could not pin worker {WORKER_ID} to CPUs {WORKER_CPUS}: {str(e)}")
+
+    intra_op_threads = TF_INTRA_OP_THREADS
+    inter_op_threads = TF_INTER_OP_THREADS
+    if WORKER_CPUS:
+        # One intra-op thread per pinned core, so workers never compete for cores
+        intra_op_threads = intra_op_threads or len(WORKER_CPUS)
+        inter_op_threads = inter_op_threads or (1 if len(WORKER_CPUS) <= 2 else 2)
+
+    try:
+        if intra_op_threads:
+            tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        if inter_op_threads:
+            tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    except RuntimeError as e:
+        logger.warning(f"TensorFlow thread pools already initialized: {str(e)}")
+        return
+
+    if intra_op_threads or inter_op_threads:
+        logger.info(
+            f"Worker {WORKER_ID} TensorFlow threads: intra_op={intra_op_threads or 'default'}, "
+            f"inter_op={inter_op_threads or 'default'}"
+        )
+
+
+configure_worker_runtime()
+
 
 # Enum for plant types
 class PlantType(str, Enum):
@@ -56,12 +137,60 @@ app.add_middleware(
 
 
 # Global variables for models and class labels
-models = {"tomato": None, "cotton": None, "mango": None}
-class_labels = {"tomato": [], "cotton": [], "mango": []}
-model_metadata = {"tomato": {}, "cotton": {}, "mango": {}}
+models = {"tomato": None, "cotton": None, "mango": None, "rice": None}
+class_labels = {"tomato": [], "cotton": [], "mango": [], "rice": []}
+model_metadata = {"tomato": {}, "cotton": {}, "mango": {}, "rice": {}}
+# RSS growth when each model was loaded (see load_model_and_labels)
+model_memory = {"tomato": {}, "cotton": {}, "mango": {}, "rice": {}}
 
 IMG_SIZE = (224, 224)
 
+# Inference batching: uploads are decoded into a shared-memory image ring per
+# model and run in greedy micro-batches (see batching.py)
+INFERENCE_MAX_BATCH = int(os.getenv("INFERENCE_MAX_BATCH", "16"))
+INFERENCE_RING_SLOTS = int(os.getenv("INFERENCE_RING_SLOTS", "64"))
+DECODE_WORKERS = int(os.getenv("DECODE_WORKERS", "0"))  # 0 = decode in threads
+# Compute precision of the crop models: "float32", or "bfloat16" on CPUs with
+# native bfloat16 instructions (weights and outputs stay float32)
+INFERENCE_PRECISION = os.getenv("INFERENCE_PRECISION", "float32").lower()
+INPUT_ALIGNMENT = 64  # TensorFlow's CPU kernels need 64-byte aligned input tensors
+
+
+def cpu_supports_bfloat16() -> bool:
+    """Whether the CPU has native bfloat16 instructions (AVX512-BF16 or AMX-BF16; read from /proc/cpuinfo)"""
+    try:
+        with open("/proc/cpuinfo", "r") as f:
+            for line in f:
+                if line.startswith("flags"):
+                    return bool({"avx512_bf16", "amx_bf16"} & set(line.split(":", 1)[1].split()))
+    except OSError:
+        pass
+    return False
+
+
+if INFERENCE_PRECISION not in ("float32", "bfloat16"):
+    logger.warning(f"Unknown INFERENCE_PRECISION {INFERENCE_PRECISION}, using float32")
+    INFERENCE_PRECISION = "float32"
+elif INFERENCE_PRECISION == "bfloat16" and not cpu_supports_bfloat16():
+    # Emulated bfloat16 is slower than float32
+    logger.warning("INFERENCE_PRECISION=bfloat16 but this CPU has no native bfloat16 support, using float32")
+    INFERENCE_PRECISION = "float32"
+elif INFERENCE_PRECISION == "bfloat16":
+    logger.info("Crop models will compute in bfloat16")
+
+decode_pool: Optional[ProcessPoolExecutor] = None
+
+# Fire-and-forget tasks; the event loop only keeps weak references to tasks
+background_tasks = set()
+
+
+def spawn_background(coro) -> asyncio.Task:
+    """Run a coroutine in the background without letting it be garbage collected"""
+    task = asyncio.get_running_loop().create_task(coro)
+    background_tasks.add(task)
+    task.add_done_callback(background_tasks.discard)
+    return task
+
 # Model and labels file paths
 MODEL_PATHS = {
     "tomato": "models/tomato_disease_model.keras",  # Update this path to match your original
@@ -89,6 +218,147 @@ METADATA_PATHS = {
     "rice": "rice_model_metadata.json",
 }
 
+# Optional cheap crop classifier used by /predict/auto; its labels are plant types.
+# Without it, /predict/auto runs every loaded disease model on the same image.
+CROP_CLASSIFIER_MODEL_PATH = "models/crop_classifier_model.keras"
+CROP_CLASSIFIER_LABELS_PATH = "class_labels/crop_classifier_labels.txt"
+AUTO_CROP_MIN_CONFIDENCE = float(os.getenv("AUTO_CROP_MIN_CONFIDENCE", "0.6"))
+
+crop_classifier = {"model": None, "labels": []}
+crop_classifier_batcher: Optional[InferenceBatcher] = None
+
+# Optional small/fast models for a confidence-gated cascade. A small model
+# must share its crop's class label order; it may use a lower input resolution.
+# It is loaded and checked with each version of the full model (a canary has
+# its own), and when its labels file exists the label order must match. The
+# full model only runs when the small model's top-1 confidence is below
+# CASCADE_CONFIDENCE_THRESHOLD. A CASCADE_AUDIT_RATE fraction of confident exits
+# is re-checked by the full model in the background to estimate the accuracy cost.
+CASCADE_MODEL_PATHS = {
+    "tomato": "models/tomato_disease_model_small.keras",
+    "cotton": "models/cotton_disease_model_small.keras",
+    "mango": "models/mango_disease_model_small.keras",
+    "rice": "models/rice_disease_model_small.keras",
+}
+CASCADE_CANARY_MODEL_PATHS = {
+    "tomato": "models/tomato_disease_model_small_canary.keras",
+    "cotton": "models/cotton_disease_model_small_canary.keras",
+    "mango": "models/mango_disease_model_small_canary.keras",
+    "rice": "models/rice_disease_model_small_canary.keras",
+}
+CASCADE_LABELS_PATHS = {
+    "tomato": "class_labels/tomato_small_class_labels.txt",
+    "cotton": "class_labels/cotton_small_class_labels.txt",
+    "mango": "class_labels/mango_small_class_labels.txt",
+    "rice": "class_labels/rice_small_class_labels.txt",
+}
+CASCADE_CONFIDENCE_THRESHOLD = float(os.getenv("CASCADE_CONFIDENCE_THRESHOLD", "0.85"))
+CASCADE_AUDIT_RATE = float(os.getenv("CASCADE_AUDIT_RATE", "0.05"))
+
+cascade_stats = {}
+
+# Test-time augmentation: all views run as one batch and their probabilities
+# are averaged. Requested with ?tta=true, or triggered automatically when the
+# single-view top-1 confidence is below TTA_CONFIDENCE_THRESHOLD (0 = never).
+TTA_VIEWS = ["original", "horizontal_flip", "vertical_flip", "center_crop", "rotate_left", "rotate_right"]
+TTA_CROP_FRACTION = 0.85
+TTA_ROTATION_DEGREES = 10
+TTA_CONFIDENCE_THRESHOLD = float(os.getenv("TTA_CONFIDENCE_THRESHOLD", "0"))
+
+# Tiled inference for high-resolution photos, requested with ?tiled=true. At
+# each level of TILE_LEVELS the photo is resized so its shorter side spans that
+# many IMG_SIZE tiles, and cut into tiles overlapping by TILE_OVERLAP. The
+# answer averages the TILE_AGGREGATE_FRACTION most diseased tiles, so a lesion
+# in one corner is not averaged away by the healthy rest of the plant.
+TILE_LEVELS = sorted({int(n) for n in os.getenv("TILE_LEVELS", "2,4").split(",") if n.strip()})
+TILE_OVERLAP = float(os.getenv("TILE_OVERLAP", "0.25"))
+TILE_MAX_TILES = int(os.getenv("TILE_MAX_TILES", "64"))
+TILE_AGGREGATE_FRACTION = 0.1
+TILE_WORST_REGIONS = 3
+
+# Upload limits: enforced while the body is read and before anything is decoded,
+# so the memory a request can pin is bounded by MAX_UPLOAD_BYTES (see
+# upload_limits.py) plus one MAX_IMAGE_PIXELS decode
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(40_000_000)))
+UPLOAD_CHUNK_BYTES = 64 * 1024
+# The header is sniffed while the upload is read, but only within this prefix
+UPLOAD_SNIFF_BYTES = 256 * 1024
+ALLOWED_IMAGE_FORMATS = {"JPEG", "PNG", "BMP", "TIFF"}
+# Leading bytes of the allowed formats (JPEG, PNG, BMP, little/big-endian TIFF)
+IMAGE_MAGIC_NUMBERS = (b"\xff\xd8\xff", b"\x89PNG\r\n\x1a\n", b"BM", b"II*\x00", b"MM\x00*")
+
+# Live camera streaming over WebSocket
+WS_MAX_FRAME_BYTES = int(os.getenv("WS_MAX_FRAME_BYTES", str(2 * 1024 * 1024)))
+
+# Hot model reload: the model, class label and metadata files are polled and a
+# changed model is loaded, warmed and swapped in without dropping requests
+# (see model_registry.py). Every response carries the version that produced it.
+MODEL_RELOAD_INTERVAL = float(os.getenv("MODEL_RELOAD_INTERVAL", "5"))  # seconds, 0 = off
+MODEL_DRAIN_TIMEOUT = float(os.getenv("MODEL_DRAIN_TIMEOUT", "60"))
+
+# Optional canary models, sharing their crop's class labels and metadata.
+# CANARY_MODE "canary" serves CANARY_TRAFFIC_FRACTION of requests from the canary;
+# "shadow" keeps serving the active model and only compares the canary's answers.
+CANARY_MODEL_PATHS = {
+    "tomato": "models/tomato_disease_model_canary.keras",
+    "cotton": "models/cotton_disease_model_canary.keras",
+    "mango": "models/mango_disease_model_canary.keras",
+    "rice": "models/rice_disease_model_canary.keras",
+}
+CANARY_TRAFFIC_FRACTION = float(os.getenv("CANARY_TRAFFIC_FRACTION", "0"))
+CANARY_MODE = os.getenv("CANARY_MODE", CANARY).lower()  # validated by ModelRegistry
+
+# Asynchronous jobs (see job_queue.py): slow requests can be submitted under
+# /jobs/... and their results fetched later with GET /jobs/{job_id}
+JOB_DB_PATH = os.getenv("JOB_DB_PATH", "jobs.db")
+JOB_WORKERS = int(os.getenv("JOB_WORKERS", "4"))
+JOB_RETENTION_SECONDS = float(os.getenv("JOB_RETENTION_SECONDS", str(24 * 3600)))
+JOB_MAX_WAIT_SECONDS = float(os.getenv("JOB_MAX_WAIT_SECONDS", "30"))
+JOB_POLL_SECONDS = float(os.getenv("JOB_POLL_SECONDS", "1"))  # how soon jobs queued by other workers are seen
+JOB_LEASE_SECONDS = float(os.getenv("JOB_LEASE_SECONDS", "60"))  # a dead worker's job is rerun after this
+
+
+# Embeddings: each crop model also returns its penultimate-layer features,
+# which a prediction can return (?embedding=true) or store (?store=true) for
+# /similar searches. Stores are kept per model version, since features of
+# different versions are not comparable (see embedding_store.py)
+EMBEDDINGS_ENABLED = os.getenv("EMBEDDINGS_ENABLED", "true").lower() == "true"
+EMBEDDING_STORE_DIR = os.getenv("EMBEDDING_STORE_DIR", "embeddings")
+# A store is written by one process only: serve.py gives each crop's store to
+# one worker and routes its store and /similar requests there. Unset means
+# this process keeps the stores of all its crops
+WORKER_EMBEDDING_PLANT_TYPES = (
+    None
+    if os.getenv("WORKER_EMBEDDING_PLANT_TYPES") is None
+    else [p.strip() for p in os.getenv("WORKER_EMBEDDING_PLANT_TYPES").split(",") if p.strip()]
+)
+EMBEDDING_DTYPE = os.getenv("EMBEDDING_DTYPE", "int8")  # "int8" or "float16"
+EMBEDDING_NPROBE = int(os.getenv("EMBEDDING_NPROBE", "8"))
+EMBEDDING_TRAIN_MIN = int(os.getenv("EMBEDDING_TRAIN_MIN", "2048"))
+SIMILAR_MAX_RESULTS = 50
+
+embedding_stores: Dict[str, EmbeddingStore] = {}
+embedding_stores_lock = threading.Lock()
+
+
+def read_class_labels(labels_path: str) -> List[str]:
+    """Read one class label per line"""
+    with open(labels_path, "r") as f:
+        return [line.strip() for line in f.readlines()]
+
+
+def read_model_metadata(plant_type: str, num_classes: int) -> dict:
+    """Read a crop's model metadata, or describe the default model if there is none"""
+    metadata_path = METADATA_PATHS[plant_type]
+    if os.path.exists(metadata_path):
+        with open(metadata_path, "r") as f:
+            return json.load(f)
+    return {
+        "num_classes": num_classes,
+        "image_size": IMG_SIZE,
+        "model_type": "MobileNetV2_Transfer_Learning",
+    }
+
 
 def load_model_and_labels(plant_type: str):
     """Load the trained model and class labels for specific plant type"""
@@ -98,30 +368,22 @@ def load_model_and_labels(plant_type: str):
         # Load model
         model_path = MODEL_PATHS[plant_type]
         logger.info(f"Loading {plant_type} model from {model_path}")
-        models[plant_type] = keras.models.load_model(model_path)
-        logger.info(f"{plant_type.capitalize()} model loaded successfully")
+        with measure_memory() as memory:
+            models[plant_type] = keras.models.load_model(model_path)
+        model_memory[plant_type] = {"load_rss_mb": memory["rss_delta_mb"], "load_peak_mb": memory["peak_delta_mb"]}
+        logger.info(f"{plant_type.capitalize()} model loaded successfully (+{memory['rss_delta_mb']} MB RSS)")
 
         # Load class labels
         labels_path = CLASS_LABELS_PATHS[plant_type]
         logger.info(f"Loading {plant_type} class labels from {labels_path}")
-        with open(labels_path, "r") as f:
-            class_labels[plant_type] = [line.strip() for line in f.readlines()]
-        logger.info(
-            f"Loaded {len(class_labels[plant_type])} {plant_type} class labels: {class_labels[plant_type]}"
-        )
+        class_labels[plant_type] = read_class_labels(labels_path)
+        logger.info("Loaded %d %s class labels", len(class_labels[plant_type]), plant_type)
+        logger.debug("%s class labels: %s", plant_type, class_labels[plant_type])
 
         # Load metadata if available
-        metadata_path = METADATA_PATHS[plant_type]
-        if os.path.exists(metadata_path):
-            with open(metadata_path, "r") as f:
-                model_metadata[plant_type] = json.load(f)
+        model_metadata[plant_type] = read_model_metadata(plant_type, len(class_labels[plant_type]))
+        if os.path.exists(METADATA_PATHS[plant_type]):
             logger.info(f"Loaded {plant_type} model metadata")
-        else:
-            model_metadata[plant_type] = {
-                "num_classes": len(class_labels[plant_type]),
-                "image_size": IMG_SIZE,
-                "model_type": "MobileNetV2_Transfer_Learning",
-            }
 
         return True
     except Exception as e:
@@ -129,12 +391,87 @@ def load_model_and_labels(plant_type: str):
         return False
 
 
+def model_files(plant_type: str, role: str = ACTIVE) -> List[str]:
+    """
+    Files that make up one version of a crop model
+
+    The model, class labels, metadata, cascade model and cascade labels, in
+    that order; the last three are optional.
+    """
+    if role == CANARY:
+        model_path, cascade_path = CANARY_MODEL_PATHS[plant_type], CASCADE_CANARY_MODEL_PATHS[plant_type]
+    else:
+        model_path, cascade_path = MODEL_PATHS[plant_type], CASCADE_MODEL_PATHS[plant_type]
+    return [
+        model_path,
+        CLASS_LABELS_PATHS[plant_type],
+        METADATA_PATHS[plant_type],
+        cascade_path,
+        CASCADE_LABELS_PATHS[plant_type],
+    ]
+
+
+def load_model_version(plant_type: str, role: str = ACTIVE) -> ModelVersion:
+    """
+    Load a crop model with its labels and metadata as a new registry version
+
+    Unlike load_model_and_labels this does not touch the module-level dicts;
+    the registry publishes the version there once it is warmed up and swapped in.
+
+    Raises:
+        ValueError: If the model's output size does not match its class labels
+    """
+    paths = model_files(plant_type, role)
+    # Fingerprint first: a file replaced while we load is picked up by the next poll
+    fingerprint = file_fingerprint(paths)
+    version_id = content_version(paths)
+
+    logger.info(f"Loading {role} {plant_type} model {version_id} from {paths[0]}")
+    with measure_memory() as memory:
+        model = keras.models.load_model(paths[0])
+    labels = read_class_labels(paths[1])
+    num_classes = model.output_shape[-1]
+    if num_classes != len(labels):
+        raise ValueError(f"model has {num_classes} outputs but {len(labels)} class labels")
+
+    version = make_model_version(
+        plant_type, model, labels, read_model_metadata(plant_type, len(labels)), version_id, paths
+    )
+    version.cascade_model = load_cascade_model(plant_type, labels, paths[3], paths[4])
+    version.fingerprint = fingerprint
+    version.memory.update(load_rss_mb=memory["rss_delta_mb"], load_peak_mb=memory["peak_delta_mb"])
+    return version
+
+
+def make_model_version(
+    plant_type: str, model, labels: List[str], metadata: dict, version_id: str, paths: List[str]
+) -> ModelVersion:
+    """Wrap a loaded model as a registry version with its static response parts built once"""
+    if INFERENCE_PRECISION == "bfloat16":
+        model = build_bfloat16_model(model) or model
+    version = ModelVersion(plant_type, model, labels, metadata, version_id, paths)
+    version.model_info = {
+        "plant_type": plant_type,
+        "version": version_id,
+        "total_classes": len(labels),
+        "image_size": IMG_SIZE,
+        "metadata": metadata,
+    }
+    if EMBEDDINGS_ENABLED:
+        version.embedding_model = build_embedding_model(model)
+    return version
+
+
 def load_all_models():
-    """Load all available models"""
+    """Load all available models (or only this worker's share in multi-worker mode)"""
     success_count = 0
-    total_models = len(MODEL_PATHS)
+    plant_types = WORKER_PLANT_TYPES or list(MODEL_PATHS.keys())
+    total_models = len(plant_types)
 
-    for plant_type in MODEL_PATHS.keys():
+    for plant_type in plant_types:
+        if plant_type not in MODEL_PATHS:
+            logger.warning(f"⚠️  Unknown plant type {plant_type} assigned to worker {WORKER_ID}, skipping...")
+            continue
         if os.path.exists(MODEL_PATHS[plant_type]) and os.path.exists(
             CLASS_LABELS_PATHS[plant_type]
         ):
@@ -152,36 +489,579 @@ def load_all_models():
     return success_count > 0
 
 
-def preprocess_image(image: Image.Image) -> np.ndarray:
+def load_cascade_model(plant_type: str, labels: List[str], model_path: str, labels_path: str):
     """
-    Preprocess image for model prediction
+    Load the small cascade model that goes with one version of a crop model (blocking)
+
+    An early exit returns the small model's class index with the full
+    model's labels, so the small model must have as many outputs and, when
+    its labels file exists, the same label order.
+
+    Returns:
+        The small model, or None when there is none or it does not match
+    """
+    if not os.path.exists(model_path):
+        return None
+    try:
+        small_model = keras.models.load_model(model_path)
+    except Exception as e:
+        logger.error(f"Error loading {plant_type} cascade model: {str(e)}")
+        return None
+
+    num_classes = small_model.output_shape[-1]
+    if num_classes != len(labels):
+        logger.warning(
+            f"⚠️  {plant_type.capitalize()} cascade model has {num_classes} outputs but "
+            f"{len(labels)} labels, cascade disabled"
+        )
+        return None
+    if os.path.exists(labels_path) and read_class_labels(labels_path) != labels:
+        logger.warning(
+            f"⚠️  {plant_type.capitalize()} cascade model labels in {labels_path} are not in the full "
+            f"model's label order, cascade disabled"
+        )
+        return None
+    logger.info(f"✅ {plant_type.capitalize()} cascade model loaded from {model_path}")
+    return small_model
+
+
+def load_crop_classifier():
+    """Load the optional crop classifier used by /predict/auto"""
+    if not (os.path.exists(CROP_CLASSIFIER_MODEL_PATH) and os.path.exists(CROP_CLASSIFIER_LABELS_PATH)):
+        logger.info("Crop classifier not found, /predict/auto will run all loaded models")
+        return False
+
+    try:
+        crop_classifier["model"] = keras.models.load_model(CROP_CLASSIFIER_MODEL_PATH)
+        with open(CROP_CLASSIFIER_LABELS_PATH, "r") as f:
+            crop_classifier["labels"] = [line.strip() for line in f.readlines() if line.strip()]
+        logger.info(f"Crop classifier loaded with labels: {crop_classifier['labels']}")
+        return True
+    except Exception as e:
+        logger.error(f"Error loading crop classifier: {str(e)}")
+        crop_classifier["model"] = None
+        return False
+
+
+def decode_pixels(image_data: bytes, image_sizes=(IMG_SIZE,), reduced: bool = False) -> List[np.ndarray]:
+    """
+    Decode encoded image bytes once into resized uint8 arrays for the image rings
+
+    Args:
+        image_data: Encoded image bytes
+        image_sizes: (width, height) sizes to produce from the single decode
+        reduced: Let the JPEG decoder skip detail the largest size doesn't
+            need (faster, slightly different pixels than a full decode)
+
+    Returns:
+        One uint8 (height, width, 3) array per requested size
+    """
+    with Image.open(io.BytesIO(image_data)) as image:
+        if reduced:
+            image.draft("RGB", max(image_sizes, key=lambda size: size[0] * size[1]))
+        image = image.convert("RGB")
+        return [prepare_pixels(image, image_size) for image_size in image_sizes]
+
+
+def build_tta_batch(image: Image.Image, image_size=IMG_SIZE) -> np.ndarray:
+    """
+    Build every test-time augmentation view of an image as one uint8 batch
+
+    Flips are numpy views of the resized image and rotations work on the
+    resized image, so only the centre crop resamples the full-resolution pixels
+    a second time.
 
     Args:
-        image: PIL Image object
+        image: Decoded PIL image
+        image_size: Model input (width, height)
+
+    Returns:
+        uint8 array of shape (len(TTA_VIEWS), height, width, 3)
+    """
+    width, height = image_size
+    batch = np.empty((len(TTA_VIEWS), height, width, 3), dtype=np.uint8)
+
+    base = prepare_pixels(image, image_size)
+    base_image = Image.fromarray(base)
+
+    # Resample the centre crop straight from the source region, without a cropped copy
+    crop_width = image.width * TTA_CROP_FRACTION
+    crop_height = image.height * TTA_CROP_FRACTION
+    left = (image.width - crop_width) / 2
+    top = (image.height - crop_height) / 2
+    center_crop = image.resize(image_size, box=(left, top, left + crop_width, top + crop_height))
+
+    views = {
+        "original": base,
+        "horizontal_flip": base[:, ::-1],
+        "vertical_flip": base[::-1],
+        "center_crop": np.asarray(center_crop),
+        "rotate_left": np.asarray(base_image.rotate(TTA_ROTATION_DEGREES, resample=Image.BILINEAR)),
+        "rotate_right": np.asarray(base_image.rotate(-TTA_ROTATION_DEGREES, resample=Image.BILINEAR)),
+    }
+    for i, view_name in enumerate(TTA_VIEWS):
+        batch[i] = views[view_name]
+    return batch
+
+
+def decode_tta_batch(image_data: bytes, image_size=IMG_SIZE) -> np.ndarray:
+    """Decode encoded image bytes once and build the TTA batch from it"""
+    with Image.open(io.BytesIO(image_data)) as image:
+        return build_tta_batch(image.convert("RGB"), image_size)
+
+
+def tile_offsets(length: int, tile: int, stride: int) -> List[int]:
+    """Start offsets of tiles covering `length`, the last one flush with the end"""
+    if length <= tile:
+        return [0]
+    offsets = list(range(0, length - tile, stride))
+    offsets.append(length - tile)
+    return offsets
+
+
+def spread_offsets(length: int, tile: int, count: int) -> List[int]:
+    """`count` tile offsets spread evenly over `length`, the outer ones flush with the ends"""
+    if count <= 1 or length <= tile:
+        return [max(0, (length - tile) // 2)]
+    return [round(i * (length - tile) / (count - 1)) for i in range(count)]
+
+
+def fit_tile_grid(ys: List[int], xs: List[int], size: Tuple[int, int], max_tiles: int) -> Tuple[List[int], List[int]]:
+    """
+    Thin a tile grid to at most `max_tiles` tiles by widening its stride
+
+    Tiles are taken away from the axis with more of them first, so a long
+    panorama keeps its rows and loses columns. With a wider stride than the
+    tile size, the tiles no longer cover the whole photo.
+    """
+    rows, columns = len(ys), len(xs)
+    while rows * columns > max(1, max_tiles):
+        if columns >= rows:
+            columns -= 1
+        else:
+            rows -= 1
+    tile_width, tile_height = IMG_SIZE
+    if rows < len(ys):
+        ys = spread_offsets(size[1], tile_height, rows)
+    if columns < len(xs):
+        xs = spread_offsets(size[0], tile_width, columns)
+    return ys, xs
+
+
+def decode_tile_levels(image_data: bytes) -> Tuple[Tuple[int, int], List[dict]]:
+    """
+    Decode an image once into one resized uint8 array per tiling level
+
+    Only the tile positions are computed here; tiles are copied straight from
+    these arrays into the image ring (see run_tiled), so no per-tile or float
+    copies of a large photo are ever made. JPEGs are decoded at a reduced
+    scale when the largest level needs fewer pixels than the original.
+
+    TILE_MAX_TILES is a hard budget: finer levels that would exceed it are
+    skipped, and when even the coarsest level exceeds it (a long panorama)
+    its tiles are spread out with a wider stride (see fit_tile_grid).
 
     Returns:
-        Preprocessed image array
+        Tuple of (original (width, height), levels), where each level holds
+        its tile count across the shorter side, its pixels, the ratio of
+        original to level pixels, its (y, x) tile offsets and whether its
+        stride was widened to fit the budget
+    """
+    tile_width, tile_height = IMG_SIZE
+    stride_x = max(1, int(tile_width * (1 - TILE_OVERLAP)))
+    stride_y = max(1, int(tile_height * (1 - TILE_OVERLAP)))
+
+    with Image.open(io.BytesIO(image_data)) as image:
+        width, height = image.size
+        short_side = min(width, height)
+
+        # Never upscale: only levels the photo has enough pixels for, else a single
+        # level of about one tile across the shorter side
+        levels = [n for n in TILE_LEVELS if n * min(IMG_SIZE) <= short_side] or [1]
+
+        planned = []
+        total_tiles = 0
+        for n in levels:
+            factor = n * min(IMG_SIZE) / short_side
+            size = (max(tile_width, round(width * factor)), max(tile_height, round(height * factor)))
+            ys = tile_offsets(size[1], tile_height, stride_y)
+            xs = tile_offsets(size[0], tile_width, stride_x)
+            thinned = False
+            if total_tiles + len(ys) * len(xs) > TILE_MAX_TILES:
+                if planned:
+                    break  # finer levels would exceed the tile budget
+                ys, xs = fit_tile_grid(ys, xs, size, TILE_MAX_TILES)
+                thinned = True
+            tiles = [(y, x) for y in ys for x in xs]
+            planned.append((n, size, tiles, thinned))
+            total_tiles += len(tiles)
+
+        # Let the JPEG decoder skip detail the largest level doesn't need
+        image.draft("RGB", planned[-1][1])
+        image = image.convert("RGB")
+
+        result = []
+        for n, size, tiles, thinned in planned:
+            result.append(
+                {
+                    "level": n,
+                    "pixels": np.asarray(image.resize(size), dtype=np.uint8),
+                    "scale": width / size[0],
+                    "tiles": tiles,
+                    "stride_widened": thinned,
+                }
+            )
+        return (width, height), result
+
+
+def aggregate_tile_probabilities(tile_probabilities: np.ndarray, disease_scores: np.ndarray) -> np.ndarray:
+    """
+    Combine per-tile model outputs into one distribution for the whole photo
+
+    Averages the most diseased TILE_AGGREGATE_FRACTION of tiles: a healthy
+    plant still looks healthy in its "worst" tiles, while a small lesion
+    decides the answer instead of being diluted by every healthy tile.
+    """
+    count = max(1, int(round(len(tile_probabilities) * TILE_AGGREGATE_FRACTION)))
+    worst = top_k_indices(disease_scores, count)
+    return tile_probabilities[worst].mean(axis=0)
+
+
+def build_embedding_model(model):
+    """
+    The same model with its penultimate-layer features as a second output
+
+    Returns None (embeddings unavailable) when the final layer's input is not
+    a flat feature vector or the model's graph can't be rewired.
     """
     try:
-        # Convert to RGB if necessary
-        if image.mode != "RGB":
-            image = image.convert("RGB")
+        features = model.layers[-1].input
+        if len(features.shape) != 2:
+            logger.warning(f"{model.name}: penultimate output has shape {features.shape}, embeddings disabled")
+            return None
+        return keras.Model(model.inputs, [model.outputs[0], features])
+    except Exception as e:
+        logger.warning(f"{model.name}: cannot expose penultimate features, embeddings disabled: {str(e)}")
+        return None
+
 
-        # Resize image
-        image = image.resize(IMG_SIZE)
+def set_layer_dtypes(layer_configs: List[dict], dtype: str):
+    """Set the dtype policy of every layer in a model config, nested models included"""
+    for layer in layer_configs:
+        if layer.get("class_name") == "InputLayer":
+            continue
+        config = layer.get("config", {})
+        if "layers" in config:
+            set_layer_dtypes(config["layers"], dtype)
+        if "dtype" in config:
+            config["dtype"] = dtype
 
-        # Convert to numpy array and normalize
-        img_array = np.array(image, dtype=np.float32) / 255.0
 
-        # Add batch dimension
-        img_array = np.expand_dims(img_array, axis=0)
+def build_bfloat16_model(model):
+    """
+    Copy of a model that computes in bfloat16 with its weights kept in float32
 
-        return img_array
+    The final layer stays float32, so the class probabilities keep their
+    precision. Returns None when the model can't be rebuilt from its config
+    (e.g. a subclassed model).
+    """
+    try:
+        config = model.get_config()
+        set_layer_dtypes(config["layers"], "mixed_bfloat16")
+        config["layers"][-1]["config"]["dtype"] = "float32"
+        mixed = model.__class__.from_config(config)
+        mixed.set_weights(model.get_weights())
+        return mixed
     except Exception as e:
-        logger.error(f"Error preprocessing image: {str(e)}")
+        logger.warning(f"{model.name}: cannot switch to bfloat16, keeping float32: {str(e)}")
+        return None
+
+
+def aligned_empty(shape: Tuple[int, ...], dtype=np.float32) -> np.ndarray:
+    """Uninitialised array whose data starts on an INPUT_ALIGNMENT-byte boundary"""
+    dtype = np.dtype(dtype)
+    nbytes = int(np.prod(shape)) * dtype.itemsize
+    raw = np.empty(nbytes + INPUT_ALIGNMENT, dtype=np.uint8)
+    offset = -raw.ctypes.data % INPUT_ALIGNMENT
+    return raw[offset:offset + nbytes].view(dtype).reshape(shape)
+
+
+def make_batch_predict_fn(model, embedding_model=None, max_batch_size: int = INFERENCE_MAX_BATCH):
+    """
+    Wrap a Keras model so it accepts uint8 batch views from the image ring
+
+    Batches are scaled to [0, 1] into a float32 buffer that is allocated once
+    for `max_batch_size` images (and grown if a larger batch comes along).
+    The buffer is handed to TensorFlow through DLPack, so the input tensor
+    shares its memory instead of copying it, and running a batch allocates
+    no input arrays. Because of that buffer the wrapper must not be called
+    from two threads at once; a batcher runs one batch at a time.
+
+    With an embedding model (see build_embedding_model) the wrapper returns
+    (outputs, features), computed in the same forward pass.
+    """
+    buffer = None
+
+    def predict_batch(batch: np.ndarray) -> np.ndarray:
+        nonlocal buffer
+        count = len(batch)
+        if buffer is None or count > len(buffer) or buffer.shape[1:] != batch.shape[1:]:
+            buffer = aligned_empty((max(count, max_batch_size),) + batch.shape[1:])
+        np.divide(batch, 255.0, out=buffer[:count], dtype=np.float32)
+        # The tensor aliases the buffer; predict_on_batch returns before it is reused
+        inputs = tf.experimental.dlpack.from_dlpack(buffer[:count].__dlpack__())
+
+        if embedding_model is not None:
+            outputs, features = embedding_model.predict_on_batch(inputs)
+            return np.asarray(outputs, dtype=np.float32), np.asarray(features, dtype=np.float32)
+        return model.predict_on_batch(inputs)
+
+    return predict_batch
+
+
+def start_version_batcher(version: ModelVersion):
+    """Give a model version its own image ring and batcher"""
+    version.batcher = InferenceBatcher(
+        f"{version.plant_type}@{version.version}",
+        make_batch_predict_fn(version.model, version.embedding_model),
+        IMG_SIZE,
+        max_batch_size=INFERENCE_MAX_BATCH,
+        num_slots=INFERENCE_RING_SLOTS,
+        decode_pool=decode_pool,
+    )
+    version.batcher.start()
+
+    if version.cascade_model is not None:
+        small_height, small_width = version.cascade_model.input_shape[1:3]
+        version.cascade_batcher = InferenceBatcher(
+            f"{version.plant_type}_small@{version.version}",
+            make_batch_predict_fn(version.cascade_model),
+            (small_width, small_height),
+            max_batch_size=INFERENCE_MAX_BATCH,
+            num_slots=INFERENCE_RING_SLOTS,
+        )
+        version.cascade_batcher.start()
+        cascade_stats.setdefault(
+            version.plant_type,
+            {
+                "requests": 0,
+                "exits": 0,
+                "small_time_ms": 0.0,
+                "escalations": 0,
+                "escalated_time_ms": 0.0,
+                "escalated_agreements": 0,
+                "audits": 0,
+                "audit_agreements": 0,
+            },
+        )
+
+
+def warm_model_version(version: ModelVersion):
+    """
+    Run the batch sizes a new version will see before it takes traffic
+
+    Records how far RSS peaked above its starting point for each batch size.
+    Memory the allocator still holds from earlier models or smaller batches
+    is reused rather than counted again, so the figures add up to the
+    worker's footprint instead of each standing alone.
+    """
+    predict = make_batch_predict_fn(version.model, version.embedding_model)
+    width, height = IMG_SIZE
+    batch_peaks = {}
+    for batch_size in sorted({1, INFERENCE_MAX_BATCH}):
+        with measure_memory() as memory:
+            predict(np.zeros((batch_size, height, width, 3), dtype=np.uint8))
+        batch_peaks[batch_size] = memory["peak_delta_mb"]
+    version.memory["batch_peak_mb"] = batch_peaks
+
+    if version.cascade_model is not None:
+        small_height, small_width = version.cascade_model.input_shape[1:3]
+        version.cascade_model.predict_on_batch(np.zeros((1, small_height, small_width, 3), dtype=np.float32))
+
+
+def publish_model_version(version: ModelVersion):
+    """Keep the module-level model dicts pointing at the active version"""
+    models[version.plant_type] = version.model
+    class_labels[version.plant_type] = version.labels
+    model_metadata[version.plant_type] = version.metadata
+
+
+def close_embedding_store(version: ModelVersion):
+    """Close a drained version's embedding store, unless a current version uses the same files (blocking)"""
+    current = (model_registry.active.get(version.plant_type), model_registry.canary.get(version.plant_type))
+    if any(other is not None and other.version == version.version for other in current):
+        return
+    with embedding_stores_lock:
+        store = embedding_stores.pop(f"{version.plant_type}/{version.version}", None)
+    if store is not None:
+        store.close()
+        logger.info(f"Closed embedding store of {version.plant_type} model {version.version}")
+
+
+model_registry = ModelRegistry(
+    load_model_version,
+    warm_model_version,
+    start_version_batcher,
+    publish_model_version,
+    poll_interval=MODEL_RELOAD_INTERVAL,
+    drain_timeout=MODEL_DRAIN_TIMEOUT,
+    canary_fraction=CANARY_TRAFFIC_FRACTION,
+    canary_mode=CANARY_MODE,
+    on_retire=close_embedding_store,
+)
+
+
+def job_runs_here(kind: str, params: dict) -> bool:
+    """
+    Prediction jobs can only run on a worker that has the crop's model loaded,
+    and those that store embeddings only on the worker that keeps the store
+    """
+    if kind != "predict":
+        return True
+    plant_type = params["plant_type"]
+    if models.get(plant_type) is None:
+        return False
+    return not params.get("store") or keeps_embedding_store(plant_type)
+
+
+job_queue = JobQueue(
+    JOB_DB_PATH,
+    worker_id=WORKER_ID,
+    num_workers=JOB_WORKERS,
+    retention_seconds=JOB_RETENTION_SECONDS,
+    poll_interval=JOB_POLL_SECONDS,
+    lease_seconds=JOB_LEASE_SECONDS,
+    accepts=job_runs_here,
+)
+
+
+async def start_inference_batchers():
+    """Create the decode pool (if enabled) and one batcher per loaded model"""
+    global decode_pool, crop_classifier_batcher
+
+    if DECODE_WORKERS > 0 and decode_pool is None:
+        # spawn, not fork: forking a process that already runs TensorFlow threads is unsafe
+        decode_pool = ProcessPoolExecutor(
+            max_workers=DECODE_WORKERS, mp_context=multiprocessing.get_context("spawn")
+        )
+        logger.info(f"Started {DECODE_WORKERS} image decode workers")
+
+    for plant_type, model in models.items():
+        if model is None or plant_type in model_registry.active:
+            continue
+        paths = model_files(plant_type)
+        version = make_model_version(
+            plant_type, model, class_labels[plant_type], model_metadata[plant_type], content_version(paths), paths
+        )
+        version.memory.update(model_memory[plant_type])
+        version.cascade_model = await asyncio.to_thread(
+            load_cascade_model, plant_type, version.labels, paths[3], paths[4]
+        )
+        await asyncio.to_thread(warm_model_version, version)
+        model_registry.install(version)
+        model_registry.watch(plant_type, ACTIVE, lambda p=plant_type: model_files(p))
+        model_registry.watch(plant_type, CANARY, lambda p=plant_type: model_files(p, CANARY))
+        if os.path.exists(CANARY_MODEL_PATHS[plant_type]):
+            await model_registry.reload(plant_type, CANARY)
+    model_registry.start_watching()
+
+    if crop_classifier["model"] is not None and crop_classifier_batcher is None:
+        crop_classifier_batcher = InferenceBatcher(
+            "crop_classifier",
+            make_batch_predict_fn(crop_classifier["model"]),
+            IMG_SIZE,
+            max_batch_size=INFERENCE_MAX_BATCH,
+            num_slots=INFERENCE_RING_SLOTS,
+        )
+        crop_classifier_batcher.start()
+
+
+app.add_middleware(UploadSizeLimitMiddleware, max_body_bytes=MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES)
+
+
+def image_too_large_message() -> str:
+    return f"Image dimensions too large. Maximum {MAX_IMAGE_PIXELS // 1_000_000} megapixels allowed."
+
+
+def sniff_image_header(data: bytes) -> Optional[tuple]:
+    """
+    Read and check an encoded image's format and dimensions without decoding its pixels
+
+    Args:
+        data: The image bytes received so far (may be incomplete)
+
+    Returns:
+        Tuple of (format, width, height), or None if the header is not
+        complete yet or the data is not a supported image
+
+    Raises:
+        HTTPException: If the image is too large (413) or not an allowed format (400)
+    """
+    try:
+        with Image.open(io.BytesIO(data)) as image:
+            header = image.format, image.width, image.height
+    except Image.DecompressionBombError:
+        # Beyond Pillow's own pixel limit: oversized rather than invalid
+        raise HTTPException(status_code=413, detail=image_too_large_message())
+    except Exception:
+        return None
+
+    image_format, width, height = header
+    if width * height > MAX_IMAGE_PIXELS:
+        raise HTTPException(status_code=413, detail=image_too_large_message())
+    if image_format not in ALLOWED_IMAGE_FORMATS:
         raise HTTPException(
-            status_code=400, detail=f"Error preprocessing image: {str(e)}"
+            status_code=400,
+            detail=f"Unsupported image format. Allowed formats: {', '.join(sorted(ALLOWED_IMAGE_FORMATS))}",
         )
+    return header
+
+
+async def read_upload(file: UploadFile) -> bytes:
+    """
+    Read an uploaded image in chunks, enforcing the byte cap and header checks
+
+    The header is sniffed as soon as enough bytes have arrived, so an
+    oversized or non-image upload is rejected without reading the rest of it
+    or decoding anything. Sniffing stops after UPLOAD_SNIFF_BYTES: data that
+    doesn't start like an allowed format is rejected there, and a header
+    that is still incomplete (e.g. a TIFF with its directory at the end) is
+    checked once the whole upload has arrived.
+
+    Args:
+        file: Uploaded file object
+
+    Returns:
+        The encoded image bytes
+    """
+    chunks = []
+    size = 0
+    header = None
+    sniffing = True
+    while True:
+        chunk = await file.read(UPLOAD_CHUNK_BYTES)
+        if not chunk:
+            break
+        size += len(chunk)
+        if size > MAX_UPLOAD_BYTES:
+            raise HTTPException(status_code=413, detail=upload_too_large_message())
+        chunks.append(chunk)
+        if sniffing:
+            # Usually complete after the first chunk
+            header = sniff_image_header(b"".join(chunks))
+            if header is not None:
+                sniffing = False
+            elif size >= UPLOAD_SNIFF_BYTES:
+                if not chunks[0].startswith(IMAGE_MAGIC_NUMBERS):
+                    raise HTTPException(status_code=400, detail="Invalid or unsupported image file")
+                sniffing = False
+
+    image_data = b"".join(chunks)
+    if header is None and not sniffing:
+        header = sniff_image_header(image_data)
+    if header is None:
+        raise HTTPException(status_code=400, detail="Invalid or unsupported image file")
+    return image_data
 
 
 def validate_image(file: UploadFile) -> bool:
@@ -194,11 +1074,9 @@ def validate_image(file: UploadFile) -> bool:
     Returns:
         True if valid, raises HTTPException if invalid
     """
-    # Check file size (max 10MB)
-    if hasattr(file, "size") and file.size > 10 * 1024 * 1024:
-        raise HTTPException(
-            status_code=400, detail="File size too large. Maximum 10MB allowed."
-        )
+    # Check file size when the client declared it; read_upload enforces it either way
+    if getattr(file, "size", None) is not None and file.size > MAX_UPLOAD_BYTES:
+        raise HTTPException(status_code=413, detail=upload_too_large_message())
 
     # Check content type
     allowed_types = ["image/jpeg", "image/jpg", "image/png", "image/bmp", "image/tiff"]
@@ -235,328 +1113,965 @@ async def startup_event():
         logger.error("Failed to load any models. Please check file paths.")
         raise RuntimeError("Model initialization failed - no models could be loaded")
 
+    load_crop_classifier()
+    await start_inference_batchers()
+    await job_queue.start()
+
+    logger.info("Memory after startup", extra={"fields": memory_report()})
     logger.info("Application startup completed successfully")
 
 
-@app.post("/predict-tomato")
-async def predict_tomato_disease(file: UploadFile = File(...)):
+@app.on_event("shutdown")
+async def shutdown_event():
+    """Stop the batchers and release shared memory"""
+    global decode_pool, crop_classifier_batcher
+
+    await job_queue.close()
+    await model_registry.close()
+
+    with embedding_stores_lock:
+        for store in embedding_stores.values():
+            store.close()
+        embedding_stores.clear()
+
+    if crop_classifier_batcher is not None:
+        await crop_classifier_batcher.close()
+        crop_classifier_batcher = None
+
+    if decode_pool is not None:
+        decode_pool.shutdown(wait=False, cancel_futures=True)
+        decode_pool = None
+
+
+@app.get("/health")
+async def health_check():
+    """Report which plant models this worker serves"""
+    return {
+        "status": "healthy",
+        "worker_id": WORKER_ID,
+        "loaded_models": [plant_type for plant_type, model in models.items() if model is not None],
+        "cpus": sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else None,
+    }
+
+
+def memory_report(top: int = 0) -> dict:
     """
-    Predict tomato disease from uploaded image
+    Memory used by this worker, broken down by model and image ring (MB)
 
     Args:
-        file: Image file (JPEG, PNG, BMP, TIFF)
+        top: Number of tracemalloc allocation sites to include (0 = none)
+    """
+    width, height = IMG_SIZE
+    crops = {}
+    for role, versions in model_registry.versions.items():
+        for plant_type, version in versions.items():
+            crops.setdefault(plant_type, {})[role] = {
+                "version": version.version,
+                **version.memory,
+                "ring_mb": to_mb(version.batcher.ring.array.nbytes) if version.batcher is not None else None,
+                "cascade_ring_mb": (
+                    to_mb(version.cascade_batcher.ring.array.nbytes) if version.cascade_batcher is not None else None
+                ),
+                "input_buffer_mb": to_mb(INFERENCE_MAX_BATCH * width * height * 3 * 4),
+                "in_flight": version.in_flight,
+            }
+
+    other_batchers = {}
+    if crop_classifier_batcher is not None:
+        other_batchers["crop_classifier"] = crop_classifier_batcher
+
+    report = {
+        "worker_id": WORKER_ID,
+        "inference_precision": INFERENCE_PRECISION,
+        "process": process_memory(),
+        "models": crops,
+        "other_rings_mb": {name: to_mb(batcher.ring.array.nbytes) for name, batcher in other_batchers.items()},
+        # Upper bound held per in-flight image: the upload and its ring slot (the
+        # float32 model input is the batcher's preallocated input buffer)
+        "per_request_mb": {
+            "upload_max": to_mb(MAX_UPLOAD_BYTES),
+            "ring_slot": to_mb(width * height * 3),
+        },
+    }
+    if top > 0:
+        report["tracemalloc_top"] = tracemalloc_top(top)
+        if report["tracemalloc_top"] is None:
+            report["tracemalloc_hint"] = "Set MEMORY_TRACEMALLOC_FRAMES (e.g. 1) to list Python allocation sites"
+    return report
+
+
+@app.get("/debug/memory")
+async def debug_memory(top: int = Query(10, ge=0, le=100, description="tracemalloc allocation sites to list")):
+    """Report this worker's memory use per model, image ring and Python allocation site"""
+    return ORJSONResponse(memory_report(top))
+
+
+def top_k_indices(probabilities: np.ndarray, k: int = 3) -> np.ndarray:
+    """
+    Indices of the k most likely classes, most likely first
+
+    Works on a single output row or a whole (batch, classes) output; only the
+    k selected entries are sorted, not the full probability vector.
+    """
+    k = min(k, probabilities.shape[-1])
+    top_k = np.argpartition(probabilities, -k, axis=-1)[..., -k:]
+    order = np.argsort(np.take_along_axis(probabilities, top_k, axis=-1), axis=-1)[..., ::-1]
+    return np.take_along_axis(top_k, order, axis=-1)
+
+
+def build_prediction_response(
+    version: ModelVersion, filename: str, probabilities: np.ndarray, compact: bool = False
+) -> dict:
+    """
+    Build the JSON body returned by the /predict-<crop> endpoints
+
+    Args:
+        version: Model version that produced the probabilities
+        filename: Original upload filename
+        probabilities: Model output row for one image
+        compact: Leave out model_info; clients look it up by model_version (GET /models)
 
     Returns:
-        JSON response with prediction results
+        Response dictionary
     """
-    plant_type = "tomato"
-    validate_plant_type(plant_type)
-    validate_image(file)
+    labels = version.labels
+    top_3_idx = top_k_indices(probabilities, 3).tolist()
+    top_3_confidences = probabilities[top_3_idx].tolist()
+    confidence = top_3_confidences[0]
+
+    response = {
+        "success": True,
+        "plant_type": version.plant_type,
+        "filename": filename,
+        "model_version": version.version,
+        "prediction": {
+            "predicted_class": labels[top_3_idx[0]],
+            "confidence": confidence,
+            "percentage": round(confidence * 100, 2),
+        },
+        "top_3_predictions": [
+            {"class": labels[i], "confidence": p, "percentage": round(p * 100, 2)}
+            for i, p in zip(top_3_idx, top_3_confidences)
+        ],
+    }
+    if not compact:
+        response["model_info"] = version.model_info
+    return response
+
 
+async def audit_cascade_exit(version: ModelVersion, image_data: bytes, small_top1: int):
+    """Re-run a confident cascade exit on the full model to measure agreement"""
+    plant_type = version.plant_type
     try:
-        # Read image file
-        logger.info(f"Processing tomato image: {file.filename}")
-        image_data = await file.read()
+        with version.use():
+            full_probabilities = await version.batcher.submit_bytes(image_data)
+    except Exception as e:
+        logger.warning(f"{plant_type.capitalize()} cascade audit failed: {str(e)}")
+        return
+    stats = cascade_stats[plant_type]
+    stats["audits"] += 1
+    stats["audit_agreements"] += int(int(np.argmax(full_probabilities)) == small_top1)
 
-        # Open image with PIL
-        image = Image.open(io.BytesIO(image_data))
-        logger.info(
-            f"Image opened successfully. Size: {image.size}, Mode: {image.mode}"
-        )
 
-        # Preprocess image
-        processed_image = preprocess_image(image)
-        logger.info("Image preprocessed successfully")
+async def run_cascade(version: ModelVersion, image_data: bytes):
+    """
+    Classify with the small model first and escalate to the full model when unsure
 
-        # Make prediction
-        logger.info("Making tomato prediction...")
-        predictions = models[plant_type].predict(processed_image, verbose=0)
+    The image is first decoded only at the small model's input size (JPEGs
+    at a reduced scale), so a confident exit never decodes the full
+    resolution; an escalation decodes it for the full model like any
+    other request.
 
-        # Get prediction results
-        predicted_class_idx = np.argmax(predictions[0])
-        confidence = float(predictions[0][predicted_class_idx])
-        predicted_class = class_labels[plant_type][predicted_class_idx]
+    Returns:
+        Tuple of (probabilities, cascade info for the response)
+    """
+    plant_type = version.plant_type
+    small_batcher = version.cascade_batcher
+    stats = cascade_stats[plant_type]
+    started = time.perf_counter()
+
+    small_pixels = (await asyncio.to_thread(decode_pixels, image_data, (small_batcher.image_size,), True))[0]
+    small_probabilities = (await small_batcher.submit_pixels(small_pixels[np.newaxis]))[0]
+    small_top1 = int(np.argmax(small_probabilities))
+    small_confidence = float(small_probabilities[small_top1])
+    stats["requests"] += 1
+
+    if small_confidence >= CASCADE_CONFIDENCE_THRESHOLD:
+        stats["exits"] += 1
+        stats["small_time_ms"] += (time.perf_counter() - started) * 1000
+        if random.random() < CASCADE_AUDIT_RATE:
+            spawn_background(audit_cascade_exit(version, image_data, small_top1))
+        return small_probabilities, {
+            "stage": "small",
+            "small_confidence": small_confidence,
+            "threshold": CASCADE_CONFIDENCE_THRESHOLD,
+        }
 
-        # Get top 3 predictions
-        top_3_idx = np.argsort(predictions[0])[-3:][::-1]
-        top_3_predictions = [
+    full_probabilities = await version.batcher.submit_bytes(image_data)
+    stats["escalations"] += 1
+    stats["escalated_time_ms"] += (time.perf_counter() - started) * 1000
+    stats["escalated_agreements"] += int(int(np.argmax(full_probabilities)) == small_top1)
+    return full_probabilities, {
+        "stage": "full",
+        "small_confidence": small_confidence,
+        "threshold": CASCADE_CONFIDENCE_THRESHOLD,
+    }
+
+
+async def run_tta(version: ModelVersion, image_data: bytes) -> np.ndarray:
+    """Classify every TTA view in a single batch and return the averaged probabilities"""
+    views = await asyncio.to_thread(decode_tta_batch, image_data)
+    outputs = await version.batcher.submit_pixels(views)
+    return outputs.mean(axis=0)
+
+
+async def run_tiled(version: ModelVersion, image_data: bytes):
+    """
+    Classify overlapping tiles of a large photo and find its worst-affected regions
+
+    Tiles are written straight from the decoded level images into the image
+    ring in max-batch-size chunks, which run back to back as full batches.
+
+    Returns:
+        Tuple of (aggregated probabilities, tiling info for the response)
+    """
+    (width, height), levels = await asyncio.to_thread(decode_tile_levels, image_data)
+    tile_width, tile_height = IMG_SIZE
+    entries = [(level, y, x) for level in levels for y, x in level["tiles"]]
+
+    def make_fill(chunk):
+        def fill(view: np.ndarray):
+            for i, (level, y, x) in enumerate(chunk):
+                view[i] = level["pixels"][y:y + tile_height, x:x + tile_width]
+
+        return fill
+
+    batch_size = version.batcher.max_batch_size
+    chunks = [entries[i:i + batch_size] for i in range(0, len(entries), batch_size)]
+    outputs = await asyncio.gather(
+        *(version.batcher.submit_fill(len(chunk), make_fill(chunk)) for chunk in chunks)
+    )
+    tile_probabilities = np.concatenate(outputs)
+
+    # How diseased each tile looks: everything that isn't a healthy class, or
+    # plain top-1 confidence for models without a healthy class
+    healthy = np.array(["healthy" in label.lower() for label in version.labels])
+    if healthy.any() and not healthy.all():
+        disease_scores = 1.0 - tile_probabilities[:, healthy].sum(axis=1)
+        disease_probabilities = np.where(healthy, 0.0, tile_probabilities)
+    else:
+        disease_scores = tile_probabilities.max(axis=1)
+        disease_probabilities = tile_probabilities
+
+    worst_regions = []
+    for i in top_k_indices(disease_scores, TILE_WORST_REGIONS).tolist():
+        level, y, x = entries[i]
+        scale = level["scale"]
+        class_idx = int(np.argmax(disease_probabilities[i]))
+        worst_regions.append(
             {
-                "class": class_labels[plant_type][i],
-                "confidence": float(predictions[0][i]),
-                "percentage": round(float(predictions[0][i]) * 100, 2),
+                # Tile bounds in original image pixels: [left, top, right, bottom]
+                "box": [
+                    round(x * scale),
+                    round(y * scale),
+                    min(width, round((x + tile_width) * scale)),
+                    min(height, round((y + tile_height) * scale)),
+                ],
+                "level": level["level"],
+                "disease_score": round(float(disease_scores[i]), 4),
+                "predicted_class": version.labels[class_idx],
+                "confidence": float(tile_probabilities[i, class_idx]),
             }
-            for i in top_3_idx
-        ]
+        )
 
-        # Prepare response
-        response = {
-            "success": True,
-            "plant_type": plant_type,
-            "filename": file.filename,
-            "prediction": {
-                "predicted_class": predicted_class,
-                "confidence": confidence,
-                "percentage": round(confidence * 100, 2),
-            },
-            "top_3_predictions": top_3_predictions,
-            "model_info": {
-                "plant_type": plant_type,
-                "total_classes": len(class_labels[plant_type]),
-                "image_size": IMG_SIZE,
-                "metadata": model_metadata.get(plant_type, {}),
-            },
-        }
+    return aggregate_tile_probabilities(tile_probabilities, disease_scores), {
+        "levels": [level["level"] for level in levels],
+        "tile_count": len(entries),
+        "overlap": TILE_OVERLAP,
+        # The tiles were spread out to fit TILE_MAX_TILES and don't cover the whole photo
+        "stride_widened": any(level["stride_widened"] for level in levels),
+        "worst_regions": worst_regions,
+    }
 
-        logger.info(
-            f"Tomato prediction successful: {predicted_class} ({confidence:.4f})"
+
+def keeps_embedding_store(plant_type: str) -> bool:
+    return WORKER_EMBEDDING_PLANT_TYPES is None or plant_type in WORKER_EMBEDDING_PLANT_TYPES
+
+
+def open_embedding_store(version: ModelVersion) -> EmbeddingStore:
+    """The embedding store of a model version, opened on first use (blocking)"""
+    key = f"{version.plant_type}/{version.version}"
+    with embedding_stores_lock:
+        store = embedding_stores.get(key)
+        if store is None:
+            store = EmbeddingStore(
+                os.path.join(EMBEDDING_STORE_DIR, version.plant_type, version.version),
+                int(version.embedding_model.outputs[1].shape[-1]),
+                dtype=EMBEDDING_DTYPE,
+                nprobe=EMBEDDING_NPROBE,
+                train_min=EMBEDDING_TRAIN_MIN,
+            )
+            embedding_stores[key] = store
+        return store
+
+
+def earlier_embedding_versions(version: ModelVersion) -> List[str]:
+    """Model versions of a crop with stored embeddings that this version's store does not include, oldest first"""
+    crop_dir = os.path.join(EMBEDDING_STORE_DIR, version.plant_type)
+    try:
+        earlier = [name for name in os.listdir(crop_dir) if name != version.version]
+    except FileNotFoundError:
+        return []
+    return sorted(earlier, key=lambda name: os.path.getmtime(os.path.join(crop_dir, name)))
+
+
+def require_embeddings(version: ModelVersion):
+    if version.embedding_model is None:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Embeddings are not available for the {version.plant_type} model",
         )
-        return JSONResponse(content=response)
 
-    except Exception as e:
-        logger.error(f"Error during tomato prediction: {str(e)}")
+
+def require_embedding_store(version: ModelVersion):
+    require_embeddings(version)
+    if not keeps_embedding_store(version.plant_type):
         raise HTTPException(
-            status_code=500, detail=f"Tomato prediction failed: {str(e)}"
+            status_code=409,
+            detail=f"The {version.plant_type} embedding store is kept by another worker",
         )
 
 
-@app.post("/predict-cotton")
-async def predict_cotton_disease(file: UploadFile = File(...)):
+async def classify_image(
+    plant_type: str,
+    image_data: bytes,
+    filename: str,
+    tta: bool = False,
+    compact: bool = False,
+    request_log: Optional[RequestLog] = None,
+    tiled: bool = False,
+    embedding: bool = False,
+    store: bool = False,
+    on_prediction: Optional[Callable[[str, float], None]] = None,
+) -> dict:
     """
-    Predict cotton disease from uploaded image
+    Classify one encoded image with a crop's model and build the response body
+
+    The image is decoded straight into the crop's shared-memory image ring
+    and classified by its batcher together with any concurrent requests. When
+    the crop has a cascade model, that runs first (see run_cascade). With
+    `tta`, or when the answer is below TTA_CONFIDENCE_THRESHOLD, the
+    augmented views are averaged instead (see run_tta). With `tiled`,
+    overlapping tiles of the full-resolution photo are classified instead of
+    one squashed view (see run_tiled).
+
+    The penultimate-layer embedding comes out of the single-view forward
+    pass; the other paths run one extra single view when it is requested.
 
     Args:
-        file: Image file (JPEG, PNG, BMP, TIFF)
+        plant_type: Crop whose model to use (must be loaded)
+        image_data: Encoded image bytes (already size and header checked)
+        filename: Original upload filename
+        tta: Run test-time augmentation
+        compact: Leave model_info out of the response
+        request_log: Summary record to add stage timings and fields to
+        tiled: Classify overlapping tiles and report the worst regions
+        embedding: Include the image's feature embedding
+        store: Store the embedding for /similar searches
+        on_prediction: Called with the predicted class and its confidence as
+            soon as the final probabilities are known, before the response
+            is built (diagnose starts the cure from here)
 
     Returns:
-        JSON response with prediction results
+        Response dictionary
     """
-    plant_type = "cotton"
+    request_log = request_log or RequestLog("prediction", 0.0)
+
+    # Pin one model version for the whole request, so a hot reload can't
+    # mix one version's probabilities with another version's labels
+    version, shadow = model_registry.select(plant_type)
+    request_log.fields["model_version"] = version.version
+    want_features = embedding or store
+    if store:
+        require_embedding_store(version)
+    elif want_features:
+        require_embeddings(version)
+    features = None
+    cascade_info = None
+    tta_info = None
+    tiles_info = None
+    with version.use():
+        if tiled:
+            with request_log.stage("tiles"):
+                probabilities, tiles_info = await run_tiled(version, image_data)
+            request_log.fields["tile_count"] = tiles_info["tile_count"]
+        elif tta:
+            # The original view is part of the TTA batch, so skip the single pass
+            with request_log.stage("tta"):
+                probabilities = await run_tta(version, image_data)
+            tta_info = {"views": TTA_VIEWS, "trigger": "request"}
+        else:
+            with request_log.stage("inference"):
+                if version.cascade_batcher is not None:
+                    probabilities, cascade_info = await run_cascade(version, image_data)
+                    request_log.fields["cascade_stage"] = cascade_info["stage"]
+                elif want_features:
+                    probabilities, features = await version.batcher.submit_bytes(image_data, with_extra=True)
+                else:
+                    # Decode into the image ring and wait for the batched prediction
+                    probabilities = await version.batcher.submit_bytes(image_data)
+
+            single_view_confidence = float(np.max(probabilities))
+            if single_view_confidence < TTA_CONFIDENCE_THRESHOLD:
+                with request_log.stage("tta"):
+                    probabilities = await run_tta(version, image_data)
+                tta_info = {
+                    "views": TTA_VIEWS,
+                    "trigger": "low_confidence",
+                    "single_view_confidence": single_view_confidence,
+                    "threshold": TTA_CONFIDENCE_THRESHOLD,
+                }
+
+        if on_prediction is not None:
+            # Same selection as build_prediction_response, so ties resolve the same way
+            top_index = int(top_k_indices(probabilities, 1)[0])
+            on_prediction(version.labels[top_index], float(probabilities[top_index]))
+            # Let work the hook started (e.g. the cure's LLM request) get going first
+            await asyncio.sleep(0)
+
+        if want_features and features is None:
+            with request_log.stage("embedding"):
+                _, features = await version.batcher.submit_bytes(image_data, with_extra=True)
+
+    if shadow is not None:
+        spawn_background(
+            model_registry.shadow(shadow, lambda v: v.batcher.submit_bytes(image_data), probabilities)
+        )
+
+    response = build_prediction_response(version, filename, probabilities, compact)
+    if cascade_info is not None:
+        response["cascade"] = cascade_info
+    if tta_info is not None:
+        response["tta"] = tta_info
+    if tiles_info is not None:
+        response["tiles"] = tiles_info
+    if store:
+        with request_log.stage("store"):
+            store_for_version = await asyncio.to_thread(open_embedding_store, version)
+            response["embedding_id"] = await asyncio.to_thread(
+                store_for_version.add,
+                features,
+                filename,
+                response["prediction"]["predicted_class"],
+                response["prediction"]["confidence"],
+            )
+    if embedding:
+        response["embedding"] = features
+
+    request_log.fields["predicted_class"] = response["prediction"]["predicted_class"]
+    request_log.fields["confidence"] = round(response["prediction"]["confidence"], 4)
+    return response
+
+
+async def predict_plant_disease(
+    plant_type: str,
+    file: UploadFile,
+    tta: bool = False,
+    compact: bool = False,
+    tiled: bool = False,
+    embedding: bool = False,
+    store: bool = False,
+) -> ORJSONResponse:
+    """Shared implementation of the /predict-<crop> endpoints (see classify_image)"""
     validate_plant_type(plant_type)
     validate_image(file)
 
+    request_log = RequestLog("prediction", LOG_SAMPLE_RATE, plant_type=plant_type, filename=file.filename)
     try:
         # Read image file
-        logger.info(f"Processing cotton image: {file.filename}")
-        image_data = await file.read()
+        with request_log.stage("read"):
+            image_data = await read_upload(file)
+        request_log.fields["bytes"] = len(image_data)
 
-        # Open image with PIL
-        image = Image.open(io.BytesIO(image_data))
-        logger.info(
-            f"Image opened successfully. Size: {image.size}, Mode: {image.mode}"
+        response = await classify_image(
+            plant_type, image_data, file.filename, tta, compact, request_log, tiled, embedding, store
         )
+        with request_log.stage("response"):
+            json_response = ORJSONResponse(content=response)
 
-        # Preprocess image
-        processed_image = preprocess_image(image)
-        logger.info("Image preprocessed successfully")
+        request_log.emit(logger)
+        return json_response
 
-        # Make prediction
-        logger.info("Making cotton prediction...")
-        predictions = models[plant_type].predict(processed_image, verbose=0)
+    except HTTPException as e:
+        request_log.emit(logger, e.status_code, e.detail)
+        raise
+    except Exception as e:
+        request_log.emit(logger, 500, str(e))
+        raise HTTPException(
+            status_code=500, detail=f"{plant_type.capitalize()} prediction failed: {str(e)}"
+        )
 
-        # Get prediction results
-        predicted_class_idx = np.argmax(predictions[0])
-        confidence = float(predictions[0][predicted_class_idx])
-        predicted_class = class_labels[plant_type][predicted_class_idx]
 
-        # Get top 3 predictions
-        top_3_idx = np.argsort(predictions[0])[-3:][::-1]
-        top_3_predictions = [
-            {
-                "class": class_labels[plant_type][i],
-                "confidence": float(predictions[0][i]),
-                "percentage": round(float(predictions[0][i]) * 100, 2),
-            }
-            for i in top_3_idx
-        ]
+@app.post("/predict-tomato")
+async def predict_tomato_disease(
+    file: UploadFile = File(...),
+    tta: bool = Query(False, description="Average predictions over augmented views"),
+    compact: bool = Query(False, description="Leave out model_info (look it up by model_version)"),
+    tiled: bool = Query(False, description="Classify overlapping tiles of a large photo"),
+    embedding: bool = Query(False, description="Include the image's feature embedding"),
+    store: bool = Query(False, description="Store the embedding for /similar searches"),
+):
+    """
+    Predict tomato disease from uploaded image
 
-        # Prepare response
-        response = {
-            "success": True,
-            "plant_type": plant_type,
-            "filename": file.filename,
-            "prediction": {
-                "predicted_class": predicted_class,
-                "confidence": confidence,
-                "percentage": round(confidence * 100, 2),
-            },
-            "top_3_predictions": top_3_predictions,
-            "model_info": {
-                "plant_type": plant_type,
-                "total_classes": len(class_labels[plant_type]),
-                "image_size": IMG_SIZE,
-                "metadata": model_metadata.get(plant_type, {}),
-            },
-        }
+    Args:
+        file: Image file (JPEG, PNG, BMP, TIFF)
+        tta: Run test-time augmentation
+        compact: Return the compact response
+        tiled: Classify overlapping tiles and report the worst regions
+        embedding: Include the image's feature embedding
+        store: Store the embedding for /similar searches
 
-        logger.info(
-            f"Cotton prediction successful: {predicted_class} ({confidence:.4f})"
-        )
-        return JSONResponse(content=response)
+    Returns:
+        JSON response with prediction results
+    """
+    return await predict_plant_disease("tomato", file, tta, compact, tiled, embedding, store)
 
-    except Exception as e:
-        logger.error(f"Error during cotton prediction: {str(e)}")
-        raise HTTPException(
-            status_code=500, detail=f"Cotton prediction failed: {str(e)}"
-        )
+
+@app.post("/predict-cotton")
+async def predict_cotton_disease(
+    file: UploadFile = File(...),
+    tta: bool = Query(False, description="Average predictions over augmented views"),
+    compact: bool = Query(False, description="Leave out model_info (look it up by model_version)"),
+    tiled: bool = Query(False, description="Classify overlapping tiles of a large photo"),
+    embedding: bool = Query(False, description="Include the image's feature embedding"),
+    store: bool = Query(False, description="Store the embedding for /similar searches"),
+):
+    """
+    Predict cotton disease from uploaded image
+
+    Args:
+        file: Image file (JPEG, PNG, BMP, TIFF)
+        tta: Run test-time augmentation
+        compact: Return the compact response
+        tiled: Classify overlapping tiles and report the worst regions
+        embedding: Include the image's feature embedding
+        store: Store the embedding for /similar searches
+
+    Returns:
+        JSON response with prediction results
+    """
+    return await predict_plant_disease("cotton", file, tta, compact, tiled, embedding, store)
 
 
 @app.post("/predict-mango")
-async def predict_mango_disease(file: UploadFile = File(...)):
+async def predict_mango_disease(
+    file: UploadFile = File(...),
+    tta: bool = Query(False, description="Average predictions over augmented views"),
+    compact: bool = Query(False, description="Leave out model_info (look it up by model_version)"),
+    tiled: bool = Query(False, description="Classify overlapping tiles of a large photo"),
+    embedding: bool = Query(False, description="Include the image's feature embedding"),
+    store: bool = Query(False, description="Store the embedding for /similar searches"),
+):
     """
     Predict mango disease from uploaded image
 
     Args:
         file: Image file (JPEG, PNG, BMP, TIFF)
+        tta: Run test-time augmentation
+        compact: Return the compact response
+        tiled: Classify overlapping tiles and report the worst regions
+        embedding: Include the image's feature embedding
+        store: Store the embedding for /similar searches
+
+    Returns:
+        JSON response with prediction results
+    """
+    return await predict_plant_disease("mango", file, tta, compact, tiled, embedding, store)
+
+
+@app.post("/predict-rice")
+async def predict_rice_disease(
+    file: UploadFile = File(...),
+    tta: bool = Query(False, description="Average predictions over augmented views"),
+    compact: bool = Query(False, description="Leave out model_info (look it up by model_version)"),
+    tiled: bool = Query(False, description="Classify overlapping tiles of a large photo"),
+    embedding: bool = Query(False, description="Include the image's feature embedding"),
+    store: bool = Query(False, description="Store the embedding for /similar searches"),
+):
+    """
+    Predict rice disease from uploaded image
+
+    Args:
+        file: Image file (JPEG, PNG, BMP, TIFF)
+        tta: Run test-time augmentation
+        compact: Return the compact response
+        tiled: Classify overlapping tiles and report the worst regions
+        embedding: Include the image's feature embedding
+        store: Store the embedding for /similar searches
 
     Returns:
         JSON response with prediction results
     """
-    plant_type = "mango"
+    return await predict_plant_disease("rice", file, tta, compact, tiled, embedding, store)
+
+
+@app.post("/similar/{plant_type}")
+async def find_similar_images(
+    plant_type: str,
+    file: UploadFile = File(...),
+    k: int = Query(5, ge=1, le=SIMILAR_MAX_RESULTS, description="Number of similar images to return"),
+):
+    """
+    Find previously stored diagnoses whose images look like the upload
+
+    Searches the embeddings stored with ?store=true by the crop's active
+    model version. Embeddings of different model versions are not
+    comparable, so a model change starts a new history; `history` says
+    which earlier versions' records are not searched.
+
+    Args:
+        plant_type: Crop model to use
+        file: Image file (JPEG, PNG, BMP, TIFF)
+        k: Number of similar images to return
+
+    Returns:
+        The upload's own prediction and the most similar stored records
+    """
     validate_plant_type(plant_type)
     validate_image(file)
+    image_data = await read_upload(file)
+
+    version = model_registry.active[plant_type]
+    require_embedding_store(version)
+    with version.use():
+        probabilities, features = await version.batcher.submit_bytes(image_data, with_extra=True)
+    store = await asyncio.to_thread(open_embedding_store, version)
+    similar = await asyncio.to_thread(store.search, features, k)
+    earlier_versions = await asyncio.to_thread(earlier_embedding_versions, version)
+
+    predicted_idx = int(np.argmax(probabilities))
+    return ORJSONResponse(
+        {
+            "plant_type": plant_type,
+            "model_version": version.version,
+            "prediction": {
+                "predicted_class": version.labels[predicted_idx],
+                "confidence": float(probabilities[predicted_idx]),
+            },
+            "similar": similar,
+            "history": {
+                "model_version": version.version,
+                "reset_by_model_change": bool(earlier_versions),
+                "earlier_model_versions": earlier_versions,
+            },
+            "index": store.stats(),
+        }
+    )
 
+
+@app.websocket("/ws/predict/{plant_type}")
+async def stream_predictions(websocket: WebSocket, plant_type: str):
+    """
+    Classify a live stream of compressed camera frames
+
+    The client sends each frame as a binary message (JPEG/PNG bytes) and gets
+    one compact JSON message back per classified frame. Only the newest frame
+    is kept: frames that arrive while the previous one is still being
+    classified replace it and are counted as dropped, so a slow connection or
+    a busy model never builds a backlog. Frames from every connected client
+    share the crop's batcher and are classified together.
+    """
+    await websocket.accept()
+    if models.get(plant_type) is None or plant_type not in model_registry.active:
+        await websocket.close(code=1008, reason=f"{plant_type} model not loaded")
+        return
+
+    latest = {"frame": None, "seq": 0, "received_at": 0.0, "dropped": 0, "closed": False}
+    frame_ready = asyncio.Event()
+
+    async def receive_frames():
+        try:
+            while True:
+                message = await websocket.receive()
+                if message["type"] == "websocket.disconnect":
+                    break
+                frame = message.get("bytes")
+                if not frame or len(frame) > WS_MAX_FRAME_BYTES:
+                    continue
+                if latest["frame"] is not None:
+                    latest["dropped"] += 1  # never classified, superseded by this one
+                latest["frame"] = frame
+                latest["seq"] += 1
+                latest["received_at"] = time.perf_counter()
+                frame_ready.set()
+        except WebSocketDisconnect:
+            pass
+        finally:
+            latest["closed"] = True
+            frame_ready.set()
+
+    receiver = asyncio.create_task(receive_frames())
     try:
-        # Read image file
-        logger.info(f"Processing mango image: {file.filename}")
-        image_data = await file.read()
+        while True:
+            await frame_ready.wait()
+            frame_ready.clear()
+            if latest["closed"]:
+                break
+            frame, seq, received_at = latest["frame"], latest["seq"], latest["received_at"]
+            if frame is None:
+                continue
+            latest["frame"] = None
+
+            # Picked per frame, so a long-lived stream follows hot reloads and canary splits
+            version, _ = model_registry.select(plant_type)
+            try:
+                if sniff_image_header(frame) is None:
+                    raise ValueError("Invalid or unsupported image frame")
+                with version.use():
+                    probabilities = await version.batcher.submit_bytes(frame)
+            except HTTPException as e:
+                await websocket.send_text(orjson.dumps({"frame": seq, "error": e.detail}).decode())
+                continue
+            except Exception as e:
+                await websocket.send_text(orjson.dumps({"frame": seq, "error": str(e)}).decode())
+                continue
+
+            predicted_class_idx = int(np.argmax(probabilities))
+            await websocket.send_text(
+                orjson.dumps(
+                    {
+                        "frame": seq,
+                        "predicted_class": version.labels[predicted_class_idx],
+                        "confidence": round(float(probabilities[predicted_class_idx]), 4),
+                        "latency_ms": round((time.perf_counter() - received_at) * 1000, 1),
+                        "dropped": latest["dropped"],
+                        "model_version": version.version,
+                    }
+                ).decode()
+            )
+    except (WebSocketDisconnect, RuntimeError):
+        # RuntimeError: sending after the client went away
+        pass
+    finally:
+        receiver.cancel()
 
-        # Open image with PIL
-        image = Image.open(io.BytesIO(image_data))
-        logger.info(
-            f"Image opened successfully. Size: {image.size}, Mode: {image.mode}"
-        )
 
-        # Preprocess image
-        processed_image = preprocess_image(image)
-        logger.info("Image preprocessed successfully")
+@app.get("/models")
+async def list_model_versions():
+    """Report the active (and canary) version of every loaded model and recent reloads"""
+    return model_registry.describe()
 
-        # Make prediction
-        logger.info("Making mango prediction...")
-        predictions = models[plant_type].predict(processed_image, verbose=0)
 
-        # Get prediction results
-        predicted_class_idx = np.argmax(predictions[0])
-        confidence = float(predictions[0][predicted_class_idx])
-        predicted_class = class_labels[plant_type][predicted_class_idx]
+@app.post("/models/{plant_type}/reload")
+async def reload_model(
+    plant_type: str,
+    role: str = Query(ACTIVE, description="Which version to reload: active or canary"),
+):
+    """
+    Reload a crop model from disk now instead of waiting for the file watcher
 
-        # Get top 3 predictions
-        top_3_idx = np.argsort(predictions[0])[-3:][::-1]
-        top_3_predictions = [
-            {
-                "class": class_labels[plant_type][i],
-                "confidence": float(predictions[0][i]),
-                "percentage": round(float(predictions[0][i]) * 100, 2),
-            }
-            for i in top_3_idx
-        ]
+    The new version is loaded and warmed in the background while the current
+    one keeps serving; requests already in flight finish on the old version.
+    """
+    validate_plant_type(plant_type)
+    if role not in (ACTIVE, CANARY):
+        raise HTTPException(status_code=400, detail=f"Invalid role: {role}. Use '{ACTIVE}' or '{CANARY}'")
+    if role == CANARY and not os.path.exists(CANARY_MODEL_PATHS[plant_type]):
+        raise HTTPException(status_code=404, detail=f"No canary model found for {plant_type}")
+
+    version = await model_registry.reload(plant_type, role)
+    current = model_registry.versions[role].get(plant_type)
+    return {
+        "plant_type": plant_type,
+        "role": role,
+        "reloaded": version is not None,
+        "version": current.version if current is not None else None,
+    }
 
-        # Prepare response
-        response = {
-            "success": True,
-            "plant_type": plant_type,
-            "filename": file.filename,
-            "prediction": {
-                "predicted_class": predicted_class,
-                "confidence": confidence,
-                "percentage": round(confidence * 100, 2),
-            },
-            "top_3_predictions": top_3_predictions,
-            "model_info": {
-                "plant_type": plant_type,
-                "total_classes": len(class_labels[plant_type]),
-                "image_size": IMG_SIZE,
-                "metadata": model_metadata.get(plant_type, {}),
-            },
+
+@app.get("/cascade-stats")
+async def get_cascade_stats():
+    """
+    Report how the confidence-gated cascade is performing per crop
+
+    `estimated_accuracy_delta` is the share of all cascade requests whose
+    answer is expected to differ from the full model: the disagreement rate
+    measured on audited exits, scaled by the exit rate.
+    """
+    report = {}
+    for plant_type, stats in cascade_stats.items():
+        requests_seen = stats["requests"]
+        exits = stats["exits"]
+        exit_rate = exits / requests_seen if requests_seen else None
+        audit_agreement = stats["audit_agreements"] / stats["audits"] if stats["audits"] else None
+        report[plant_type] = {
+            "requests": requests_seen,
+            "exit_rate": exit_rate,
+            "avg_exit_latency_ms": stats["small_time_ms"] / exits if exits else None,
+            "avg_escalated_latency_ms": (
+                stats["escalated_time_ms"] / stats["escalations"] if stats["escalations"] else None
+            ),
+            "escalated_agreement": (
+                stats["escalated_agreements"] / stats["escalations"] if stats["escalations"] else None
+            ),
+            "audits": stats["audits"],
+            "audit_agreement": audit_agreement,
+            "estimated_accuracy_delta": (
+                (1.0 - audit_agreement) * exit_rate
+                if audit_agreement is not None and exit_rate is not None
+                else None
+            ),
         }
+    return {
+        "threshold": CASCADE_CONFIDENCE_THRESHOLD,
+        "audit_rate": CASCADE_AUDIT_RATE,
+        "crops": report,
+    }
 
-        logger.info(
-            f"Mango prediction successful: {predicted_class} ({confidence:.4f})"
-        )
-        return JSONResponse(content=response)
 
-    except Exception as e:
-        logger.error(f"Error during mango prediction: {str(e)}")
-        raise HTTPException(
-            status_code=500, detail=f"Mango prediction failed: {str(e)}"
-        )
+def crop_match_score(probabilities: np.ndarray) -> float:
+    """
+    How decisively a disease head recognises an image, from 0 (uniform) to 1
 
+    Heads have different class counts, so raw top-1 confidences are not
+    comparable; this rescales the top-1 probability against chance level.
+    """
+    num_classes = len(probabilities)
+    chance = 1.0 / num_classes
+    return float((np.max(probabilities) - chance) / (1.0 - chance))
 
-@app.post("/predict-rice")
-async def predict_rice_disease(file: UploadFile = File(...)):
+
+@app.post("/predict/auto")
+async def predict_auto(
+    file: UploadFile = File(...),
+    compact: bool = Query(False, description="Leave out model_info (look it up by model_version)"),
+    plant_types: Optional[str] = Query(None, description="Comma-separated crops to consider (default: all loaded)"),
+):
     """
-    Predict rice disease from uploaded image
+    Identify the crop and predict its disease from a single upload
+
+    The upload is read and decoded once. If the crop classifier is loaded and
+    confident, only the matching disease model runs; otherwise every
+    considered disease model classifies the same decoded image concurrently
+    (each one batched with other traffic) and the most decisive head wins.
 
     Args:
         file: Image file (JPEG, PNG, BMP, TIFF)
+        compact: Return the compact response
+        plant_types: Crops to choose between; serve.py splits the crops
+            between workers this way and merges their answers
 
     Returns:
-        JSON response with prediction results
+        JSON response with prediction results, the identified crop and the
+        crops that were considered
+
+    Raises:
+        HTTPException: 409 if none of the requested crops is loaded here, or
+            the crop classifier is confident about a crop that was not considered
     """
-    plant_type = "rice"
-    validate_plant_type(plant_type)
     validate_image(file)
+    loaded_plant_types = [plant_type for plant_type in model_registry.active if models.get(plant_type) is not None]
+    if not loaded_plant_types:
+        raise HTTPException(status_code=503, detail="No models loaded. Please check server configuration.")
+    if plant_types is not None:
+        requested = [p.strip().lower() for p in plant_types.split(",") if p.strip()]
+        unsupported = [plant_type for plant_type in requested if plant_type not in models]
+        if unsupported:
+            raise HTTPException(
+                status_code=400,
+                detail=f"Unsupported plant types: {unsupported}. Supported types: {list(models.keys())}",
+            )
+        loaded_plant_types = [plant_type for plant_type in loaded_plant_types if plant_type in requested]
+        if not loaded_plant_types:
+            raise HTTPException(
+                status_code=409, detail=f"None of the requested crops {requested} is loaded on this worker"
+            )
 
+    request_log = RequestLog("auto_prediction", LOG_SAMPLE_RATE, filename=file.filename)
     try:
-        # Read image file
-        logger.info(f"Processing rice image: {file.filename}")
-        image_data = await file.read()
-
-        # Open image with PIL
-        image = Image.open(io.BytesIO(image_data))
-        logger.info(
-            f"Image opened successfully. Size: {image.size}, Mode: {image.mode}"
+        with request_log.stage("read"):
+            image_data = await read_upload(file)
+        request_log.fields["bytes"] = len(image_data)
+        with request_log.stage("decode"):
+            pixels = (await asyncio.to_thread(decode_pixels, image_data))[0][np.newaxis]
+        versions = {plant_type: model_registry.select(plant_type)[0] for plant_type in loaded_plant_types}
+        # Hold every selected version before the first await, so a reload
+        # can't close a batcher this request is about to use
+        with ExitStack() as stack:
+            for version in versions.values():
+                stack.enter_context(version.use())
+
+            identification = None
+            if crop_classifier_batcher is not None:
+                with request_log.stage("crop_classifier"):
+                    crop_probabilities = (await crop_classifier_batcher.submit_pixels(pixels))[0]
+                crop_idx = int(np.argmax(crop_probabilities))
+                crop_confidence = float(crop_probabilities[crop_idx])
+                crop = crop_classifier["labels"][crop_idx]
+                if crop_confidence >= AUTO_CROP_MIN_CONFIDENCE and crop not in loaded_plant_types:
+                    # Scoring the photo with the other heads would confidently name the wrong crop
+                    raise HTTPException(
+                        status_code=409,
+                        detail=(
+                            f"The crop was identified as {crop} ({crop_confidence:.2f}), "
+                            f"which is not among the crops considered here: {loaded_plant_types}"
+                        ),
+                    )
+                if crop_confidence >= AUTO_CROP_MIN_CONFIDENCE:
+                    identification = {
+                        "method": "crop_classifier",
+                        "plant_type": crop,
+                        "confidence": crop_confidence,
+                        "scores": {
+                            label: float(p) for label, p in zip(crop_classifier["labels"], crop_probabilities)
+                        },
+                    }
+                    with request_log.stage("inference"):
+                        probabilities = (await versions[crop].batcher.submit_pixels(pixels))[0]
+
+            if identification is None:
+                # Run every disease head on the same decoded pixels
+                with request_log.stage("inference"):
+                    outputs = await asyncio.gather(
+                        *(versions[plant_type].batcher.submit_pixels(pixels) for plant_type in loaded_plant_types)
+                    )
+                scores = {
+                    plant_type: crop_match_score(output[0])
+                    for plant_type, output in zip(loaded_plant_types, outputs)
+                }
+                crop = max(scores, key=scores.get)
+                probabilities = outputs[loaded_plant_types.index(crop)][0]
+                identification = {
+                    "method": "all_heads",
+                    "plant_type": crop,
+                    "confidence": scores[crop],
+                    "scores": scores,
+                }
+
+        with request_log.stage("response"):
+            response = build_prediction_response(versions[crop], file.filename, probabilities, compact)
+            response["crop_identification"] = identification
+            response["considered_crops"] = loaded_plant_types
+            json_response = ORJSONResponse(content=response)
+
+        request_log.fields.update(
+            plant_type=crop,
+            method=identification["method"],
+            model_version=versions[crop].version,
+            predicted_class=response["prediction"]["predicted_class"],
+            confidence=round(response["prediction"]["confidence"], 4),
         )
+        request_log.emit(logger)
+        return json_response
 
-        # Preprocess image
-        processed_image = preprocess_image(image)
-        logger.info("Image preprocessed successfully")
-
-        # Make prediction
-        logger.info("Making rice prediction...")
-        predictions = models[plant_type].predict(processed_image, verbose=0)
-
-        # Get prediction results
-        predicted_class_idx = np.argmax(predictions[0])
-        confidence = float(predictions[0][predicted_class_idx])
-        predicted_class = class_labels[plant_type][predicted_class_idx]
-
-        # Get top 3 predictions
-        top_3_idx = np.argsort(predictions[0])[-3:][::-1]
-        top_3_predictions = [
-            {
-                "class": class_labels[plant_type][i],
-                "confidence": float(predictions[0][i]),
-                "percentage": round(float(predictions[0][i]) * 100, 2),
-            }
-            for i in top_3_idx
-        ]
-
-        # Prepare response
-        response = {
-            "success": True,
-            "plant_type": plant_type,
-            "filename": file.filename,
-            "prediction": {
-                "predicted_class": predicted_class,
-                "confidence": confidence,
-                "percentage": round(confidence * 100, 2),
-            },
-            "top_3_predictions": top_3_predictions,
-            "model_info": {
-                "plant_type": plant_type,
-                "total_classes": len(class_labels[plant_type]),
-                "image_size": IMG_SIZE,
-                "metadata": model_metadata.get(plant_type, {}),
-            },
-        }
-
-        logger.info(f"Rice prediction successful: {predicted_class} ({confidence:.4f})")
-        return JSONResponse(content=response)
-
+    except HTTPException as e:
+        request_log.emit(logger, e.status_code, e.detail)
+        raise
     except Exception as e:
-        logger.error(f"Error during rice prediction: {str(e)}")
-        raise HTTPException(status_code=500, detail=f"Rice prediction failed: {str(e)}")
-    
+        request_log.emit(logger, 500, str(e))
+        raise HTTPException(status_code=500, detail=f"Auto prediction failed: {str(e)}")
+
 
 # Custom exception handler
 @app.exception_handler(Exception)
@@ -567,40 +2082,6 @@ async def global_exception_handler(request, exc):
     )
 
 
-if __name__ == "__main__":
-    # Check if model files exist
-    missing_files = []
-
-    for plant_type, model_path in MODEL_PATHS.items():
-        if not os.path.exists(model_path):
-            missing_files.append(f"{plant_type} model: {model_path}")
-
-        labels_path = CLASS_LABELS_PATHS[plant_type]
-        if not os.path.exists(labels_path):
-            missing_files.append(f"{plant_type} labels: {labels_path}")
-
-    if missing_files:
-        print("⚠️  Warning: Some model files are missing:")
-        for file in missing_files:
-            print(f"   - {file}")
-        print("\nThe API will start but missing models won't be available.")
-        print("Make sure to place your model files in the correct locations.\n")
-
-    # Run the server
-    print("🚀 Starting Plant Disease Classification API...")
-    print("📚 API Documentation available at: http://192.168.18.226:8000/docs")
-    print("🍅 Tomato prediction: http://192.168.18.226:8000/predict-tomato")
-    print("🌱 Cotton prediction: http://192.168.18.226:8000/predict-cotton")
-    print("🥭 Mango prediction: http://192.168.18.226:8000/predict_mango")
-
-    uvicorn.run(
-        app,
-        host="0.0.0.0",
-        port=8000,
-        reload=False,  # Set to True for development
-        access_log=True,
-    )
-
 @app.post("/api/predict/yield")
 async def predict_crop_yield(request: CropYieldRequest):
     """
@@ -610,35 +2091,37 @@ async def predict_crop_yield(request: CropYieldRequest):
     Returns:
         JSON response with predicted yield
     """
+    request_log = RequestLog("yield_prediction", LOG_SAMPLE_RATE)
     try:
         model_path = Path("models/crop_yield_model.pkl")
 
         # ✅ Check if model file exists
         if not model_path.exists():
-            print("[ERROR] Crop yield model file not found.")
             raise HTTPException(status_code=500, detail="Crop yield model file not found.")
 
         # ✅ Load using joblib (not pickle)
-        model = joblib.load(model_path)
-        print("✅ Model loaded successfully!")
+        with request_log.stage("load_model"):
+            model = joblib.load(model_path)
 
         # ✅ Validate input features
         features = request.features
         if not isinstance(features, list) or len(features) != 5:
-            print(f"[ERROR] Invalid features: {features}")
             raise HTTPException(status_code=400, detail="Features must be a list of 5 numeric values.")
 
         # ✅ Convert to float
         features = [float(x) for x in features]
 
         # ✅ Predict
-        prediction = model.predict([features])[0]
-        print(f"[INFO] Prediction result: {prediction}")
+        with request_log.stage("predict"):
+            prediction = model.predict([features])[0]
+        request_log.fields["predicted_yield"] = round(float(prediction), 3)
+        request_log.emit(logger)
 
         return {"predicted_yield": round(float(prediction), 3)}
 
     except Exception as e:
-        print(f"[ERROR] Prediction error: {str(e)}")
+        request_log.fields["features"] = request.features
+        request_log.emit(logger, 500, str(getattr(e, "detail", e)))
         raise HTTPException(status_code=500, detail=f"Prediction error: {str(e)}")
 
 # Add these imports to your existing imports at the top of main.py
@@ -680,7 +2163,10 @@ LLM_PROVIDERS = {
         "api_key_env": "GROQ_API_KEY",
         "max_tokens": 1500,  # Increased from 800
         "temperature": 0.7,
-        "timeout": 90  # Increased timeout
+        "timeout": 90,  # Increased timeout
+        # Client-side budget (0 = unlimited); corrected from the rate-limit response headers
+        "requests_per_minute": int(os.getenv("GROQ_REQUESTS_PER_MINUTE", "30")),
+        "tokens_per_minute": int(os.getenv("GROQ_TOKENS_PER_MINUTE", "12000")),
     },
     "huggingface": {
         "model_name": "google/flan-t5-base",
@@ -688,7 +2174,9 @@ LLM_PROVIDERS = {
         "api_key_env": "HUGGINGFACE_API_KEY",
         "max_tokens": 500,  # Increased
         "temperature": 0.7,
-        "timeout": 60
+        "timeout": 60,
+        "requests_per_minute": int(os.getenv("HUGGINGFACE_REQUESTS_PER_MINUTE", "0")),
+        "tokens_per_minute": int(os.getenv("HUGGINGFACE_TOKENS_PER_MINUTE", "0")),
     },
     "together": {
         "model_name": "meta-llama/Llama-2-7b-chat-hf",
@@ -696,7 +2184,9 @@ LLM_PROVIDERS = {
         "api_key_env": "df29827c8fbbc875e9e28c07835515599e6b923b63f5d1cc4949cc1d935ecfb2",
         "max_tokens": 500,  # Increased
         "temperature": 0.7,
-        "timeout": 60
+        "timeout": 60,
+        "requests_per_minute": int(os.getenv("TOGETHER_REQUESTS_PER_MINUTE", "60")),
+        "tokens_per_minute": int(os.getenv("TOGETHER_TOKENS_PER_MINUTE", "0")),
     }
 }
 
@@ -711,6 +2201,29 @@ API_KEYS = {
     "together": os.getenv("TOGETHER_API_KEY", "")
 }
 
+# How long a cure request may wait for provider rate-limit budget in total
+# before falling back to the static suggestions
+LLM_QUEUE_SECONDS = float(os.getenv("LLM_QUEUE_SECONDS", "10"))
+# LLM cure suggestions are cached per (crop, disease, language); concurrent
+# requests for the same key share one LLM call
+CURE_CACHE_SIZE = int(os.getenv("CURE_CACHE_SIZE", "512"))
+CURE_CACHE_TTL_SECONDS = float(os.getenv("CURE_CACHE_TTL_SECONDS", str(24 * 3600)))
+
+cure_cache: "OrderedDict[tuple, tuple]" = OrderedDict()  # key -> (expires_at, cure_suggestion, model_used)
+cure_in_flight: Dict[tuple, asyncio.Future] = {}
+
+# Concurrent Hugging Face prompts arriving within this window share one call
+LLM_PACK_WINDOW_MS = float(os.getenv("LLM_PACK_WINDOW_MS", "20"))
+LLM_PACK_MAX_PROMPTS = int(os.getenv("LLM_PACK_MAX_PROMPTS", "8"))
+
+# Every serve.py worker gets an equal share of each provider's limits
+llm_limiters = {
+    name: ProviderLimiter(
+        name, config["requests_per_minute"], config["tokens_per_minute"], share=1.0 / WORKER_COUNT
+    )
+    for name, config in LLM_PROVIDERS.items()
+}
+
 # Add these helper functions before your existing functions
 
 def create_cure_prompt(plant_type: str, disease: str, confidence: float, language: str) -> str:
@@ -759,7 +2272,7 @@ async def call_groq_llm(prompt: str) -> dict:
     """Call Groq API for LLM inference"""
     api_key = API_KEYS["groq"]
     if not api_key:
-        return {"success": False, "error": "Groq API key not found"}
+        return {"success": False, "error": "Groq API key not found", "billed": False}
     
     headers = {
         "Authorization": f"Bearer {api_key}",
@@ -782,28 +2295,42 @@ async def call_groq_llm(prompt: str) -> dict:
                 headers=headers, 
                 json=payload
             ) as response:
+                if response.status == 429:
+                    llm_limiters["groq"].on_rate_limited(response.headers)
+                    return {"success": False, "error": "Groq rate limit reached", "rate_limited": True, "billed": False}
+                llm_limiters["groq"].update_from_headers(response.headers)
                 if response.status == 200:
                     result = await response.json()
-                    return {"success": True, "text": result["choices"][0]["message"]["content"]}
+                    return {
+                        "success": True,
+                        "text": result["choices"][0]["message"]["content"],
+                        "tokens_used": result.get("usage", {}).get("total_tokens"),
+                    }
                 else:
                     error_text = await response.text()
-                    return {"success": False, "error": f"Groq API error {response.status}: {error_text}"}
+                    # Rejected requests generate no tokens, and server errors are not billed at all
+                    return {
+                        "success": False,
+                        "error": f"Groq API error {response.status}: {error_text}",
+                        "tokens_used": 0,
+                        "billed": response.status < 500,
+                    }
     except Exception as e:
-        return {"success": False, "error": f"Groq request failed: {str(e)}"}
+        return {"success": False, "error": f"Groq request failed: {str(e)}", "billed": False}
 
-async def call_huggingface_llm(prompt: str) -> dict:
-    """Call Hugging Face Inference API with a free model"""
+async def call_huggingface_batch(prompts: List[str]) -> List[dict]:
+    """Call Hugging Face Inference API with a free model, several prompts in one request"""
     api_key = API_KEYS["huggingface"]
     if not api_key:
-        return {"success": False, "error": "Hugging Face API key not found"}
+        return [{"success": False, "error": "Hugging Face API key not found", "billed": False}] * len(prompts)
     
     headers = {
         "Authorization": f"Bearer {api_key}",
         "Content-Type": "application/json"
     }
     
-    # Using a simpler free model approach
-    payload = {"inputs": prompt}
+    # Using a simpler free model approach; text2text models take a list of inputs
+    payload = {"inputs": prompts if len(prompts) > 1 else prompts[0]}
     
     try:
         async with aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=LLM_CONFIG["timeout"])) as session:
@@ -812,23 +2339,47 @@ async def call_huggingface_llm(prompt: str) -> dict:
                 headers=headers, 
                 json=payload
             ) as response:
+                if response.status == 429:
+                    llm_limiters["huggingface"].on_rate_limited(response.headers)
+                    return [{"success": False, "error": "HF rate limit reached", "rate_limited": True, "billed": False}] * len(prompts)
                 if response.status == 200:
                     result = await response.json()
-                    if isinstance(result, list) and len(result) > 0:
-                        return {"success": True, "text": result[0].get("generated_text", "")}
+                    if isinstance(result, list) and len(result) == len(prompts):
+                        # One entry per input (a single input may come back as a nested list)
+                        return [
+                            {"success": True, "text": (entry[0] if isinstance(entry, list) else entry).get("generated_text", "")}
+                            for entry in result
+                        ]
                     else:
-                        return {"success": False, "error": "Unexpected response format"}
+                        return [{"success": False, "error": "Unexpected response format"}] * len(prompts)
                 else:
                     error_text = await response.text()
-                    return {"success": False, "error": f"HF API error {response.status}: {error_text}"}
+                    return [
+                        {
+                            "success": False,
+                            "error": f"HF API error {response.status}: {error_text}",
+                            "tokens_used": 0,
+                            "billed": response.status < 500,
+                        }
+                    ] * len(prompts)
     except Exception as e:
-        return {"success": False, "error": f"HF request failed: {str(e)}"}
+        return [{"success": False, "error": f"HF request failed: {str(e)}", "billed": False}] * len(prompts)
+
+
+huggingface_packer = PromptPacker(
+    call_huggingface_batch, window_seconds=LLM_PACK_WINDOW_MS / 1000, max_prompts=LLM_PACK_MAX_PROMPTS
+)
+
+
+async def call_huggingface_llm(prompt: str) -> dict:
+    """Call Hugging Face Inference API, packed with concurrent prompts into one request"""
+    return await huggingface_packer.submit(prompt)
 
 async def call_together_llm(prompt: str) -> dict:
     """Call Together AI API"""
     api_key = API_KEYS["together"]
     if not api_key:
-        return {"success": False, "error": "Together API key not found"}
+        return {"success": False, "error": "Together API key not found", "billed": False}
     
     headers = {
         "Authorization": f"Bearer {api_key}",
@@ -851,14 +2402,28 @@ async def call_together_llm(prompt: str) -> dict:
                 headers=headers, 
                 json=payload
             ) as response:
+                if response.status == 429:
+                    llm_limiters["together"].on_rate_limited(response.headers)
+                    return {"success": False, "error": "Together rate limit reached", "rate_limited": True, "billed": False}
+                llm_limiters["together"].update_from_headers(response.headers)
                 if response.status == 200:
                     result = await response.json()
-                    return {"success": True, "text": result["choices"][0]["message"]["content"]}
+                    return {
+                        "success": True,
+                        "text": result["choices"][0]["message"]["content"],
+                        "tokens_used": result.get("usage", {}).get("total_tokens"),
+                    }
                 else:
                     error_text = await response.text()
-                    return {"success": False, "error": f"Together API error {response.status}: {error_text}"}
+                    # Rejected requests generate no tokens, and server errors are not billed at all
+                    return {
+                        "success": False,
+                        "error": f"Together API error {response.status}: {error_text}",
+                        "tokens_used": 0,
+                        "billed": response.status < 500,
+                    }
     except Exception as e:
-        return {"success": False, "error": f"Together request failed: {str(e)}"}
+        return {"success": False, "error": f"Together request failed: {str(e)}", "billed": False}
 
 def get_fallback_cure_suggestion(plant_type: str, disease: str) -> str:
     """Provide comprehensive cure suggestions when LLM is unavailable"""
@@ -931,8 +2496,44 @@ def get_fallback_cure_suggestion(plant_type: str, disease: str) -> str:
     return generic_cures.get(plant_type.lower(), 
         "1. Apply broad-spectrum fungicide spray\n2. Remove all affected plant parts\n3. Improve drainage and air circulation\n4. Adjust watering practices\n\nPrevention: Use healthy plants, maintain field hygiene")
 
-async def call_llm_with_fallback(prompt: str) -> dict:
-    """Call LLM with fallback options"""
+async def call_rate_limited(provider_name: str, provider_func, prompt: str, deadline: float) -> dict:
+    """
+    Call a provider within its rate-limit budget
+
+    Waits for budget until `deadline`, and after a 429 tries once more if
+    the provider's Retry-After time still fits before the deadline. Providers
+    without an API key are skipped without touching their budget, and calls
+    the provider did not bill get their whole reservation back.
+    """
+    if not API_KEYS.get(provider_name):
+        return {"success": False, "error": f"{provider_name} API key not found"}
+    limiter = llm_limiters[provider_name]
+    reserved = estimate_tokens(prompt) + LLM_CONFIG["max_tokens"]
+    result = {"success": False, "error": f"{provider_name} rate limit budget exhausted"}
+    for _ in range(2):
+        if not await limiter.acquire(reserved, deadline):
+            return {"success": False, "error": f"{provider_name} rate limit budget exhausted"}
+        result = await provider_func(prompt)
+        if result.get("billed", True):
+            limiter.settle(reserved, result.get("tokens_used"), 1.0 / result.get("packed", 1))
+        else:
+            limiter.refund(reserved, 1.0 / result.get("packed", 1))
+        if not result.get("rate_limited"):
+            return result
+    return result
+
+
+async def call_llm_with_fallback(prompt: str, deadline: Optional[float] = None) -> dict:
+    """
+    Call LLM with fallback options
+
+    Args:
+        prompt: Prompt text
+        deadline: time.monotonic() by which budget must be available
+            (default: LLM_QUEUE_SECONDS from now)
+    """
+    if deadline is None:
+        deadline = time.monotonic() + LLM_QUEUE_SECONDS
     
     # List of providers to try in order
     providers = [
@@ -942,12 +2543,9 @@ async def call_llm_with_fallback(prompt: str) -> dict:
     ]
     
     # Try preferred provider first
-    if PREFERRED_LLM == "groq":
-        result = await call_groq_llm(prompt)
-    elif PREFERRED_LLM == "huggingface":
-        result = await call_huggingface_llm(prompt)
-    elif PREFERRED_LLM == "together":
-        result = await call_together_llm(prompt)
+    provider_funcs = dict(providers)
+    if PREFERRED_LLM in provider_funcs:
+        result = await call_rate_limited(PREFERRED_LLM, provider_funcs[PREFERRED_LLM], prompt, deadline)
     else:
         result = {"success": False, "error": "Unknown provider"}
     
@@ -957,8 +2555,8 @@ async def call_llm_with_fallback(prompt: str) -> dict:
     # Try other providers as fallback
     for provider_name, provider_func in providers:
         if provider_name != PREFERRED_LLM:
-            logger.info(f"Trying fallback provider: {provider_name}")
-            result = await provider_func(prompt)
+            logger.info("Trying fallback provider: %s", provider_name)
+            result = await call_rate_limited(provider_name, provider_func, prompt, deadline)
             if result["success"]:
                 return result
     
@@ -989,6 +2587,99 @@ def extract_cure_from_response(llm_response: str, original_prompt: str) -> str:
 
 # Add this new endpoint to your FastAPI app (add this before the exception handler)
 
+async def cached_llm_cure(
+    request: CureSuggestionRequest, prompt: str, request_log: RequestLog
+) -> Optional[Tuple[str, str]]:
+    """
+    LLM cure suggestion for a request, from the cure cache when possible
+
+    Returns:
+        Tuple of (cure suggestion, model used), or None when every provider failed
+    """
+    cache_key = (request.plant_type, request.predicted_class.lower(), request.language or "en")
+    cached = cure_cache.get(cache_key)
+    if cached is not None and cached[0] >= time.monotonic():
+        cure_cache.move_to_end(cache_key)
+        request_log.fields["cure_cache"] = "hit"
+        return cached[1], cached[2]
+
+    # Identical concurrent requests wait for the same LLM call
+    llm_call = cure_in_flight.get(cache_key)
+    if llm_call is None:
+        llm_call = asyncio.ensure_future(call_llm_with_fallback(prompt))
+        cure_in_flight[cache_key] = llm_call
+        llm_call.add_done_callback(lambda _: cure_in_flight.pop(cache_key, None))
+    with request_log.stage("llm"):
+        llm_result = await asyncio.shield(llm_call)
+
+    if not llm_result["success"]:
+        request_log.fields["llm_error"] = llm_result["error"]
+        return None
+
+    cure_suggestion = extract_cure_from_response(llm_result["text"], prompt)
+    model_used = LLM_CONFIG["model_name"]
+    request_log.fields["llm_response_chars"] = len(llm_result["text"])
+    cure_cache[cache_key] = (time.monotonic() + CURE_CACHE_TTL_SECONDS, cure_suggestion, model_used)
+    cure_cache.move_to_end(cache_key)
+    while len(cure_cache) > CURE_CACHE_SIZE:
+        cure_cache.popitem(last=False)
+    return cure_suggestion, model_used
+
+
+async def generate_cure_suggestion(
+    request: CureSuggestionRequest, request_log: Optional[RequestLog] = None
+) -> CureSuggestionResponse:
+    """
+    Generate a cure suggestion with the LLM, or from the fallback table when every provider fails
+
+    Args:
+        request: CureSuggestionRequest with plant_type, predicted_class, confidence, severity, and language
+        request_log: Summary record to add stage timings and fields to
+
+    Returns:
+        CureSuggestionResponse
+    """
+    request_log = request_log or RequestLog("cure_suggestion", 0.0)
+
+    # Validate plant type
+    if request.plant_type not in ["tomato", "cotton", "mango", "rice"]:
+        raise HTTPException(
+            status_code=400,
+            detail=f"Unsupported plant type: {request.plant_type}"
+        )
+    
+    # Create prompt for LLM
+    confidence = request.confidence or 0.5
+    prompt = create_cure_prompt(
+        request.plant_type, 
+        request.predicted_class, 
+        confidence,
+        request.language
+    )
+    
+    llm_cure = await cached_llm_cure(request, prompt, request_log)
+    if llm_cure is not None:
+        cure_suggestion, model_used = llm_cure
+    else:
+        # Use fallback cure suggestion when all LLM providers fail
+        cure_suggestion = get_fallback_cure_suggestion(request.plant_type, request.predicted_class)
+        model_used = "fallback_system"
+    
+    # Determine confidence level
+    confidence_level = "high" if confidence > 0.8 else "moderate" if confidence > 0.6 else "low"
+    
+    request_log.fields["model_used"] = model_used
+    request_log.fields["cure_chars"] = len(cure_suggestion)
+    return CureSuggestionResponse(
+        success=True,
+        plant_type=request.plant_type,
+        disease=request.predicted_class,
+        cure_suggestion=cure_suggestion,
+        confidence_level=confidence_level,
+        model_used=model_used
+    )
+
+
 @app.post("/get-cure-suggestion", response_model=CureSuggestionResponse)
 async def get_cure_suggestion(request: CureSuggestionRequest):
     """
@@ -1000,61 +2691,23 @@ async def get_cure_suggestion(request: CureSuggestionRequest):
     Returns:
         JSON response with cure suggestion
     """
+    request_log = RequestLog(
+        "cure_suggestion",
+        LOG_SAMPLE_RATE,
+        plant_type=request.plant_type,
+        disease=request.predicted_class,
+        language=request.language,
+    )
     try:
-        logger.info(f"Getting cure suggestion for {request.plant_type} - {request.predicted_class} in language: {request.language}")
-        
-        # Validate plant type
-        if request.plant_type not in ["tomato", "cotton", "mango", "rice"]:
-            raise HTTPException(
-                status_code=400,
-                detail=f"Unsupported plant type: {request.plant_type}"
-            )
-        
-        # Create prompt for LLM
-        confidence = request.confidence or 0.5
-        prompt = create_cure_prompt(
-            request.plant_type, 
-            request.predicted_class, 
-            confidence,
-            request.language
-        )
-        
-        # Call LLM with fallback
-        logger.info("Calling LLM for cure suggestion...")
-        llm_result = await call_llm_with_fallback(prompt)
-        
-        if llm_result["success"]:
-            cure_suggestion = extract_cure_from_response(llm_result["text"], prompt)
-            model_used = LLM_CONFIG["model_name"]
-            
-            # Log the full response for debugging
-            logger.info(f"Full LLM response length: {len(llm_result['text'])} characters")
-            logger.info(f"Extracted cure length: {len(cure_suggestion)} characters")
-        else:
-            # Use fallback cure suggestion when all LLM providers fail
-            logger.warning(f"All LLM providers failed: {llm_result['error']}")
-            cure_suggestion = get_fallback_cure_suggestion(request.plant_type, request.predicted_class)
-            model_used = "fallback_system"
-        
-        # Determine confidence level
-        confidence_level = "high" if confidence > 0.8 else "moderate" if confidence > 0.6 else "low"
-        
-        response = CureSuggestionResponse(
-            success=True,
-            plant_type=request.plant_type,
-            disease=request.predicted_class,
-            cure_suggestion=cure_suggestion,
-            confidence_level=confidence_level,
-            model_used=model_used
-        )
-        
-        logger.info(f"Cure suggestion generated successfully for {request.plant_type} - {request.predicted_class}")
+        response = await generate_cure_suggestion(request, request_log)
+        request_log.emit(logger)
         return response
         
-    except HTTPException:
+    except HTTPException as e:
+        request_log.emit(logger, e.status_code, e.detail)
         raise
     except Exception as e:
-        logger.error(f"Error generating cure suggestion: {str(e)}")
+        request_log.emit(logger, 500, str(e))
         return CureSuggestionResponse(
             success=False,
             plant_type=request.plant_type,
@@ -1065,6 +2718,255 @@ async def get_cure_suggestion(request: CureSuggestionRequest):
             error=str(e)
         )
 
+@app.post("/diagnose/{plant_type}")
+async def diagnose(
+    plant_type: str,
+    file: UploadFile = File(...),
+    language: str = Query("en", description="Cure suggestion language (en or ur)"),
+    severity: Optional[str] = Query(None, description="mild, moderate or severe"),
+    tta: bool = Query(False, description="Average predictions over augmented views"),
+    compact: bool = Query(False, description="Leave out model_info (look it up by model_version)"),
+    tiled: bool = Query(False, description="Classify overlapping tiles of a large photo"),
+    stream: bool = Query(False, description="Stream the prediction and the cure as NDJSON lines"),
+):
+    """
+    Predict a disease and suggest its cure in one round trip
+
+    The cure (from the cure cache, the LLM or the fallback table) is started
+    from classify_image's on_prediction hook, right after the argmax and
+    before the prediction response is built. With `stream`, the prediction is sent
+    straight away as the first NDJSON line while the cure is generated, and
+    the cure follows as the second line; otherwise both come in one JSON body.
+    Healthy predictions get no cure.
+
+    Args:
+        plant_type: Crop model to use
+        file: Image file (JPEG, PNG, BMP, TIFF)
+        language: Cure suggestion language (en or ur)
+        severity: Optional severity passed on to the cure suggestion
+        tta: Run test-time augmentation
+        compact: Return the compact prediction response
+        tiled: Classify overlapping tiles and report the worst regions
+        stream: Stream {"event": "prediction"} and {"event": "cure"} lines
+
+    Returns:
+        JSON (or NDJSON) response with the prediction and the cure suggestion
+    """
+    validate_plant_type(plant_type)
+    validate_image(file)
+
+    request_log = RequestLog(
+        "diagnosis", LOG_SAMPLE_RATE, plant_type=plant_type, filename=file.filename, language=language
+    )
+    cure_tasks = []
+
+    def start_cure(predicted_class: str, confidence: float):
+        # Runs right after the argmax, so the cure overlaps building the prediction response
+        if "healthy" in predicted_class.lower():
+            return
+        cure_request = CureSuggestionRequest(
+            plant_type=plant_type,
+            predicted_class=predicted_class,
+            confidence=confidence,
+            severity=severity,
+            language=language,
+        )
+        cure_tasks.append(asyncio.ensure_future(generate_cure_suggestion(cure_request, request_log)))
+
+    try:
+        with request_log.stage("read"):
+            image_data = await read_upload(file)
+        request_log.fields["bytes"] = len(image_data)
+        prediction = await classify_image(
+            plant_type, image_data, file.filename, tta, compact, request_log, tiled, on_prediction=start_cure
+        )
+    except HTTPException as e:
+        for task in cure_tasks:
+            task.cancel()
+        request_log.emit(logger, e.status_code, e.detail)
+        raise
+    except Exception as e:
+        for task in cure_tasks:
+            task.cancel()
+        request_log.emit(logger, 500, str(e))
+        raise HTTPException(status_code=500, detail=f"{plant_type.capitalize()} diagnosis failed: {str(e)}")
+
+    top = prediction["prediction"]
+    cure_task = cure_tasks[0] if cure_tasks else None
+
+    async def finish_cure() -> Optional[dict]:
+        if cure_task is None:
+            return None
+        try:
+            return (await cure_task).model_dump()
+        except Exception as e:
+            request_log.fields["cure_error"] = str(e)
+            return CureSuggestionResponse(
+                success=False,
+                plant_type=plant_type,
+                disease=top["predicted_class"],
+                cure_suggestion=get_fallback_cure_suggestion(plant_type, top["predicted_class"]),
+                confidence_level="low",
+                model_used="fallback_system",
+                error=str(e),
+            ).model_dump()
+
+    if not stream:
+        cure = await finish_cure()
+        with request_log.stage("response"):
+            json_response = ORJSONResponse(content={"prediction": prediction, "cure": cure})
+        request_log.emit(logger)
+        return json_response
+
+    async def ndjson_lines():
+        try:
+            yield orjson.dumps(
+                {"event": "prediction", "data": prediction}, option=orjson.OPT_SERIALIZE_NUMPY
+            ) + b"\n"
+            yield orjson.dumps({"event": "cure", "data": await finish_cure()}) + b"\n"
+            request_log.emit(logger)
+        finally:
+            # Client went away before the cure was sent
+            if cure_task is not None and not cure_task.done():
+                cure_task.cancel()
+
+    return StreamingResponse(ndjson_lines(), media_type="application/x-ndjson")
+
+
+async def run_prediction_job(params: dict, image_data: bytes) -> dict:
+    """Job handler: classify an uploaded image (see classify_image)"""
+    validate_plant_type(params["plant_type"])
+    request_log = RequestLog(
+        "prediction_job", LOG_SAMPLE_RATE, plant_type=params["plant_type"], filename=params["filename"]
+    )
+    response = await classify_image(
+        params["plant_type"],
+        image_data,
+        params["filename"],
+        params["tta"],
+        params["compact"],
+        request_log,
+        params.get("tiled", False),
+        params.get("embedding", False),
+        params.get("store", False),
+    )
+    request_log.emit(logger)
+    return response
+
+
+async def run_cure_job(params: dict, payload: Optional[bytes]) -> dict:
+    """Job handler: generate a cure suggestion (see generate_cure_suggestion)"""
+    response = await generate_cure_suggestion(CureSuggestionRequest(**params))
+    return response.model_dump()
+
+
+job_queue.register("predict", run_prediction_job)
+job_queue.register("cure", run_cure_job)
+
+
+def job_response(job: dict) -> ORJSONResponse:
+    """202 while a job is queued or running, 200 once it has finished"""
+    finished = job["status"] in (DONE, FAILED)
+    return ORJSONResponse(status_code=200 if finished else 202, content=job)
+
+
+@app.post("/jobs/predict/{plant_type}")
+async def submit_prediction_job(
+    plant_type: str,
+    file: UploadFile = File(...),
+    tta: bool = Query(False, description="Average predictions over augmented views"),
+    compact: bool = Query(False, description="Leave out model_info (look it up by model_version)"),
+    tiled: bool = Query(False, description="Classify overlapping tiles of a large photo"),
+    embedding: bool = Query(False, description="Include the image's feature embedding"),
+    store: bool = Query(False, description="Store the embedding for /similar searches"),
+):
+    """
+    Queue a prediction and return its job id immediately
+
+    Submitting the same image with the same options again returns the
+    existing job instead of classifying it twice (as long as the same model
+    version is active).
+
+    Args:
+        plant_type: Crop model to use
+        file: Image file (JPEG, PNG, BMP, TIFF)
+        tta: Run test-time augmentation
+        compact: Return the compact response
+        tiled: Classify overlapping tiles and report the worst regions
+        embedding: Include the image's feature embedding
+        store: Store the embedding for /similar searches
+
+    Returns:
+        The job; poll GET /jobs/{job_id} for the result
+    """
+    validate_plant_type(plant_type)
+    validate_image(file)
+    image_data = await read_upload(file)
+
+    params = {
+        "plant_type": plant_type,
+        "filename": file.filename,
+        "tta": tta,
+        "compact": compact,
+        "tiled": tiled,
+        "embedding": embedding,
+        "store": store,
+        "model_version": model_registry.active[plant_type].version,
+    }
+    return job_response(await job_queue.submit("predict", params, image_data))
+
+
+@app.post("/jobs/cure")
+async def submit_cure_job(request: CureSuggestionRequest):
+    """
+    Queue a cure suggestion and return its job id immediately
+
+    Useful when the LLM providers are slow; identical requests share one job.
+
+    Args:
+        request: CureSuggestionRequest with plant_type, predicted_class, confidence, severity, and language
+
+    Returns:
+        The job; poll GET /jobs/{job_id} for the result
+    """
+    if request.plant_type not in ["tomato", "cotton", "mango", "rice"]:
+        raise HTTPException(status_code=400, detail=f"Unsupported plant type: {request.plant_type}")
+    return job_response(await job_queue.submit("cure", request.model_dump()))
+
+
+@app.get("/jobs")
+async def get_job_stats():
+    """
+    Count jobs in the shared store by status
+
+    Returns:
+        Counts per status, plus running jobs whose lease has expired (their
+        worker is gone or stuck; another worker will reclaim them)
+    """
+    return await asyncio.to_thread(job_queue.stats)
+
+
+@app.get("/jobs/{job_id}")
+async def get_job(
+    job_id: str,
+    wait: float = Query(0.0, ge=0.0, description="Seconds to wait for the job to finish (long polling)"),
+):
+    """
+    Get a job's status and, once finished, its result
+
+    Args:
+        job_id: Id returned when the job was submitted
+        wait: Hold the request until the job finishes or this many seconds pass
+
+    Returns:
+        The job with its result or error
+    """
+    job = await job_queue.get(job_id, min(wait, JOB_MAX_WAIT_SECONDS))
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job not found: {job_id}")
+    return job_response(job)
+
+
 # Optional: Add a health check endpoint for the LLM service
 @app.get("/llm-health")
 async def check_llm_health():
@@ -1085,7 +2987,8 @@ async def check_llm_health():
             "available_providers": available_providers,
             "fallback_system": "available",
             "status": "healthy" if result["success"] or len(available_providers) > 0 else "degraded",
-            "error": result.get("error") if not result["success"] else None
+            "error": result.get("error") if not result["success"] else None,
+            "rate_limits": {name: limiter.describe() for name, limiter in llm_limiters.items()},
         }
     except Exception as e:
         return {
@@ -1095,4 +2998,39 @@ async def check_llm_health():
             "fallback_system": "available",
             "status": "degraded",
             "error": str(e)
-        }
\ No newline at end of file
+        }
+
+
+if __name__ == "__main__":
+    # Check if model files exist
+    missing_files = []
+
+    for plant_type, model_path in MODEL_PATHS.items():
+        if not os.path.exists(model_path):
+            missing_files.append(f"{plant_type} model: {model_path}")
+
+        labels_path = CLASS_LABELS_PATHS[plant_type]
+        if not os.path.exists(labels_path):
+            missing_files.append(f"{plant_type} labels: {labels_path}")
+
+    if missing_files:
+        print("⚠️  Warning: Some model files are missing:")
+        for file in missing_files:
+            print(f"   - {file}")
+        print("\nThe API will start but missing models won't be available.")
+        print("Make sure to place your model files in the correct locations.\n")
+
+    # Run the server
+    print("🚀 Starting Plant Disease Classification API...")
+    print("📚 API Documentation available at: http://192.168.18.226:8000/docs")
+    print("🍅 Tomato prediction: http://192.168.18.226:8000/predict-tomato")
+    print("🌱 Cotton prediction: http://192.168.18.226:8000/predict-cotton")
+    print("🥭 Mango prediction: http://192.168.18.226:8000/predict_mango")
+
+    uvicorn.run(
+        app,
+        host="0.0.0.0",
+        port=8000,
+        reload=False,  # Set to True for development
+        access_log=True,
+    )
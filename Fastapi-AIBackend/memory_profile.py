@@ -0,0 +1,136 @@
+"""
+Process memory measurement
+
+Resident set size (RSS) comes from /proc/self/status on Linux. Elsewhere only
+the peak RSS from getrusage is available and current RSS is reported as None.
+
+Peaks of a single step (e.g. one forward pass at a given batch size) are
+measured by resetting the kernel's RSS high-water mark through
+/proc/self/clear_refs first. Where that file cannot be written, the step's
+peak is only known if it raised the process peak, so `measure_memory` reports
+the larger of the peak increase and the RSS increase.
+
+Python-level allocations are broken down with tracemalloc, which has to be
+started early (see MEMORY_TRACEMALLOC_FRAMES in main.py) and slows allocation
+down, so it is off by default.
+"""
+
+import resource
+import sys
+import tracemalloc
+from contextlib import contextmanager
+from typing import List, Optional
+
+
+MB = 1024 * 1024
+
+# Process peak from before the last high-water mark reset
+_peak_before_reset = 0
+
+
+def _read_status_bytes(field: str) -> Optional[int]:
+    """Read a "<field>: <n> kB" line of /proc/self/status in bytes"""
+    try:
+        with open("/proc/self/status", "r") as f:
+            for line in f:
+                if line.startswith(field + ":"):
+                    return int(line.split()[1]) * 1024
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def current_rss() -> Optional[int]:
+    """Current resident set size in bytes, or None where it can't be read"""
+    return _read_status_bytes("VmRSS")
+
+
+def peak_rss() -> int:
+    """Highest resident set size in bytes since start (or the last reset)"""
+    peak = _read_status_bytes("VmHWM")
+    if peak is not None:
+        return peak
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on Linux, bytes on macOS
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def reset_peak_rss() -> bool:
+    """Reset the RSS high-water mark to the current RSS; False if not supported"""
+    global _peak_before_reset
+    _peak_before_reset = max(_peak_before_reset, peak_rss())
+    try:
+        with open("/proc/self/clear_refs", "w") as f:
+            f.write("5")
+        return True
+    except OSError:
+        return False
+
+
+def to_mb(num_bytes: Optional[int]) -> Optional[float]:
+    return round(num_bytes / MB, 1) if num_bytes is not None else None
+
+
+@contextmanager
+def measure_memory():
+    """
+    Measure the RSS growth and peak of the wrapped block
+
+    Yields a dict that is filled in when the block exits:
+    rss_delta_mb (RSS after minus before, None without /proc) and
+    peak_delta_mb (highest RSS reached above the starting RSS).
+    """
+    result = {}
+    peak_reset = reset_peak_rss()
+    rss_before = current_rss()
+    peak_before = peak_rss()
+    try:
+        yield result
+    finally:
+        rss_after = current_rss()
+        peak_after = peak_rss()
+        rss_delta = rss_after - rss_before if rss_after is not None and rss_before is not None else None
+        start = rss_before if rss_before is not None else peak_before
+        if peak_reset or peak_after > peak_before:
+            peak_delta = peak_after - start
+        else:
+            peak_delta = rss_delta or 0  # stayed below an earlier peak; only the growth is known
+        result["rss_delta_mb"] = to_mb(rss_delta)
+        result["peak_delta_mb"] = to_mb(max(0, peak_delta))
+
+
+def tracemalloc_top(limit: int = 10) -> Optional[List[dict]]:
+    """
+    Largest Python allocation sites by live size
+
+    Returns:
+        One entry per source line (most recent frame) with its size and
+        allocation count, or None when tracemalloc is not tracing
+    """
+    if not tracemalloc.is_tracing():
+        return None
+    snapshot = tracemalloc.take_snapshot().filter_traces(
+        [
+            tracemalloc.Filter(False, tracemalloc.__file__),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+            tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+        ]
+    )
+    return [
+        {
+            "location": f"{stat.traceback[0].filename}:{stat.traceback[0].lineno}",
+            "size_mb": round(stat.size / MB, 3),
+            "count": stat.count,
+        }
+        for stat in snapshot.statistics("lineno")[:limit]
+    ]
+
+
+def process_memory() -> dict:
+    """Process-wide memory figures in MB"""
+    report = {"rss_mb": to_mb(current_rss()), "peak_rss_mb": to_mb(max(_peak_before_reset, peak_rss()))}
+    if tracemalloc.is_tracing():
+        traced, traced_peak = tracemalloc.get_traced_memory()
+        report["python_traced_mb"] = to_mb(traced)
+        report["python_traced_peak_mb"] = to_mb(traced_peak)
+    return report
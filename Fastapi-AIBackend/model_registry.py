@@ -0,0 +1,338 @@
+"""
+Versioned model registry with hot reload, canary and shadow traffic
+
+Every crop has one active `ModelVersion` (model, labels, metadata, batcher,
+optional cascade model and a content-hash version id) and optionally a canary
+version. The registry polls the model, label and metadata files; when they
+change it loads and warms the new version in the background, swaps it in with
+a single dict assignment on the event loop, and closes the old version's
+batchers once its in-flight requests have drained. Requests hold on to the version they started with, so
+a swap never mixes one version's probabilities with another's labels.
+
+With a canary loaded, `select` routes a configurable fraction of traffic to
+it ("canary" mode), or keeps answering from the active version while the
+canary classifies the same fraction in the background for comparison
+("shadow" mode).
+"""
+
+import asyncio
+import hashlib
+import logging
+import os
+import random
+import time
+from contextlib import contextmanager
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+
+logger = logging.getLogger(__name__)
+
+ACTIVE = "active"
+CANARY = "canary"
+SHADOW = "shadow"
+CANARY_MODES = (CANARY, SHADOW)
+
+
+def file_fingerprint(paths: List[str]) -> Tuple:
+    """Cheap change detector: (path, mtime, size) of every file that exists"""
+    fingerprint = []
+    for path in paths:
+        try:
+            stat = os.stat(path)
+            fingerprint.append((path, stat.st_mtime_ns, stat.st_size))
+        except FileNotFoundError:
+            fingerprint.append((path, None, None))
+    return tuple(fingerprint)
+
+
+def content_version(paths: List[str]) -> str:
+    """Short content hash of a model's files, used as its version id"""
+    digest = hashlib.sha256()
+    for path in paths:
+        if not os.path.exists(path):
+            continue
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                digest.update(chunk)
+    return digest.hexdigest()[:12]
+
+
+class ModelVersion:
+    """One loaded version of a crop model with its labels, metadata and batcher"""
+
+    def __init__(self, plant_type: str, model, labels: List[str], metadata: dict, version: str, paths: List[str]):
+        self.plant_type = plant_type
+        self.model = model
+        self.labels = labels
+        self.metadata = metadata
+        self.version = version
+        self.paths = paths
+        self.fingerprint = file_fingerprint(paths)
+        self.loaded_at = time.time()
+        self.batcher = None
+        self.in_flight = 0
+        # Static part of the prediction response, filled in by whoever creates the version
+        self.model_info: Optional[dict] = None
+        # Memory measured while loading and warming up (MB)
+        self.memory: dict = {}
+        # Model with the penultimate features as a second output, if available
+        self.embedding_model = None
+        # Small model of the confidence-gated cascade, checked against these labels, and its batcher
+        self.cascade_model = None
+        self.cascade_batcher = None
+
+    @contextmanager
+    def use(self):
+        """Mark a request as using this version so it is not closed underneath it"""
+        self.in_flight += 1
+        try:
+            yield self
+        finally:
+            self.in_flight -= 1
+
+    async def close_batchers(self):
+        for batcher in (self.batcher, self.cascade_batcher):
+            if batcher is not None:
+                await batcher.close()
+
+    def describe(self) -> dict:
+        return {
+            "version": self.version,
+            "loaded_at": self.loaded_at,
+            "in_flight": self.in_flight,
+            "files": self.paths,
+            "cascade": self.cascade_model is not None,
+            "model_info": self.model_info,
+            "memory": self.memory,
+        }
+
+
+class ModelRegistry:
+    """Holds the active (and canary) version of every crop model and hot-swaps them"""
+
+    def __init__(
+        self,
+        load_version: Callable[[str, str], ModelVersion],
+        warm_version: Callable[[ModelVersion], None],
+        start_batcher: Callable[[ModelVersion], None],
+        on_activate: Callable[[ModelVersion], None],
+        poll_interval: float = 5.0,
+        drain_timeout: float = 60.0,
+        canary_fraction: float = 0.0,
+        canary_mode: str = CANARY,
+        on_retire: Optional[Callable[[ModelVersion], None]] = None,
+    ):
+        """
+        Args:
+            load_version: Blocking loader, called in a thread as load_version(plant_type, role)
+            warm_version: Blocking warm-up, called in a thread before a version serves traffic
+            start_batcher: Creates and starts version.batcher, and version.cascade_batcher
+                for a version with a cascade model (runs on the event loop)
+            on_activate: Called after a version becomes the active one
+            poll_interval: Seconds between file checks (0 disables watching)
+            drain_timeout: Longest wait for in-flight requests before closing an old version
+            canary_fraction: Share of requests sent to (or shadowed on) the canary
+            canary_mode: "canary" to serve canary answers, "shadow" to only compare them
+            on_retire: Blocking clean-up, called in a thread once an old version has drained
+
+        Raises:
+            ValueError: If canary_mode is not one of CANARY_MODES
+        """
+        if canary_mode not in CANARY_MODES:
+            raise ValueError(f"Invalid canary mode: {canary_mode}. Use one of {list(CANARY_MODES)}")
+        self.load_version = load_version
+        self.warm_version = warm_version
+        self.start_batcher = start_batcher
+        self.on_activate = on_activate
+        self.poll_interval = poll_interval
+        self.drain_timeout = drain_timeout
+        self.canary_fraction = canary_fraction
+        self.canary_mode = canary_mode
+        self.on_retire = on_retire
+
+        self.versions: Dict[str, Dict[str, ModelVersion]] = {ACTIVE: {}, CANARY: {}}
+        self.watched: Dict[Tuple[str, str], Callable[[], List[str]]] = {}
+        self.shadow_stats: Dict[str, Dict[str, int]] = {}
+        self.reloads: List[dict] = []
+        self._reload_locks: Dict[Tuple[str, str], asyncio.Lock] = {}
+        self._pending_fingerprints: Dict[Tuple[str, str], Tuple] = {}
+        self._watcher: Optional[asyncio.Task] = None
+        self._drains = set()
+
+    @property
+    def active(self) -> Dict[str, ModelVersion]:
+        return self.versions[ACTIVE]
+
+    @property
+    def canary(self) -> Dict[str, ModelVersion]:
+        return self.versions[CANARY]
+
+    def watch(self, plant_type: str, role: str, paths: Callable[[], List[str]]):
+        """Watch a crop's files for the given role; `paths` returns the model file first"""
+        self.watched[(plant_type, role)] = paths
+
+    def install(self, version: ModelVersion, role: str = ACTIVE):
+        """Start a version's batcher and make it current for its role"""
+        if version.batcher is None:
+            self.start_batcher(version)
+
+        old = self.versions[role].get(version.plant_type)
+        self.versions[role][version.plant_type] = version
+        if role == ACTIVE:
+            self.on_activate(version)
+        if role == CANARY:
+            self.shadow_stats[version.plant_type] = {"compared": 0, "agreements": 0}
+
+        if old is not None and old is not version:
+            task = asyncio.get_running_loop().create_task(self._drain(old))
+            self._drains.add(task)
+            task.add_done_callback(self._drains.discard)
+
+    async def reload(self, plant_type: str, role: str = ACTIVE, force: bool = False) -> Optional[ModelVersion]:
+        """
+        Load, warm and swap in a new version of a crop model
+
+        Returns the new version, or None when the files did not change (or the
+        new version failed to load, in which case the current one keeps serving).
+        """
+        lock = self._reload_locks.setdefault((plant_type, role), asyncio.Lock())
+        async with lock:
+            current = self.versions[role].get(plant_type)
+            started = time.perf_counter()
+            try:
+                version = await asyncio.to_thread(self.load_version, plant_type, role)
+                if current is not None and version.version == current.version and not force:
+                    current.fingerprint = version.fingerprint
+                    return None
+                await asyncio.to_thread(self.warm_version, version)
+            except Exception as e:
+                logger.error(f"Reloading {role} {plant_type} model failed, keeping current version: {str(e)}")
+                self.reloads.append(
+                    {"plant_type": plant_type, "role": role, "error": str(e), "at": time.time()}
+                )
+                if current is not None:
+                    # Don't retry the same broken files on every poll
+                    current.fingerprint = file_fingerprint(current.paths)
+                return None
+
+            self.install(version, role)
+            elapsed_ms = (time.perf_counter() - started) * 1000
+            self.reloads.append(
+                {
+                    "plant_type": plant_type,
+                    "role": role,
+                    "from_version": current.version if current is not None else None,
+                    "to_version": version.version,
+                    "load_ms": round(elapsed_ms, 1),
+                    "at": time.time(),
+                }
+            )
+            logger.info(
+                f"Swapped {role} {plant_type} model "
+                f"{current.version if current is not None else '-'} -> {version.version} ({elapsed_ms:.0f} ms)"
+            )
+            return version
+
+    async def _drain(self, old: ModelVersion):
+        """Close an old version's batcher once nothing uses it any more"""
+        deadline = time.monotonic() + self.drain_timeout
+        while old.in_flight > 0 and time.monotonic() < deadline:
+            await asyncio.sleep(0.1)
+        if old.in_flight > 0:
+            logger.warning(
+                f"Closing {old.plant_type} model {old.version} with {old.in_flight} requests still in flight"
+            )
+        await old.close_batchers()
+        if self.on_retire is not None:
+            try:
+                await asyncio.to_thread(self.on_retire, old)
+            except Exception as e:
+                logger.warning(f"Cleaning up {old.plant_type} model {old.version} failed: {str(e)}")
+        logger.info(f"Drained {old.plant_type} model {old.version}")
+
+    def start_watching(self):
+        if self.poll_interval > 0 and self._watcher is None:
+            self._watcher = asyncio.get_running_loop().create_task(self._watch_files())
+
+    async def _watch_files(self):
+        while True:
+            await asyncio.sleep(self.poll_interval)
+            for (plant_type, role), paths in list(self.watched.items()):
+                current = self.versions[role].get(plant_type)
+                fingerprint = file_fingerprint(paths())
+                if current is not None and fingerprint == current.fingerprint:
+                    self._pending_fingerprints.pop((plant_type, role), None)
+                    continue
+                if fingerprint[0][1] is None:
+                    continue  # no model file (yet), e.g. no canary for this crop
+
+                # Only reload once the files have stopped changing between two polls,
+                # so a model that is still being copied is never loaded half-written
+                if self._pending_fingerprints.get((plant_type, role)) != fingerprint:
+                    self._pending_fingerprints[(plant_type, role)] = fingerprint
+                    continue
+                self._pending_fingerprints.pop((plant_type, role), None)
+                await self.reload(plant_type, role)
+
+    def select(self, plant_type: str) -> Tuple[ModelVersion, Optional[ModelVersion]]:
+        """
+        Pick the version that answers a request
+
+        Returns:
+            Tuple of (serving version, version to shadow the request on or None)
+        """
+        active = self.active[plant_type]
+        canary = self.canary.get(plant_type)
+        if canary is None or random.random() >= self.canary_fraction:
+            return active, None
+        if self.canary_mode == CANARY:
+            return canary, None
+        return active, canary
+
+    async def shadow(self, shadow: ModelVersion, run: Callable[[ModelVersion], Awaitable[np.ndarray]], served: np.ndarray):
+        """Run a request on the shadow version and record whether it agrees"""
+        try:
+            with shadow.use():
+                probabilities = await run(shadow)
+        except Exception as e:
+            logger.warning(f"Shadow {shadow.plant_type} model {shadow.version} failed: {str(e)}")
+            return
+        stats = self.shadow_stats.setdefault(shadow.plant_type, {"compared": 0, "agreements": 0})
+        stats["compared"] += 1
+        stats["agreements"] += int(int(np.argmax(probabilities)) == int(np.argmax(served)))
+
+    def describe(self) -> dict:
+        crops = {}
+        for plant_type, version in self.active.items():
+            entry = {"active": version.describe()}
+            canary = self.canary.get(plant_type)
+            if canary is not None:
+                stats = self.shadow_stats.get(plant_type, {"compared": 0, "agreements": 0})
+                entry["canary"] = {
+                    **canary.describe(),
+                    "mode": self.canary_mode,
+                    "traffic_fraction": self.canary_fraction,
+                    "shadow_compared": stats["compared"],
+                    "shadow_agreement": (
+                        stats["agreements"] / stats["compared"] if stats["compared"] else None
+                    ),
+                }
+            crops[plant_type] = entry
+        return {"poll_interval": self.poll_interval, "crops": crops, "recent_reloads": self.reloads[-20:]}
+
+    async def close(self):
+        if self._watcher is not None:
+            self._watcher.cancel()
+            try:
+                await self._watcher
+            except asyncio.CancelledError:
+                pass
+            self._watcher = None
+        for task in list(self._drains):
+            task.cancel()
+        for role_versions in self.versions.values():
+            for version in role_versions.values():
+                await version.close_batchers()
+            role_versions.clear()
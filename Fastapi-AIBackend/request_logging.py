@@ -0,0 +1,137 @@
+"""
+Low-overhead structured logging
+
+Records are handed to a `QueueListener` thread through a queue, so the event
+loop never waits on formatting or stderr writes. Messages keep their %-style
+arguments until the listener formats them, and records below the configured
+level are never built at all.
+
+Each request emits a single summary record (see `RequestLog`) carrying its
+fields and per-stage timings, instead of one log line per stage. Successful
+requests can be sampled; failures are always logged.
+"""
+
+import atexit
+import logging
+import queue
+import random
+import time
+from contextlib import contextmanager
+from logging.handlers import QueueHandler, QueueListener
+from typing import Optional
+
+import orjson
+
+
+class LazyQueueHandler(QueueHandler):
+    """Queue handler that leaves all formatting to the listener thread"""
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        # The queue never leaves this process, so the record can be passed on
+        # as-is instead of being formatted (and its args merged) on the caller
+        return record
+
+
+class StructuredFormatter(logging.Formatter):
+    """Renders a record's structured `fields` as JSON, or as key=value pairs after the message"""
+
+    def __init__(self, json_output: bool = False):
+        super().__init__("%(asctime)s %(levelname)s %(name)s: %(message)s")
+        self.json_output = json_output
+
+    def format(self, record: logging.LogRecord) -> str:
+        fields = getattr(record, "fields", None)
+        if not self.json_output:
+            text = super().format(record)
+            if fields:
+                text += " " + " ".join(f"{key}={value}" for key, value in fields.items())
+            return text
+
+        payload = {
+            "ts": record.created,
+            "level": record.levelname,
+            "logger": record.name,
+            "message": record.getMessage(),
+        }
+        if fields:
+            payload.update(fields)
+        if record.exc_info:
+            payload["exc_info"] = self.formatException(record.exc_info)
+        return orjson.dumps(payload, default=str, option=orjson.OPT_SERIALIZE_NUMPY).decode()
+
+
+def setup_logging(level: str = "INFO", json_output: bool = False) -> QueueListener:
+    """
+    Route all logging through a background listener thread
+
+    Args:
+        level: Root log level name
+        json_output: Emit one JSON object per line instead of text
+
+    Returns:
+        The started listener (stopped automatically at exit)
+    """
+    log_queue = queue.SimpleQueue()
+    handler = logging.StreamHandler()
+    handler.setFormatter(StructuredFormatter(json_output))
+
+    root = logging.getLogger()
+    for existing in list(root.handlers):
+        root.removeHandler(existing)
+    root.addHandler(LazyQueueHandler(log_queue))
+    root.setLevel(level)
+
+    listener = QueueListener(log_queue, handler, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    return listener
+
+
+class RequestLog:
+    """Collects one request's fields and stage timings and logs them as a single record"""
+
+    def __init__(self, event: str, sample_rate: float = 1.0, **fields):
+        """
+        Args:
+            event: Name of the request type, e.g. "prediction"
+            sample_rate: Share of successful requests to log (failures are always logged)
+            **fields: Initial fields of the summary record
+        """
+        self.event = event
+        self.sample_rate = sample_rate
+        self.fields = fields
+        self.stages = {}
+        self.started = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name: str):
+        """Time a stage of the request; repeated stages accumulate"""
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.stages[name] = self.stages.get(name, 0.0) + (time.perf_counter() - started) * 1000
+
+    def emit(self, logger: logging.Logger, status_code: int = 200, error: Optional[str] = None):
+        """Log the summary record (subject to sampling when the request succeeded)"""
+        if status_code >= 500:
+            level = logging.ERROR
+        elif status_code >= 400:
+            level = logging.WARNING
+        else:
+            level = logging.INFO
+            if self.sample_rate < 1.0 and random.random() >= self.sample_rate:
+                return
+        if not logger.isEnabledFor(level):
+            return
+
+        fields = {
+            "event": self.event,
+            **self.fields,
+            "status": status_code,
+            "total_ms": round((time.perf_counter() - self.started) * 1000, 2),
+            "stages_ms": {name: round(ms, 2) for name, ms in self.stages.items()},
+        }
+        if error is not None:
+            fields["error"] = error
+        logger.log(level, "%s %s", self.event, "failed" if error is not None else "completed", extra={"fields": fields})
@@ -0,0 +1,469 @@
+"""
+Multi-process serving for the Plant Disease Classification API
+
+Starts several `main:app` worker processes, each pinned to its own CPU set
+with TensorFlow thread pools sized to match, and puts a lightweight
+front-end in front of them that routes every `/predict-<crop>` request to a
+worker that actually has that crop's model loaded.
+
+Example (rice and cotton on workers 0-1, mango on worker 2):
+
+    python serve.py --workers 3 --assign rice=0-1 --assign cotton=0-1 --assign mango=2
+
+Crops without an --assign entry are loaded on every worker.
+"""
+
+import argparse
+import asyncio
+import atexit
+import itertools
+import logging
+import os
+import re
+import signal
+import subprocess
+import sys
+from pathlib import Path
+from typing import Dict, List
+
+import aiohttp
+import uvicorn
+from fastapi import FastAPI, Request, WebSocket, WebSocketDisconnect
+from fastapi.responses import JSONResponse, StreamingResponse
+
+from upload_limits import UploadSizeLimitMiddleware
+
+
+logging.basicConfig(level=logging.INFO)
+logger = logging.getLogger("serve")
+
+PLANT_TYPES = ["tomato", "cotton", "mango", "rice"]
+
+# Headers that must not be copied verbatim between the front-end and workers
+HOP_BY_HOP_HEADERS = {
+    "host",
+    "connection",
+    "keep-alive",
+    "content-length",
+    "transfer-encoding",
+    "content-encoding",
+    "upgrade",
+}
+
+# /predict-<crop> and the /<route>/<crop> prediction endpoints must reach a worker that hosts the crop
+PREDICT_PATH_PATTERN = re.compile(r"^/(?:predict-|jobs/predict/|similar/|diagnose/)(\w+)")
+
+
+def parse_worker_range(spec: str) -> List[int]:
+    """Parse a worker range such as "0-1", "2" or "0,2" into worker ids"""
+    worker_ids = []
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-", 1)
+            worker_ids.extend(range(int(start), int(end) + 1))
+        else:
+            worker_ids.append(int(part))
+    return worker_ids
+
+
+def build_placement(num_workers: int, assignments: List[str]) -> Dict[int, List[str]]:
+    """
+    Work out which plant types each worker loads
+
+    Args:
+        num_workers: Number of worker processes
+        assignments: Entries of the form "<crop>=<worker range>"
+
+    Returns:
+        Mapping of worker id to the plant types it serves
+    """
+    assigned = {}
+    for entry in assignments:
+        if "=" not in entry:
+            raise ValueError(f"Invalid assignment '{entry}', expected <crop>=<workers>")
+        plant_type, spec = entry.split("=", 1)
+        plant_type = plant_type.strip().lower()
+        if plant_type not in PLANT_TYPES:
+            raise ValueError(f"Unsupported plant type: {plant_type}. Supported types: {PLANT_TYPES}")
+        worker_ids = parse_worker_range(spec)
+        invalid = [w for w in worker_ids if w < 0 or w >= num_workers]
+        if invalid:
+            raise ValueError(f"Worker ids {invalid} out of range for {num_workers} workers")
+        assigned[plant_type] = worker_ids
+
+    placement = {worker_id: [] for worker_id in range(num_workers)}
+    for plant_type in PLANT_TYPES:
+        for worker_id in assigned.get(plant_type, range(num_workers)):
+            placement[worker_id].append(plant_type)
+
+    empty = [worker_id for worker_id, plants in placement.items() if not plants]
+    if empty:
+        raise ValueError(f"Workers {empty} have no models assigned")
+    return placement
+
+
+def embedding_owners(placement: Dict[int, List[str]]) -> Dict[str, int]:
+    """
+    Pick the worker that keeps each crop's embedding store
+
+    A store is written by one process only, so every store and /similar
+    request for a crop goes to the first worker that hosts it.
+    """
+    owners = {}
+    for worker_id in sorted(placement):
+        for plant_type in placement[worker_id]:
+            owners.setdefault(plant_type, worker_id)
+    return owners
+
+
+def split_crops_across_workers(placement: Dict[int, List[str]], first: int = 0) -> Dict[int, List[str]]:
+    """
+    Pick workers that together host every crop, and the crops each one scores
+
+    Greedy set cover: the worker hosting the most crops not yet covered goes
+    next, ties going to the worker that comes first counting from `first`
+    (so successive requests spread over equivalent workers). Each crop is
+    given to exactly one worker.
+
+    Returns:
+        Mapping of worker id to the crops it should consider
+    """
+    order = sorted(placement, key=lambda w: (w - first) % len(placement))
+    uncovered = [plant_type for plant_type in PLANT_TYPES if any(plant_type in p for p in placement.values())]
+    split = {}
+    while uncovered:
+        worker_id = max(order, key=lambda w: sum(plant_type in placement[w] for plant_type in uncovered))
+        split[worker_id] = [plant_type for plant_type in uncovered if plant_type in placement[worker_id]]
+        uncovered = [plant_type for plant_type in uncovered if plant_type not in split[worker_id]]
+    return split
+
+
+def partition_cpus(num_workers: int) -> Dict[int, List[int]]:
+    """Split the CPUs available to this process into one contiguous set per worker"""
+    if hasattr(os, "sched_getaffinity"):
+        cpus = sorted(os.sched_getaffinity(0))
+    else:
+        cpus = list(range(os.cpu_count() or 1))
+
+    if num_workers >= len(cpus):
+        # More workers than cores: give each worker a single core, wrapping around
+        return {worker_id: [cpus[worker_id % len(cpus)]] for worker_id in range(num_workers)}
+
+    per_worker, extra = divmod(len(cpus), num_workers)
+    partitions = {}
+    start = 0
+    for worker_id in range(num_workers):
+        size = per_worker + (1 if worker_id < extra else 0)
+        partitions[worker_id] = cpus[start:start + size]
+        start += size
+    return partitions
+
+
+def start_worker(
+    worker_id: int,
+    port: int,
+    plant_types: List[str],
+    cpus: List[int],
+    worker_count: int,
+    embedding_plant_types: List[str],
+) -> subprocess.Popen:
+    """Launch a single `main:app` worker process"""
+    env = os.environ.copy()
+    env["WORKER_ID"] = str(worker_id)
+    env["WORKER_COUNT"] = str(worker_count)
+    env["WORKER_PLANT_TYPES"] = ",".join(plant_types)
+    env["WORKER_EMBEDDING_PLANT_TYPES"] = ",".join(embedding_plant_types)
+    if cpus:
+        env["WORKER_CPUS"] = ",".join(str(cpu) for cpu in cpus)
+
+    logger.info(f"Starting worker {worker_id} on port {port} with {plant_types} (CPUs: {cpus or 'unpinned'})")
+    return subprocess.Popen(
+        [
+            sys.executable, "-m", "uvicorn", "main:app",
+            "--host", "127.0.0.1",
+            "--port", str(port),
+            "--no-access-log",
+        ],
+        cwd=str(Path(__file__).resolve().parent),
+        env=env,
+    )
+
+
+def create_frontend(worker_urls: Dict[int, str], placement: Dict[int, List[str]]) -> FastAPI:
+    """
+    Build the front-end app that proxies requests to the workers
+
+    Prediction requests go round-robin to the workers that host the requested
+    crop, except that /similar and ?store=true requests go to the worker that
+    keeps the crop's embedding store; /predict/auto goes to workers that
+    together host every crop and their answers are merged; model reloads go
+    to every worker that hosts the crop; every other request goes round-robin
+    to all workers.
+    """
+    frontend = FastAPI(title="Plant Disease Classification API (front-end)")
+    # Same body cap as the workers, so nothing over it is buffered here
+    frontend.add_middleware(UploadSizeLimitMiddleware)
+
+    plant_workers = {
+        plant_type: [w for w, plants in placement.items() if plant_type in plants]
+        for plant_type in PLANT_TYPES
+        if any(plant_type in plants for plants in placement.values())
+    }
+    plant_routes = {
+        plant_type: itertools.cycle([worker_urls[w] for w in worker_ids])
+        for plant_type, worker_ids in plant_workers.items()
+    }
+    store_workers = {plant_type: worker_urls[w] for plant_type, w in embedding_owners(placement).items()}
+    any_worker = itertools.cycle(list(worker_urls.values()))
+    auto_turns = itertools.count()
+    state = {"session": None}
+
+    @frontend.on_event("startup")
+    async def open_session():
+        state["session"] = aiohttp.ClientSession(timeout=aiohttp.ClientTimeout(total=300))
+
+    @frontend.on_event("shutdown")
+    async def close_session():
+        if state["session"] is not None:
+            await state["session"].close()
+
+    def pick_worker(path: str, uses_store: bool = False) -> str:
+        match = PREDICT_PATH_PATTERN.match(path)
+        if match and match.group(1) in plant_routes:
+            # Queued jobs that store embeddings are claimed by the store's worker itself
+            if path.startswith("/similar/") or (uses_store and not path.startswith("/jobs/")):
+                return store_workers[match.group(1)]
+            return next(plant_routes[match.group(1)])
+        return next(any_worker)
+
+    @frontend.websocket("/ws/predict/{plant_type}")
+    async def proxy_websocket(websocket: WebSocket, plant_type: str):
+        worker_url = pick_worker(f"/predict-{plant_type}")
+        await websocket.accept()
+        try:
+            async with state["session"].ws_connect(
+                f"{worker_url.replace('http', 'ws', 1)}/ws/predict/{plant_type}"
+            ) as upstream:
+
+                async def client_to_worker():
+                    try:
+                        while True:
+                            message = await websocket.receive()
+                            if message["type"] == "websocket.disconnect":
+                                break
+                            if message.get("bytes") is not None:
+                                await upstream.send_bytes(message["bytes"])
+                            elif message.get("text") is not None:
+                                await upstream.send_str(message["text"])
+                    except WebSocketDisconnect:
+                        pass
+                    finally:
+                        await upstream.close()
+
+                pump = asyncio.create_task(client_to_worker())
+                try:
+                    async for message in upstream:
+                        if message.type == aiohttp.WSMsgType.TEXT:
+                            await websocket.send_text(message.data)
+                        elif message.type == aiohttp.WSMsgType.BINARY:
+                            await websocket.send_bytes(message.data)
+                        else:
+                            break
+                finally:
+                    pump.cancel()
+        except aiohttp.ClientError as e:
+            logger.warning(f"Worker {worker_url} WebSocket unavailable: {str(e)}")
+        except (WebSocketDisconnect, RuntimeError):
+            return
+
+        try:
+            await websocket.close()
+        except RuntimeError:
+            pass
+
+    @frontend.post("/models/{plant_type}/reload")
+    async def reload_on_every_worker(request: Request, plant_type: str):
+        """Reload a crop model on every worker that hosts it (each worker keeps its own copy)"""
+        worker_ids = plant_workers.get(plant_type)
+        if not worker_ids:
+            return await proxy(request, request.url.path.lstrip("/"))
+
+        async def reload_worker(worker_id: int):
+            try:
+                async with state["session"].post(
+                    f"{worker_urls[worker_id]}{request.url.path}",
+                    params=list(request.query_params.multi_items()),
+                ) as upstream:
+                    return upstream.status, await upstream.json(content_type=None)
+            except (aiohttp.ClientError, ValueError) as e:
+                logger.warning(f"Reloading {plant_type} on worker {worker_id} failed: {str(e)}")
+                return 503, {"detail": "Worker unavailable, please retry"}
+
+        results = dict(zip(worker_ids, await asyncio.gather(*(reload_worker(w) for w in worker_ids))))
+        statuses = {status for status, _ in results.values()}
+        if len(statuses) == 1 and statuses != {200}:
+            # Every worker rejected it the same way (e.g. unknown role or no canary)
+            status, body = next(iter(results.values()))
+            return JSONResponse(status_code=status, content=body)
+        return JSONResponse(
+            status_code=200 if statuses == {200} else 502,
+            content={
+                "plant_type": plant_type,
+                "reloaded": any(status == 200 and body.get("reloaded") for status, body in results.values()),
+                "workers": {str(w): {"status": status, **body} for w, (status, body) in results.items()},
+            },
+        )
+
+    @frontend.post("/predict/auto")
+    async def predict_auto_across_workers(request: Request):
+        """
+        Identify the crop of an upload among all crops, wherever they are loaded
+
+        Each chosen worker considers only its share of the crops. When the
+        crop classifier is confident, only the worker given that crop answers
+        (the others reply 409); otherwise the most decisive head over all
+        workers wins, as crop_match_score is comparable across heads.
+        """
+        split = split_crops_across_workers(placement, next(auto_turns) % len(placement))
+        headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+        body = await request.body()
+
+        async def ask_worker(worker_id: int, plant_types: List[str]):
+            params = [(k, v) for k, v in request.query_params.multi_items() if k != "plant_types"]
+            params.append(("plant_types", ",".join(plant_types)))
+            try:
+                async with state["session"].post(
+                    f"{worker_urls[worker_id]}/predict/auto", params=params, headers=headers, data=body
+                ) as upstream:
+                    return upstream.status, await upstream.json(content_type=None)
+            except (aiohttp.ClientError, ValueError) as e:
+                logger.warning(f"Auto prediction on worker {worker_id} failed: {str(e)}")
+                return 503, {"detail": "Worker unavailable, please retry"}
+
+        results = await asyncio.gather(*(ask_worker(w, plant_types) for w, plant_types in split.items()))
+        answers = [content for status, content in results if status == 200]
+        if not answers:
+            # A 409 only means "not my crop"; any other error says more
+            status, content = next(((s, c) for s, c in results if s != 409), results[0])
+            return JSONResponse(status_code=status, content=content)
+
+        by_classifier = [a for a in answers if a["crop_identification"]["method"] == "crop_classifier"]
+        if by_classifier:
+            best = by_classifier[0]
+        else:
+            best = max(answers, key=lambda a: a["crop_identification"]["confidence"])
+            best["crop_identification"]["scores"] = {
+                plant_type: score for a in answers for plant_type, score in a["crop_identification"]["scores"].items()
+            }
+        # Crops of workers that failed were not considered
+        best["considered_crops"] = [
+            plant_type
+            for (status, _), plant_types in zip(results, split.values())
+            if status in (200, 409)
+            for plant_type in plant_types
+        ]
+        return JSONResponse(content=best)
+
+    @frontend.api_route("/{path:path}", methods=["GET", "POST", "PUT", "PATCH", "DELETE", "OPTIONS"])
+    async def proxy(request: Request, path: str):
+        worker_url = pick_worker(
+            request.url.path, request.query_params.get("store", "").lower() in ("1", "true", "yes", "on")
+        )
+        headers = {k: v for k, v in request.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+        body = await request.body()
+
+        try:
+            upstream = await state["session"].request(
+                request.method,
+                f"{worker_url}{request.url.path}",
+                params=list(request.query_params.multi_items()),
+                headers=headers,
+                data=body,
+            )
+        except aiohttp.ClientConnectionError as e:
+            logger.warning(f"Worker {worker_url} unavailable: {str(e)}")
+            return JSONResponse(status_code=503, content={"detail": "Worker unavailable, please retry"})
+
+        # Relay the body as it arrives, so streamed (NDJSON) responses reach the client line by line
+        async def relay_body():
+            try:
+                async for chunk in upstream.content.iter_any():
+                    yield chunk
+            except aiohttp.ClientError as e:
+                logger.warning(f"Worker {worker_url} response cut off: {str(e)}")
+            finally:
+                upstream.release()
+
+        response_headers = {k: v for k, v in upstream.headers.items() if k.lower() not in HOP_BY_HOP_HEADERS}
+        return StreamingResponse(relay_body(), status_code=upstream.status, headers=response_headers)
+
+    return frontend
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Run the API as multiple pinned worker processes")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Number of worker processes")
+    parser.add_argument(
+        "--assign",
+        action="append",
+        default=[],
+        metavar="CROP=WORKERS",
+        help="Place a crop on specific workers, e.g. rice=0-1 (repeatable)",
+    )
+    parser.add_argument("--host", default="0.0.0.0", help="Front-end bind address")
+    parser.add_argument("--port", type=int, default=8000, help="Front-end port")
+    parser.add_argument("--worker-base-port", type=int, default=8100, help="Port of worker 0 (others follow)")
+    parser.add_argument("--no-pin", action="store_true", help="Do not pin workers to CPU sets")
+    args = parser.parse_args()
+
+    if args.workers < 1:
+        parser.error("--workers must be at least 1")
+
+    try:
+        placement = build_placement(args.workers, args.assign)
+    except ValueError as e:
+        parser.error(str(e))
+
+    cpu_sets = {} if args.no_pin else partition_cpus(args.workers)
+    owners = embedding_owners(placement)
+    worker_urls = {}
+    processes = []
+    for worker_id, plant_types in placement.items():
+        port = args.worker_base_port + worker_id
+        processes.append(
+            start_worker(
+                worker_id,
+                port,
+                plant_types,
+                cpu_sets.get(worker_id, []),
+                len(placement),
+                [plant_type for plant_type, owner in owners.items() if owner == worker_id],
+            )
+        )
+        worker_urls[worker_id] = f"http://127.0.0.1:{port}"
+
+    def stop_workers(*_):
+        for process in processes:
+            if process.poll() is None:
+                process.terminate()
+        for process in processes:
+            try:
+                process.wait(timeout=10)
+            except subprocess.TimeoutExpired:
+                process.kill()
+
+    atexit.register(stop_workers)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    print(f"🚀 Front-end listening on http://{args.host}:{args.port} with {args.workers} workers")
+    for worker_id, plant_types in placement.items():
+        print(f"   - worker {worker_id}: {', '.join(plant_types)} -> {worker_urls[worker_id]}")
+
+    uvicorn.run(create_frontend(worker_urls, placement), host=args.host, port=args.port, access_log=True)
+
+
+if __name__ == "__main__":
+    main()
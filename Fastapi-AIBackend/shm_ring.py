@@ -0,0 +1,132 @@
+"""
+Shared-memory ring buffer of preprocessed input images
+
+Decode workers (separate processes) write resized uint8 RGB images straight
+into preallocated slots of a `multiprocessing.shared_memory` block, and the
+inference batcher reads a contiguous run of slots as a single numpy view, so
+no image array is ever pickled between processes.
+
+This module only depends on numpy and Pillow so decode workers stay light
+(they never import TensorFlow).
+"""
+
+import io
+from multiprocessing import shared_memory
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from PIL import Image
+
+
+def prepare_pixels(image: Image.Image, image_size: Tuple[int, int]) -> np.ndarray:
+    """
+    Convert a PIL image to a resized uint8 RGB array
+
+    Args:
+        image: PIL Image object
+        image_size: Target (width, height)
+
+    Returns:
+        uint8 array of shape (height, width, 3)
+    """
+    if image.mode != "RGB":
+        image = image.convert("RGB")
+    if image.size != tuple(image_size):
+        image = image.resize(image_size)
+    return np.asarray(image, dtype=np.uint8)
+
+
+class SharedImageRing:
+    """Fixed number of uint8 image slots backed by one shared memory block"""
+
+    def __init__(
+        self,
+        num_slots: int,
+        image_size: Tuple[int, int],
+        name: Optional[str] = None,
+        create: bool = True,
+    ):
+        self.num_slots = num_slots
+        self.image_size = tuple(image_size)
+        width, height = self.image_size
+        self.shape = (num_slots, height, width, 3)
+        nbytes = int(np.prod(self.shape))
+
+        if create:
+            self.shm = shared_memory.SharedMemory(create=True, size=nbytes)
+        else:
+            # Pool workers share the creating process's resource tracker, so
+            # attaching does not hand ownership of the block to the worker
+            self.shm = shared_memory.SharedMemory(name=name)
+
+        self.name = self.shm.name
+        self.owner = create
+        self.array = np.ndarray(self.shape, dtype=np.uint8, buffer=self.shm.buf)
+
+    @classmethod
+    def attach(cls, name: str, num_slots: int, image_size: Tuple[int, int]) -> "SharedImageRing":
+        """Attach to a ring created by another process"""
+        return cls(num_slots, image_size, name=name, create=False)
+
+    def slot(self, index: int) -> np.ndarray:
+        """Writable view of a single slot"""
+        return self.array[index]
+
+    def batch_view(self, start: int, count: int) -> np.ndarray:
+        """View of `count` consecutive slots starting at `start` (no copy)"""
+        if start < 0 or start + count > self.num_slots:
+            raise IndexError(f"Slots {start}..{start + count - 1} outside ring of {self.num_slots}")
+        return self.array[start:start + count]
+
+    def write_pixels(self, index: int, pixels: np.ndarray):
+        """Copy an already resized uint8 image into a slot"""
+        np.copyto(self.array[index], pixels, casting="unsafe")
+
+    def write_image(self, index: int, image_data: bytes) -> Tuple[int, int]:
+        """Decode encoded image bytes into a slot and return the original (width, height)"""
+        with Image.open(io.BytesIO(image_data)) as image:
+            original_size = image.size
+            self.write_pixels(index, prepare_pixels(image, self.image_size))
+        return original_size
+
+    def close(self):
+        """Release this process's mapping (and the block itself if we own it)"""
+        self.array = None
+        try:
+            self.shm.close()
+        except BufferError:
+            # A batch view is still alive somewhere; the mapping goes away with the process
+            pass
+        if self.owner:
+            try:
+                self.shm.unlink()
+            except FileNotFoundError:
+                pass
+
+
+# Rings attached by this (worker) process, keyed by shared memory name
+_attached_rings: Dict[str, SharedImageRing] = {}
+
+
+def decode_into_ring(
+    ring_name: str,
+    num_slots: int,
+    image_size: Tuple[int, int],
+    slot_index: int,
+    image_data: bytes,
+) -> Tuple[int, int]:
+    """
+    Decode-worker entry point: decode image bytes into a ring slot
+
+    Runs in a process pool; only the slot index and the original image size
+    travel back to the parent process.
+
+    Returns:
+        Original (width, height) of the decoded image
+    """
+    ring = _attached_rings.get(ring_name)
+    if ring is None:
+        ring = SharedImageRing.attach(ring_name, num_slots, image_size)
+        _attached_rings[ring_name] = ring
+
+    return ring.write_image(slot_index, image_data)
@@ -0,0 +1,58 @@
+"""
+Request body cap shared by the API workers and the serve.py front-end
+
+Kept free of TensorFlow so the front-end can enforce the same limit before it
+forwards anything to a worker.
+"""
+
+import os
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+
+
+MAX_UPLOAD_BYTES = int(os.getenv("MAX_UPLOAD_BYTES", str(10 * 1024 * 1024)))
+# Multipart boundaries and part headers around the file itself
+MULTIPART_OVERHEAD_BYTES = 64 * 1024
+
+
+def upload_too_large_message() -> str:
+    return f"File size too large. Maximum {MAX_UPLOAD_BYTES // (1024 * 1024)}MB allowed."
+
+
+class UploadSizeLimitMiddleware:
+    """
+    Reject request bodies over the upload cap before they are parsed
+
+    Requests that declare a larger Content-Length get a 413 straight away;
+    chunked bodies are counted as they arrive and cut off at the cap, so an
+    oversized upload is never spooled in full.
+    """
+
+    def __init__(self, app, max_body_bytes: int = MAX_UPLOAD_BYTES + MULTIPART_OVERHEAD_BYTES):
+        self.app = app
+        self.max_body_bytes = max_body_bytes
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        content_length = dict(scope["headers"]).get(b"content-length")
+        if content_length is not None and content_length.isdigit() and int(content_length) > self.max_body_bytes:
+            response = JSONResponse(status_code=413, content={"detail": upload_too_large_message()})
+            await response(scope, receive, send)
+            return
+
+        received = 0
+
+        async def limited_receive():
+            nonlocal received
+            message = await receive()
+            if message["type"] == "http.request":
+                received += len(message.get("body", b""))
+                if received > self.max_body_bytes:
+                    raise HTTPException(status_code=413, detail=upload_too_large_message())
+            return message
+
+        await self.app(scope, limited_receive, send)